@@ -1,27 +1,73 @@
+import asyncio
+import os
 import re
 import time
+from typing import Set
 
 import httpx
 from app.chroma_client import ChromaClient
 from app.colors import INFO_COLOR, Colors
+from app.context_packer import ContextPacker, PackedContext
 from app.generator import Generator
+from app.http_pool import get_async_client
+from app.intent_router import IntentRouter, query_terms
+from app.request_context import FOLLOW_UP, begin_turn, set_priority
 from app.thread_store import ThreadStore
+from app.tracing import span
+from app.usage import TurnUsage, UsageBreakdown, set_step
 from app.schemas import *
 from app.google_gen import GoogleGenAI
 
 MAX_ITERATIONS = 3
+# Search the thread's documents with the raw user message while the intent analysis runs
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "1") == "1"
+# Search queries per research iteration: the model's follow-up query plus its sub-queries
+RESEARCH_FANOUT = int(os.getenv("RESEARCH_FANOUT", "3"))
+
+
+def merge_chunks(*results: List[Dict[str, Any]], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Merges search_chunks results of several queries over the same collection: deduplicated
+    by chunk id and ordered by distance (earlier result lists win ties).
+    """
+    best: Dict[str, Dict[str, Any]] = {}
+    for chunks in results:
+        for chunk in chunks:
+            known = best.get(chunk["id"])
+            if known is None or chunk["distance"] < known["distance"]:
+                best[chunk["id"]] = chunk
+    merged = sorted(best.values(), key=lambda chunk: chunk["distance"])
+    return merged[:limit] if limit else merged
+
+
+def research_queries(response: ResponseWithRetrieval) -> List[str]:
+    """
+    Search queries for the next research iteration: `any_more_info_needed` and `search_queries`
+    of the response, deduplicated, at most RESEARCH_FANOUT. Empty if the answer is complete.
+    """
+    queries: List[str] = []
+    for query in [response.any_more_info_needed or "", *response.search_queries]:
+        query = query.strip()
+        if query and query.lower() not in {q.lower() for q in queries}:
+            queries.append(query)
+    return queries[:RESEARCH_FANOUT]
 
 class Agent:
-    def __init__(self, generator: Generator, chroma_client: ChromaClient, thread_store : ThreadStore, language : str = "Russian"):
+    def __init__(self, generator: Generator, chroma_client: ChromaClient, thread_store : ThreadStore, language : str = "Russian", packer: Optional[ContextPacker] = None, intent_router: Optional[IntentRouter] = None):
         self.generator = generator
         self.chroma_client = chroma_client
         self.thread_store = thread_store  
         self.language = language
+        self.packer = packer or ContextPacker(context_size=generator.context_size)
+        self.intent_router = intent_router
         
         
-    def history_to_payload(self, thread: Thread) -> LLamaMessageHistory:
+    def history_to_payload(self, thread: Thread, history: Optional[List[Message]] = None) -> LLamaMessageHistory:
+        """
+        :param history: Messages to use instead of the whole thread history (e.g. PackedContext.history).
+        """
         messages = []
-        for msg in thread.history:
+        for msg in (thread.history if history is None else history):
             if msg.sender == "user":
                 messages.append(UserLamaMessage(content=msg.content))
             elif msg.sender == "agent":
@@ -30,11 +76,64 @@ class Agent:
                 messages.append(SystemLamaMessage(content=msg.content))
         return LLamaMessageHistory(messages=messages)
         
-    def user_intent(self, thread : Thread, temperature:float = 0.5) -> IntentAnalysis:
-        doc_list_text = ""
-        for doc in self.chroma_client.get_all_documents():
-            if doc.get('id') in thread.document_ids: # type: ignore
-                doc_list_text += f"- {doc.get('name')}\n"
+    async def stream_answer(self, payload: LLamaMessageHistory, system_prompt: str, temperature: float = 0.7):
+        """
+        Generates a plain-text answer, yielding an AgentDelta for every streamed piece
+        and then the full answer as the last item (a str).
+        """
+        payload.messages.insert(0, SystemLamaMessage(role="system", content=f"{system_prompt}\n\nAnswer in {self.language}."))
+        parts = []
+        with span("answer"):
+            async for delta in self.generator.astream_function(payload=payload, temperature=temperature, max_tokens=2048):
+                parts.append(delta)
+                yield AgentDelta(delta=delta)
+        yield "".join(parts)
+
+    async def pack_context(self, label: str, **kwargs) -> PackedContext:
+        """
+        Runs ContextPacker.pack off the event loop (token counting may call the tokenizer server).
+        """
+        with span("pack context", label=label):
+            return await asyncio.to_thread(self.packer.pack, label=label, **kwargs)
+
+    def finish_turn(self, thread: Thread, turn_usage: TurnUsage) -> AgentUsage:
+        """
+        Adds the turn's usage to the thread's cumulative usage (metadata["usage"], saved with
+        the thread) and returns the event that closes the stream.
+        """
+        thread_usage = UsageBreakdown.from_dict(thread.metadata.get("usage"))
+        thread_usage.merge(turn_usage)
+        thread.metadata["usage"] = thread_usage.to_dict()
+        print(f"{INFO_COLOR}Turn usage:{Colors.RESET} {turn_usage}")
+        return AgentUsage(usage=turn_usage.to_dict())
+
+    async def thread_document_names(self, thread: Thread) -> List[str]:
+        return [doc.get('name') for doc in await asyncio.to_thread(self.chroma_client.get_all_documents)
+                if doc.get('id') in thread.document_ids]  # type: ignore
+
+    async def analyze_intent(self, thread: Thread) -> IntentAnalysis:
+        """
+        Intent of the latest user message: from the intent router when it is confident,
+        otherwise from the LLM (`user_intent`). A routed turn keeps the message as the query.
+        """
+        if self.intent_router is None:
+            return await self.user_intent(thread)
+        doc_names = await self.thread_document_names(thread) if thread.document_ids else []
+        decision = await asyncio.to_thread(self.intent_router.route, thread, doc_names)
+        print(f"{INFO_COLOR}Intent router:{Colors.RESET} {decision}")
+        if decision.routed:
+            return IntentAnalysis(enhanced_query=thread.history[-1].content, need_for_retrieval=decision.need_for_retrieval)
+        response = await self.user_intent(thread, doc_names=doc_names)
+        self.intent_router.record_llm(decision, response.need_for_retrieval)
+        return response
+
+    async def user_intent(self, thread : Thread, temperature:float = 0.5, doc_names: Optional[List[str]] = None) -> IntentAnalysis:
+        """
+        :param doc_names: Names of the thread's documents, if already known.
+        """
+        if doc_names is None:
+            doc_names = await self.thread_document_names(thread)
+        doc_list_text = "".join(f"- {name}\n" for name in doc_names)
 
 
         example_query = [{'role': 'user', 'content': 'опиши по порядку все содержание файла ПЗ'}, {'role': 'model', 'content': 'Пожалуйста, предоставьте больше информации о файле ПЗ.  Мне нужно знать, что это за файл.  В частности, мне нужно увидеть содержимое файла, чтобы я мог описать его функциональность и назначение.'},  {'role': 'model', 'content': 'Проект - устройство для измерения расстояний, использующее HC-SR04, предназначенное для работы с Raspberry Pi, с точностью до 4 м и низким уровнем стоимости.'}, {'role': 'user', 'content': 'hi there'}]
@@ -50,35 +149,41 @@ class Agent:
             self-contained question or statement. It should be detailed and specific, incorporating relevant information from the chat history and documents. It should be grammatically correct and coherent.\n\n
             You also need to determine if the user's query can be answered directly without retrieval. If not need_for_retrieval should be true.\n\n
             If user mentions any documant or topic from availabel or spmething that is not present in the current context you must set need_for_retrieval as true.
-            **Available Documents:**\n{doc_list_text}\n\n
+            The available documents are listed before the conversation history.\n\n
             Dont ask for more information, just rewrite the query.\n\n
+            """
+        )
+        examples = f"""
             <Example>
             example query(conversation history): {example_query} 
             example response: {example_response} 
             </Example>
             """
-        )
         
+        packed = await self.pack_context("intent", system=system_prompt, fixed=[doc_list_text], history=thread.history,
+                                         extras=[("examples", examples)])
+        system_prompt += "".join(packed.extras)
+        history = self.history_to_payload(thread, packed.history)
         prompt = f"""
+        **Available Documents:**\n{doc_list_text}\n
         Here is the conversation history and you must determine what exactly user wants to get from the data retrieval system with their latest query.
         <conversation history>
-        {self.history_to_payload(thread)}
+        {history}
         </conversation history>
         """ 
-        print("Prompt for intent analysis:", system_prompt)
-        print("History for intent analysis:", self.history_to_payload(thread).to_dict())
-        response: IntentAnalysis = self.generator.generate_one_shot(
+        response: IntentAnalysis = await self.generator.agenerate_one_shot(
             system_prompt=system_prompt,
             prompt=prompt,
             language=self.language,
             pydantic_model=IntentAnalysis,
-            temperature=temperature
+            temperature=temperature,
+            cacheable=True  # same history and documents give the same analysis
         )  
         print(f"Identified intent: {response.enhanced_query}, Need for retrieval: {response.need_for_retrieval}")
         return response
 
     
-    def user_intent_db_explorer(self, thread: Thread, temperature: float = 0.5) -> DataBaseIntentAnalysis:
+    async def user_intent_db_explorer(self, thread: Thread, temperature: float = 0.5) -> DataBaseIntentAnalysis:
         """
         Analyzes the user's intent for querying a database, rewrites the query with context,
         and determines if an SQL query is necessary.
@@ -93,7 +198,7 @@ class Agent:
         """
 
         try:
-            response = httpx.get(f"http://127.0.0.1:{int(os.getenv('MCP_PORT', 1234))}/api/database/tables")
+            response = await get_async_client("mcp").get(f"http://127.0.0.1:{int(os.getenv('MCP_PORT', 1234))}/api/database/tables")
             response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
             db_structure = response.json()
         except httpx.RequestError as e:
@@ -121,8 +226,7 @@ class Agent:
             The rewritten query should be a detailed and specific description of what the user wants.
 
             You also need to determine if an SQL query is necessary to answer the user's query.
-
-            **Available Database Structure:**\n{db_structure}\n\n
+            The available database structure is given before the conversation history.
 
             <Example 1>
             example query(conversation history): {example_query}
@@ -136,49 +240,106 @@ class Agent:
             """
         )
 
+        packed = await self.pack_context("db intent", system=system_prompt, fixed=[str(db_structure)], history=thread.history)
         prompt = f"""
+        **Available Database Structure:**\n{db_structure}\n
         Here is the conversation history. Determine what the user wants to get from the database,
         and describe it in detail, including exact columns, tables and other names, filters and the number of queries required.
         <conversation history>
-        {self.history_to_payload(thread).to_dict()}
+        {self.history_to_payload(thread, packed.history).to_dict()}
         </conversation history>
         """
         # print("Prompt for intent analysis:", system_prompt)
         # print("History for intent analysis:", self.history_to_payload(thread).to_dict())
 
         #  Use the generator to create the intent analysis
-        analysis_response: DataBaseIntentAnalysis = self.generator.generate_one_shot(
+        analysis_response: DataBaseIntentAnalysis = await self.generator.agenerate_one_shot(
             system_prompt=system_prompt,
             prompt=prompt,
             language=self.language,
             pydantic_model=DataBaseIntentAnalysis,
-            temperature=temperature
+            temperature=temperature,
+            cacheable=True  # same history and documents give the same analysis
         )
 
         print(f"Identified intent: {analysis_response.enhanced_query}, Need for SQL: {analysis_response.need_for_sql}")
         return analysis_response
 
 
-    def user_query(self, user_input: str, thread_id: str, iterate: bool = True, temperature: float = 0.7):
-        thread = self.thread_store.get_thread(thread_id)
+    def search_thread_chunks(self, thread: Thread, query_text: str) -> List[Dict[str, Any]]:
+        return self.chroma_client.search_chunks(
+            query_text=query_text,
+            top_k=2 * self.packer.top_k,  # spare candidates for chunks that don't fit the context
+            doc_ids=thread.document_ids
+        )
+
+    def start_speculative_retrieval(self, thread: Thread, user_input: str) -> Optional[asyncio.Task]:
+        """
+        Starts the search with the raw user message in a worker thread, so embedding and the
+        vector search overlap with the intent analysis LLM call. None if disabled or the thread has no documents.
+        """
+        if not SPECULATIVE_RETRIEVAL or not thread.document_ids:
+            return None
+        return asyncio.create_task(asyncio.to_thread(self.search_thread_chunks, thread, user_input))
+
+    async def retrieve_chunks(self, thread: Thread, enhanced_query: str, speculative: Optional[asyncio.Task] = None) -> List[Dict[str, Any]]:
+        """
+        Chunks for the answer. Without a speculative search, searches with the enhanced query.
+        Otherwise the speculative results are used alone if the enhanced query has no terms
+        that aren't in the user message, and merged with the enhanced query's results if it has.
+
+        :param speculative: Task started by `start_speculative_retrieval`.
+        """
+        user_message = thread.history[-1].content
+        query_text = enhanced_query + " Оriginal text follows:" + user_message  # Use the enriched query for search
+        if speculative is None:
+            return await asyncio.to_thread(self.search_thread_chunks, thread, query_text)
+
+        ready = speculative.done()
+        try:
+            speculative_chunks = await speculative
+        except Exception as e:
+            print(f"Speculative retrieval failed, searching with the enhanced query: {e}")
+            return await asyncio.to_thread(self.search_thread_chunks, thread, query_text)
+
+        new_terms = query_terms(enhanced_query) - query_terms(user_message)
+        if not new_terms:
+            print(f"{INFO_COLOR}Speculative retrieval:{Colors.RESET} {len(speculative_chunks)} chunks "
+                  f"({'ready' if ready else 'awaited'}), enhanced query adds nothing new")
+            return speculative_chunks
+        enhanced_chunks = await asyncio.to_thread(self.search_thread_chunks, thread, query_text)
+        merged = merge_chunks(enhanced_chunks, speculative_chunks, limit=2 * self.packer.top_k)
+        print(f"{INFO_COLOR}Speculative retrieval:{Colors.RESET} {len(speculative_chunks)} chunks "
+              f"({'ready' if ready else 'awaited'}) merged with {len(enhanced_chunks)} of the enhanced query "
+              f"-> {len(merged)}")
+        return merged
+
+    async def user_query(self, user_input: str, thread_id: str, iterate: bool = True, temperature: float = 0.7):
+        turn_usage = begin_turn(thread_id)
+        with span("load thread"):
+            thread = await asyncio.to_thread(self.thread_store.get_thread, thread_id)
         if not thread:
             raise ValueError("Thread not found")
         
         thread.history.append(UserMessage(sender="user", content=user_input))
         
-        # We'll use the enriched query from the previous step here
-        enriched_query_obj = self.user_intent(thread)
+        set_step("retrieval")  # the speculative search task keeps this step
+        speculative = self.start_speculative_retrieval(thread, user_input)
+        set_step("intent")
+        try:
+            # We'll use the enriched query from the previous step here
+            with span("intent"):
+                enriched_query_obj = await self.analyze_intent(thread)
+        except BaseException:
+            if speculative:
+                speculative.cancel()
+            raise
         
         if enriched_query_obj.need_for_retrieval and thread.document_ids:
             print(f"{INFO_COLOR} RAG USED {Colors.RESET}")
-            retrieved_chunks_data = self.chroma_client.search_chunks(
-                query_text=enriched_query_obj.enhanced_query + " Оriginal text follows:" + thread.history[-1].content, # Use the enriched query for search
-                top_k=5,
-                doc_ids=thread.document_ids
-            )
-            chunks_text = "\n".join(
-                [f"<chunk index=\"{index}\" name=\"{chunk['metadata']['name']}\">\n{chunk['text']}\n</chunk>" for index, chunk in enumerate(retrieved_chunks_data)]
-            )
+            set_step("retrieval")
+            with span("retrieval"):
+                retrieved_chunks_data = await self.retrieve_chunks(thread, enriched_query_obj.enhanced_query, speculative)
 
             system_prompt = (
                 f"""
@@ -186,13 +347,20 @@ class Agent:
                 1. Provide a concise, direct answer to the user's query based strictly on the information in `<likely_referenced_data>`. You are allowed to use  MarkDown tags only inside `answer` filed.\n
                 2. After answering, check if any part of the user's query remains unanswered.\n
                 3. For requesting additional details, generate a focused search query in the `any_more_info_needed` field for the next iteration.\n
-                if the answer is incomplete YOU MUST ITERATE and place in the `any_more_info_needed` field the information necessary to continue refining the answer in the next step.\n\n
-                <likely_referenced_data>
-                {chunks_text}\n\n
-                </likely_referenced_data>
+                if the answer is incomplete YOU MUST ITERATE and place in the `any_more_info_needed` field the information necessary to continue refining the answer in the next step.\n
+                4. If several different things are missing, also put up to {RESEARCH_FANOUT} short, independent search queries, one per missing part, in the `search_queries` field; they are searched in parallel.\n\n
                 """
             )
+            packed = await self.pack_context("retrieval answer", system=system_prompt, fixed=[enriched_query_obj.enhanced_query],
+                                             chunks=retrieved_chunks_data)
+            retrieved_chunks_data = packed.chunks
+            chunks_text = "\n".join(
+                [f"<chunk index=\"{index}\" name=\"{chunk['metadata']['name']}\">\n{chunk['text']}\n</chunk>" for index, chunk in enumerate(retrieved_chunks_data)]
+            )
             prompt = f"""
+            <likely_referenced_data>
+            {chunks_text}\n\n
+            </likely_referenced_data>
             Here is the user query that you should fulfill using the information provided.
             <user_query>
             {enriched_query_obj.enhanced_query}
@@ -200,76 +368,122 @@ class Agent:
             """ 
 
             # print("Prompt for response with retrieval:", prompt)
-            response = self.generator.generate_one_shot(
-                system_prompt=system_prompt,
-                prompt=prompt,
-                language=self.language,
-                pydantic_model=ResponseWithRetrieval,
-                temperature=temperature)
+            set_step("answer")
+            with span("answer"):
+                async for event in self.generator.astream_one_shot(
+                    system_prompt=system_prompt,
+                    prompt=prompt,
+                    language=self.language,
+                    pydantic_model=ResponseWithRetrieval,
+                    temperature=temperature):
+                    if isinstance(event, AgentDelta):
+                        yield event
+                    else:
+                        response = event
             
             retrieved_docs_map = {chunk['metadata']['doc_id']: chunk['metadata']['name'] for chunk in retrieved_chunks_data}
             retrieved_docs = [RetrievedDocument(id=doc_id, name=name) for doc_id, name in retrieved_docs_map.items()]
 
             thread.history.append(AgentMessage(sender="agent", content=response.answer, retrieved_docs=retrieved_docs))
             
-            agent_response = AgentResponse(answer=response.answer, retrieved_docs=retrieved_docs, follow_up=not(response.any_more_info_needed is None))
+            queries = research_queries(response)
+            agent_response = AgentResponse(answer=response.answer, retrieved_docs=retrieved_docs, follow_up=bool(queries))
             yield agent_response.model_dump_json()
             
-            if response.any_more_info_needed and iterate:
-                yield AgentResponse(answer="<internal>" + response.any_more_info_needed).model_dump_json()
+            if queries and iterate:
+                yield AgentResponse(answer="<internal>" + "; ".join(queries)).model_dump_json()
                 # thread.history.append(AgentMessage(sender="agent", content=response.any_more_info_needed))
-                yield from self.agent_query(0, thread, response.any_more_info_needed)
+                seen_ids = {chunk["id"] for chunk in retrieved_chunks_data}
+                async for event in self.agent_query(0, thread, queries, seen_ids):
+                    yield event
         else:
-            
+            if speculative:
+                speculative.cancel()
             print(f"{INFO_COLOR} NO RAG {Colors.RESET}")
             system_prompt = (
                 f"You are a helpful assistant. Your task is to directly answer the user's question based on the provided chat history. "
-                f"Do not explain your reasoning process. Provide a direct answer in the `answer` field.\n\n"
+                f"Do not explain your reasoning process. Reply with the answer text only.\n\n"
                 f"Based on the user query, provide a comprehensive answer."
             )
-            response = self.generator.generate_with_payload(
-                system_prompt=system_prompt,
-                language=self.language,
-                pydantic_model=ResponseWithoutRetrieval,
-                payload=self.history_to_payload(thread))
+            packed = await self.pack_context("answer", system=system_prompt, history=thread.history)
+            set_step("answer")
+            async for event in self.stream_answer(self.history_to_payload(thread, packed.history), system_prompt):
+                if isinstance(event, AgentDelta):
+                    yield event
+                else:
+                    answer = event
             
-            thread.history.append(AgentMessage(sender="agent", content=response.answer))
-            yield AgentResponse(answer=response.answer).model_dump_json()
-        self.thread_store.save_thread(thread)
+            thread.history.append(AgentMessage(sender="agent", content=answer))
+            yield AgentResponse(answer=answer).model_dump_json()
+        usage_event = self.finish_turn(thread, turn_usage)
+        with span("save thread"):
+            await asyncio.to_thread(self.thread_store.save_thread, thread)
+        yield usage_event
         
-    def agent_query(self, iteration : int, thread : Thread, info_needed : str):
+    async def agent_query(self, iteration: int, thread: Thread, queries: List[str], seen_ids: Set[str]):
+        """
+        One research iteration: searches the thread's documents with all `queries` at once
+        (one embedding batch, one vector query), answers with the chunks the model hasn't seen
+        in this turn yet and continues with the queries of its answer. Stops early when the
+        search brings nothing new.
+
+        :param queries: Search queries from `research_queries`.
+        :param seen_ids: Ids of chunks already given to the model in this turn; updated in place.
+        """
         if iteration >= MAX_ITERATIONS:
             yield AgentResponse(answer="<internal>Maximum iterations reached.").model_dump_json()
             return
-
-        # In agent_query, we search all documents since the query is for new info
-        retrieved_chunks_data = self.chroma_client.search_documents(
-                query_text=info_needed,
-                top_k=5
-            )
-        
-        chunks_text = "\n".join(
-            [f"<chunk index=\"{index}\" name=\"{chunk['metadata']['name']}\">\n{chunk['text']}\n</chunk>" for index, chunk in enumerate(retrieved_chunks_data)] # type: ignore
-        )
-        
-        history = "\n".join([f"{'User' if msg.sender == 'user' else 'Agent'}: {msg.content}" for msg in thread.history])
+        # research iterations yield to first answers of other users
+        set_priority(FOLLOW_UP)
+        set_step(f"research {iteration}")
+
+        with span(f"research {iteration} search", queries=len(queries)) as search:
+            results = await asyncio.to_thread(
+                    self.chroma_client.search_chunks_many,
+                    query_texts=queries,
+                    top_k=2 * self.packer.top_k,
+                    doc_ids=thread.document_ids,
+                    exclude_ids=seen_ids
+                )
+            retrieved_chunks_data = merge_chunks(*results, limit=2 * self.packer.top_k)
+            search.set(new_chunks=len(retrieved_chunks_data), seen_chunks=len(seen_ids))
+        print(f"{INFO_COLOR}Iteration {iteration} {Colors.RESET} - {len(queries)} queries, "
+              f"{len(retrieved_chunks_data)} new chunks ({len(seen_ids)} already seen)")
+        if not retrieved_chunks_data:
+            yield AgentResponse(answer="<internal>No new information found.").model_dump_json()
+            return
         
         # --- REWORKED PROMPT ---
         system_prompt = (
             f"You are in a research loop to answer the original user query. Use the newly retrieved chunks to improve the answer. Follow these steps:\n"
-            f"1. Synthesize a complete and updated answer to the user's original query using the chat history and the new `<retrieved_chunks>`.\n"
+            f"1. Synthesize a complete and updated answer to the user's original query using the chat history and the new `<retrieved_chunks>`. Chunks shown earlier are not repeated; their content is in your previous answers.\n"
             f"2. At the end of each sentence that uses information from a NEW chunk, you MUST cite it using its index, like this: `This is a new fact.`.\n"
-            f"3. After writing the new, complete answer, determine if any part of the query *still* remains unanswered. If another search could find more details, formulate a new, concise search query for the missing information in `any_more_info_needed`. If the answer is now complete, leave that field empty.\n\n"
-            f"---\n\n"
+            f"3. After writing the new, complete answer, determine if any part of the query *still* remains unanswered. If another search could find more details, formulate a new, concise search query for the missing information in `any_more_info_needed`. If the answer is now complete, leave that field empty.\n"
+            f"4. If several different things are still missing, also put up to {RESEARCH_FANOUT} short, independent search queries, one per missing part, in `search_queries`; they are searched in parallel.\n\n"
+        )
+        packed = await self.pack_context(f"research {iteration}", system=system_prompt, history=thread.history,
+                                         chunks=retrieved_chunks_data)
+        retrieved_chunks_data = packed.chunks
+        seen_ids.update(chunk["id"] for chunk in retrieved_chunks_data)
+        chunks_text = "\n".join(
+            [f"<chunk index=\"{index}\" name=\"{chunk['metadata']['name']}\">\n{chunk['text']}\n</chunk>" for index, chunk in enumerate(retrieved_chunks_data)] # type: ignore
+        )
+        context = (
             f"**Newly Retrieved Chunks:**\n"
             f"{chunks_text}\n\n"
         )
 
-        response = self.generator.generate_with_payload(
-            system_prompt=system_prompt,
-            language=self.language,
-            payload=self.history_to_payload(thread),
-            pydantic_model=ResponseWithRetrieval)
+        with span(f"research {iteration} answer"):
+            async for event in self.generator.astream_with_payload(
+                system_prompt=system_prompt,
+                language=self.language,
+                payload=self.history_to_payload(thread, packed.history),
+                context=context,
+                pydantic_model=ResponseWithRetrieval):
+                if isinstance(event, AgentDelta):
+                    yield event
+                else:
+                    response = event
         
         print(f"{INFO_COLOR}Iteration {iteration} {Colors.RESET} - Agent response: {response.answer}")
 
@@ -281,13 +495,17 @@ class Agent:
         agent_response = AgentResponse(answer=response.answer, retrieved_docs=retrieved_docs, follow_up=True)
         yield agent_response.model_dump_json()
         
-        if response.any_more_info_needed:
-            yield AgentResponse(answer="<internal>" + response.any_more_info_needed).model_dump_json()
+        queries = research_queries(response)
+        if queries:
+            yield AgentResponse(answer="<internal>" + "; ".join(queries)).model_dump_json()
             # thread.history.append(AgentMessage(sender="agent", content=response.any_more_info_needed, retrieved_docs=retrieved_docs, follow_up=True))
-            yield from self.agent_query(iteration + 1, thread, response.any_more_info_needed)
+            async for event in self.agent_query(iteration + 1, thread, queries, seen_ids):
+                yield event
 
-    def simple_query(self, user_input: str, thread_id: str):
-        thread = self.thread_store.get_thread(thread_id)
+    async def simple_query(self, user_input: str, thread_id: str):
+        turn_usage = begin_turn(thread_id)
+        with span("load thread"):
+            thread = await asyncio.to_thread(self.thread_store.get_thread, thread_id)
         if not thread:
             raise ValueError("Thread not found")
 
@@ -295,66 +513,90 @@ class Agent:
 
         context_for_prompt = ""
         retrieved_docs = []
+        retrieved_chunks_data = []
         
         if thread.document_ids:
             print(f"{INFO_COLOR} RAG USED (Simple Query) {Colors.RESET}")
-            retrieved_chunks_data = self.chroma_client.search_chunks(
-                query_text=user_input,
-                top_k=3,
-                doc_ids=thread.document_ids
+            set_step("retrieval")
+            with span("retrieval"):
+                retrieved_chunks_data = await asyncio.to_thread(
+                    self.chroma_client.search_chunks,
+                    query_text=user_input,
+                    top_k=3,
+                    doc_ids=thread.document_ids
+                )
+
+        # Static instructions go to the system prompt; the retrieved context is prepended to the
+        # latest user message, so the system prompt and earlier history stay a reusable KV-cache prefix
+        system_prompt_parts = ["You are a helpful assistant. Answer the user's question based on the conversation history."]
+        if retrieved_chunks_data:
+            system_prompt_parts.append(
+                "You have been provided with context from relevant documents before the user's latest message. "
+                "When you use information from this context, you MUST cite the source document's name, for example: [Source: document_name.pdf]."
             )
+        packed = await self.pack_context("simple", system="\n".join(system_prompt_parts), history=thread.history,
+                                         chunks=retrieved_chunks_data)
+        if packed.chunks:
             # Format context for the model and collect document metadata
             context_for_prompt = "\n\n".join(
-                [f"Source Document: {chunk['metadata']['name']}\nContent:\n{chunk['text']}" for chunk in retrieved_chunks_data]
+                [f"Source Document: {chunk['metadata']['name']}\nContent:\n{chunk['text']}" for chunk in packed.chunks]
             )
             
             # Create a unique list of retrieved documents for the response
-            retrieved_docs_map = {chunk['metadata']['doc_id']: chunk['metadata']['name'] for chunk in retrieved_chunks_data}
+            retrieved_docs_map = {chunk['metadata']['doc_id']: chunk['metadata']['name'] for chunk in packed.chunks}
             retrieved_docs = [RetrievedDocument(id=doc_id, name=name) for doc_id, name in retrieved_docs_map.items()]
 
         # Create a simple message history for the prompt
-        messages_for_prompt = self.history_to_payload(thread)
+        messages_for_prompt = self.history_to_payload(thread, packed.history)
 
-        # Add the retrieved context and instructions to the system prompt
-        system_prompt_parts = ["You are a helpful assistant. Answer the user's question based on the conversation history."]
         if context_for_prompt:
-            system_prompt_parts.append(
-                "You have been provided with the following context from relevant documents. "
-                "When you use information from this context, you MUST cite the source document's name, for example: [Source: document_name.pdf]."
-            )
-            messages_for_prompt.messages.insert(0, SystemLamaMessage(role="system", content=f"--- CONTEXT ---\n{context_for_prompt}\n--- END CONTEXT ---"))
+            messages_for_prompt.messages[-1].content = f"--- CONTEXT ---\n{context_for_prompt}\n--- END CONTEXT ---\n\n{user_input}"
 
         messages_for_prompt.messages.insert(0, SystemLamaMessage(role="system", content="\n".join(system_prompt_parts)))
 
-        # Use the simpler `complete` method for direct text generation
-        response_text = self.generator.complete_funtion(
-            payload=messages_for_prompt,
-            temperature=0.7
-        )
+        # Direct text generation, streamed to the client as it is produced
+        set_step("answer")
+        parts = []
+        with span("answer"):
+            async for delta in self.generator.astream_function(payload=messages_for_prompt, temperature=0.7):
+                parts.append(delta)
+                yield AgentDelta(delta=delta)
+        response_text = "".join(parts)
 
         # Save the full agent message with retrieved docs to history
         thread.history.append(AgentMessage(sender="agent", content=response_text, retrieved_docs=retrieved_docs))
-        self.thread_store.save_thread(thread)
+        usage_event = self.finish_turn(thread, turn_usage)
+        with span("save thread"):
+            await asyncio.to_thread(self.thread_store.save_thread, thread)
 
         # Yield the structured response
         agent_response = AgentResponse(answer=response_text, retrieved_docs=retrieved_docs)
         yield agent_response.model_dump_json()
+        yield usage_event
         
         
-    def query_with_db_explorer(self, user_input: str, thread_id: Optional[str] = None, iterate: bool = True, iteration: int = 0, thread: Optional[Thread] = None):
+    async def query_with_db_explorer(self, user_input: str, thread_id: Optional[str] = None, iterate: bool = True, iteration: int = 0, thread: Optional[Thread] = None):
         if iteration >= MAX_ITERATIONS:
             yield AgentResponse(answer="Maximum iterations reached.").model_dump_json()
             return
+        if iteration == 0:
+            turn_usage = begin_turn(thread_id or (thread.id if thread else None))
         if not thread:
             if thread_id:
-                thread = self.thread_store.get_thread(thread_id)
+                with span("load thread"):
+                    thread = await asyncio.to_thread(self.thread_store.get_thread, thread_id)
         if not thread:
             raise ValueError("Thread not found")
         
+        stage = "" if iteration == 0 else f"research {iteration} "
         if iteration == 0:
             thread.history.append(UserMessage(sender="user", content=user_input))    
-            intent = self.user_intent_db_explorer(thread)
+            set_step("intent")
+            with span("intent"):
+                intent = await self.user_intent_db_explorer(thread)
         else:
+            set_priority(FOLLOW_UP)
+            set_step(f"research {iteration}")
             print(f"{INFO_COLOR} Iteration {iteration} {Colors.RESET}")
             intent = DataBaseIntentAnalysis(
                 enhanced_query=user_input,
@@ -369,56 +611,62 @@ class Agent:
                 3. Provide the SQL query in the `sql_query` field of your response. Try to keep a qury simple and avoid using exact match filters if possible. Avoid using `UNION` in sql queries.
                 """
             )
+        with span(stage + "db schema"):
+            db_schema = (await get_async_client("mcp").get(f"http://127.0.0.1:{int(os.getenv('MCP_PORT', 1234))}/api/database/tables")).text
         prompt = f"""
         Here is the user query that you should fulfill using the database.
         <user_query>
         {intent.enhanced_query}
         </user_query>
         <db_schema>
-        {httpx.get(f"http://127.0.0.1:{int(os.getenv("MCP_PORT", 1234))}/api/database/tables").text}
+        {db_schema}
         </db_schema>
         """ 
         
         if intent.need_for_sql:
             print(f"{INFO_COLOR} YES SQL {Colors.RESET}")
-            query_list = self.generator.generate_one_shot(
-                system_prompt=system_prompt,
-                prompt=prompt,
-                language=self.language,
-                pydantic_model=DataBaseQueryList,
-                temperature=0.5
-            )
+            if iteration == 0:
+                set_step("sql")
+            with span(stage + "sql generation"):
+                query_list = await self.generator.agenerate_one_shot(
+                    system_prompt=system_prompt,
+                    prompt=prompt,
+                    language=self.language,
+                    pydantic_model=DataBaseQueryList,
+                    temperature=0.5
+                )
             
             
             results = []
             
-            for query in query_list.sql_queries:
-                print(f"{INFO_COLOR}Generated SQL query: {query} {Colors.RESET}")
-                try:
-                    if 'UNION' in query:
-                        for clean_query in self.split_union_query(query):
-                            query_results = httpx.get(f"http://127.0.0.1:{int(os.getenv('MCP_PORT', 1234))}/api/database/query", params={"query": clean_query})
+            with span(stage + "sql execution", queries=len(query_list.sql_queries)):
+                for query in query_list.sql_queries:
+                    print(f"{INFO_COLOR}Generated SQL query: {query} {Colors.RESET}")
+                    try:
+                        if 'UNION' in query:
+                            for clean_query in self.split_union_query(query):
+                                query_results = await get_async_client("mcp").get(f"http://127.0.0.1:{int(os.getenv('MCP_PORT', 1234))}/api/database/query", params={"query": clean_query})
+                                results.append(
+                                    {
+                                        "query": clean_query,
+                                        "results": query_results.json().get("results", []),
+                                    }
+                                )    
+                        else:
+                            query_results = await get_async_client("mcp").get(f"http://127.0.0.1:{int(os.getenv('MCP_PORT', 1234))}/api/database/query", params={"query": query})
                             results.append(
                                 {
-                                    "query": clean_query,
+                                    "query": query,
                                     "results": query_results.json().get("results", []),
                                 }
-                            )    
-                    else:
-                        query_results = httpx.get(f"http://127.0.0.1:{int(os.getenv('MCP_PORT', 1234))}/api/database/query", params={"query": query})
+                            )
+                    except Exception as e:
                         results.append(
                             {
                                 "query": query,
-                                "results": query_results.json().get("results", []),
+                                "results": f"Error executing query: {e}",
                             }
                         )
-                except Exception as e:
-                    results.append(
-                        {
-                            "query": query,
-                            "results": f"Error executing query: {e}",
-                        }
-                    )  
                     
             prompt = f"""
             You need to answer the user's original query based on the results of the executed SQL queries. If an error happened during query execution, include that information in `any_more_info_needed` field to request different query in the next iteration (include your original query, mark the error and how it should be properly requested).
@@ -429,12 +677,19 @@ class Agent:
             </sql_results>
             """        
             
-            response = self.generator.generate_one_shot(
-                system_prompt=system_prompt,
-                prompt=prompt,
-                language=self.language,
-                pydantic_model=ResponseWithRetrieval,
-                temperature=0.7)
+            if iteration == 0:
+                set_step("answer")
+            with span(stage + "answer"):
+                async for event in self.generator.astream_one_shot(
+                    system_prompt=system_prompt,
+                    prompt=prompt,
+                    language=self.language,
+                    pydantic_model=ResponseWithRetrieval,
+                    temperature=0.7):
+                    if isinstance(event, AgentDelta):
+                        yield event
+                    else:
+                        response = event
             
             
             queries_used = [RetrievedDocument(id="SQL", name=f"{query}")  for query in query_list.sql_queries]
@@ -446,28 +701,36 @@ class Agent:
             if response.any_more_info_needed and iterate:
                 yield AgentResponse(answer="<internal>" + response.any_more_info_needed).model_dump_json()
                 # thread.history.append(AgentMessage(sender="agent", content=response.any_more_info_needed))
-                yield from self.query_with_db_explorer(
+                async for event in self.query_with_db_explorer(
                     thread=thread, 
                     user_input=response.any_more_info_needed,
-                    iteration=iteration + 1)
+                    iteration=iteration + 1):
+                    yield event
                     
         else:
             
             print(f"{INFO_COLOR} NO SQL {Colors.RESET}")
             system_prompt = (
                 f"You are a helpful assistant. Your task is to directly answer the user's question based on the provided chat history. "
-                f"Do not explain your reasoning process. Provide a direct answer in the `answer` field.\n\n"
+                f"Do not explain your reasoning process. Reply with the answer text only.\n\n"
                 f"Based on the user query, provide a comprehensive answer."
             )
-            response = self.generator.generate_with_payload(
-                system_prompt=system_prompt,
-                language=self.language,
-                pydantic_model=ResponseWithoutRetrieval,
-                payload=self.history_to_payload(thread))
+            packed = await self.pack_context("answer", system=system_prompt, history=thread.history)
+            set_step("answer")
+            async for event in self.stream_answer(self.history_to_payload(thread, packed.history), system_prompt):
+                if isinstance(event, AgentDelta):
+                    yield event
+                else:
+                    answer = event
             
-            thread.history.append(AgentMessage(sender="agent", content=response.answer))
-            yield AgentResponse(answer=response.answer).model_dump_json()
-        self.thread_store.save_thread(thread)
+            thread.history.append(AgentMessage(sender="agent", content=answer))
+            yield AgentResponse(answer=answer).model_dump_json()
+        if iteration == 0:
+            usage_event = self.finish_turn(thread, turn_usage)
+        with span("save thread"):
+            await asyncio.to_thread(self.thread_store.save_thread, thread)
+        if iteration == 0:
+            yield usage_event
         
     def split_union_query(self, sql_query: str) -> List[str]:
         """
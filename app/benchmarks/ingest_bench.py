@@ -0,0 +1,274 @@
+# app/benchmarks/ingest_bench.py
+"""
+Micro-benchmarks for the ingestion pipeline.
+
+    python -m app.benchmarks.ingest_bench chunking [files...] [--size-mb 4] [--repeat 3]
+    python -m app.benchmarks.ingest_bench extractors [files...] [--size-mb 4] [--repeat 3]
+
+`chunking` measures sentence splitting and chunking throughput (chars/sec) on
+synthetic Russian/English text and on any real corpora passed as files, and
+checks that the output is identical to the reference (previous) implementation.
+
+`extractors` times every registered extractor engine per format (synthetic
+HTML/DOCX plus any .html/.docx files passed) and checks that each engine's
+output is identical to the DOM-based "dom" engine.
+
+Exits with code 1 on any parity mismatch, so it doubles as a golden-output check.
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Callable, Dict, List, Tuple
+
+from app.colors import ERROR_COLOR, HEADER_COLOR, INFO_COLOR, SUCCESS_COLOR, Colors
+from app.ingest import EXTRACTORS, _read_text_best_effort, _split_sentences, chunk_text, detect_format, normalize_text
+
+# --------- reference implementation (before the single-pass chunker) ---------
+
+_REF_SENT_SPLIT = re.compile(
+    r"""
+        (?:
+            (?<!\b[А-ЯA-Z]\.)
+            (?<!\b[А-ЯA-Z]\.[А-ЯA-Z]\.)
+            (?<!\bт\.д) (?<!\bт\.п) (?<!\bи\.т\.д) (?<!\bи\.т\.п)
+            (?<=[\.\!\?])
+            | (?<=…)
+            | (?<=\.\.\.)
+        )
+        [\"»”)\]]*
+        \s+
+        (?=[^\s])
+    """,
+    flags=re.U | re.X
+)
+
+
+def reference_split_sentences(text: str) -> List[str]:
+    if "\n" in text and len(text) < 2000:
+        parts = [p.strip() for p in text.splitlines() if p.strip()]
+        return parts if len(parts) > 1 else [text.strip()]
+    parts = _REF_SENT_SPLIT.split(text)
+    parts = [p.strip() for p in parts if p and p.strip()]
+    return parts if parts else [text.strip()]
+
+
+def reference_chunk_text(text: str, chunk_size: int = 800, overlap: int = 120) -> List[str]:
+    sents = reference_split_sentences(text)
+    chunks, cur, cur_len = [], [], 0
+    for s in sents:
+        slen = len(s.split())
+        if cur and cur_len + slen > chunk_size:
+            joined = " ".join(cur).strip()
+            if joined:
+                chunks.append(joined)
+            if overlap > 0:
+                tail_sents = reference_split_sentences(joined)
+                tail = " ".join(tail_sents[-2:]) if len(tail_sents) >= 2 else (tail_sents[-1] if tail_sents else "")
+                cur, cur_len = ([tail] if tail else []), len(tail.split()) if tail else 0
+            else:
+                cur, cur_len = [], 0
+        cur.append(s); cur_len += slen
+    if cur:
+        joined = " ".join(cur).strip()
+        if joined:
+            chunks.append(joined)
+    return [c for c in chunks if len(c.split()) >= 5]
+
+# --------- synthetic corpora ---------
+
+_RU_WORDS = ("система документ проект измерение расстояние устройство данные модель запрос ответ "
+             "пользователь поиск индекс таблица значение результат анализ метод точность сервер").split()
+_EN_WORDS = ("system document project measurement distance device data model query answer "
+             "user search index table value result analysis method accuracy server").split()
+_ENDINGS = [".", ".", ".", "!", "?", "...", "…", ".\"", ".»", ".)"]
+_SPECIAL = ["И. И. Иванов", "A. B. Smith", "т.д.", "и т.п.", "см. рис. 3", "v1.2.3", "e.g. this"]
+
+
+def synthetic_text(words: List[str], size_chars: int, seed: int = 0) -> str:
+    rnd = random.Random(seed)
+    out: List[str] = []
+    total = 0
+    while total < size_chars:
+        n = rnd.randint(3, 40)
+        sent = [rnd.choice(words) for _ in range(n)]
+        if rnd.random() < 0.1:
+            sent.insert(rnd.randint(0, n), rnd.choice(_SPECIAL))
+        s = " ".join(sent).capitalize() + rnd.choice(_ENDINGS)
+        s += "\n\n" if rnd.random() < 0.05 else ("\n" if rnd.random() < 0.1 else " ")
+        out.append(s)
+        total += len(s)
+    return normalize_text("".join(out))
+
+
+def _sentences(rnd: random.Random, n: int) -> str:
+    return " ".join(" ".join(rnd.choice(_RU_WORDS) for _ in range(rnd.randint(3, 20))).capitalize() + "."
+                    for _ in range(n))
+
+
+def synthetic_html(path: str, size_chars: int, seed: int = 0):
+    """
+    Exported-wiki-like page: headings, paragraphs with inline markup and entities,
+    lists, tables, scripts/styles and comments.
+    """
+    rnd = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("<!DOCTYPE html><html><head><title>Wiki</title><style>p { margin: 0 }</style></head><body>\n")
+        total = 0
+        while total < size_chars:
+            kind = rnd.random()
+            if kind < 0.5:
+                block = f"<p>{_sentences(rnd, 3)} <b>{rnd.choice(_RU_WORDS)}</b> &amp; &laquo;{rnd.choice(_RU_WORDS)}&raquo;<br>{_sentences(rnd, 1)}</p>\n"
+            elif kind < 0.65:
+                block = f"<h2 id=\"s{total}\">{_sentences(rnd, 1)}</h2>\n"
+            elif kind < 0.8:
+                block = "<ul>" + "".join(f"<li>{_sentences(rnd, 1)}</li>" for _ in range(rnd.randint(2, 6))) + "</ul>\n"
+            elif kind < 0.95:
+                rows = "".join("<tr>" + "".join(f"<td>{rnd.choice(_RU_WORDS)} {rnd.randint(1, 999)}</td>" for _ in range(4)) + "</tr>"
+                               for _ in range(rnd.randint(2, 8)))
+                block = f"<table>{rows}</table>\n"
+            else:
+                block = f"<script>var x = {rnd.randint(0, 99)}; if (x < 3) {{ run(); }}</script><!-- {rnd.choice(_RU_WORDS)} -->\n"
+            f.write(block)
+            total += len(block)
+        f.write("</body></html>\n")
+
+
+def synthetic_docx(path: str, size_chars: int, seed: int = 0):
+    """
+    Spec-like Word document: paragraphs with several runs, tabs and breaks, and
+    tables with horizontally and vertically merged cells.
+    """
+    from docx import Document
+
+    rnd = random.Random(seed)
+    w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+    def par(text: str) -> str:
+        runs = text.split(". ")
+        return "<w:p>" + "".join(f'<w:r><w:t xml:space="preserve">{r}. </w:t></w:r>' for r in runs) + "<w:r><w:tab/><w:br/></w:r></w:p>"
+
+    body: List[str] = []
+    total = 0
+    while total < size_chars:
+        if rnd.random() < 0.8:
+            text = _sentences(rnd, rnd.randint(1, 5))
+            body.append(par(text))
+        else:
+            rows = []
+            for r in range(rnd.randint(2, 10)):
+                merged = r > 0 and rnd.random() < 0.3
+                first = '<w:tc><w:tcPr><w:vMerge/></w:tcPr><w:p/></w:tc>' if merged else \
+                    f'<w:tc><w:tcPr><w:vMerge w:val="restart"/></w:tcPr>{par(_sentences(rnd, 1))}</w:tc>'
+                rows.append("<w:tr>" + first + f'<w:tc><w:tcPr><w:gridSpan w:val="2"/></w:tcPr>{par(_sentences(rnd, 2))}</w:tc>'
+                            + f"<w:tc>{par(str(rnd.randint(1, 999)))}</w:tc></w:tr>")
+            text = "".join(rows)
+            body.append("<w:tbl><w:tblGrid>" + "<w:gridCol/>" * 4 + "</w:tblGrid>" + text + "</w:tbl>")
+        total += len(text)
+    xml = f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:document {w}><w:body>{"".join(body)}<w:sectPr/></w:body></w:document>'
+
+    template = io.BytesIO()
+    Document().save(template)
+    with zipfile.ZipFile(template) as src, zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as dst:
+        for item in src.infolist():
+            dst.writestr(item, xml if item.filename == "word/document.xml" else src.read(item.filename))
+
+# --------- runner ---------
+
+
+def _time(fn: Callable[[], object], repeat: int) -> Tuple[float, object]:
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def bench_chunking(corpora: Dict[str, str], repeat: int, chunk_size: int, overlap: int) -> bool:
+    ok = True
+    print(f"{HEADER_COLOR}{'corpus':<24}{'chars':>12}{'split MB/s':>12}{'ref':>10}{'chunk MB/s':>12}{'ref':>10}  parity{Colors.RESET}")
+    for name, text in corpora.items():
+        mb = len(text) / 1e6
+        t_split, sents = _time(lambda: _split_sentences(text), repeat)
+        t_ref_split, ref_sents = _time(lambda: reference_split_sentences(text), repeat)
+        t_chunk, chunks = _time(lambda: chunk_text(text, chunk_size, overlap), repeat)
+        t_ref_chunk, ref_chunks = _time(lambda: reference_chunk_text(text, chunk_size, overlap), repeat)
+        same = sents == ref_sents and chunks == ref_chunks
+        ok &= same
+        parity = f"{SUCCESS_COLOR}ok{Colors.RESET}" if same else f"{ERROR_COLOR}MISMATCH{Colors.RESET}"
+        print(f"{name:<24}{len(text):>12}{mb / t_split:>12.2f}{mb / t_ref_split:>10.2f}"
+              f"{mb / t_chunk:>12.2f}{mb / t_ref_chunk:>10.2f}  {parity}")
+    return ok
+
+
+def bench_extractors(files: Dict[str, str], repeat: int) -> bool:
+    ok = True
+    print(f"{HEADER_COLOR}{'file':<28}{'engine':<10}{'MB':>8}{'sec':>10}{'MB/s':>10}  parity{Colors.RESET}")
+    for name, path in files.items():
+        engines = EXTRACTORS[detect_format(path)]
+        mb = os.path.getsize(path) / 1e6
+        baseline = None
+        for engine, extract in engines.items():
+            t, text = _time(lambda: extract(path), repeat)
+            if engine == "dom":
+                baseline, parity = text, "ref"
+            elif baseline is None:
+                parity = "-"
+            elif text == baseline:
+                parity = f"{SUCCESS_COLOR}ok{Colors.RESET}"
+            else:
+                ok, parity = False, f"{ERROR_COLOR}MISMATCH{Colors.RESET}"
+            print(f"{name:<28}{engine:<10}{mb:>8.2f}{t:>10.3f}{mb / t:>10.2f}  {parity}")
+    return ok
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Ingestion micro-benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_chunk = sub.add_parser("chunking", help="sentence splitting and chunking throughput + parity")
+    p_chunk.add_argument("files", nargs="*", help="real corpora (plain text files)")
+    p_chunk.add_argument("--size-mb", type=float, default=2.0, help="size of each synthetic corpus")
+    p_chunk.add_argument("--repeat", type=int, default=3)
+    p_chunk.add_argument("--chunk-size", type=int, default=800)
+    p_chunk.add_argument("--overlap", type=int, default=120)
+    p_extract = sub.add_parser("extractors", help="HTML/DOCX extractor engines throughput + parity")
+    p_extract.add_argument("files", nargs="*", help="real .html/.docx files")
+    p_extract.add_argument("--size-mb", type=float, default=2.0, help="text size of each synthetic document")
+    p_extract.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.command == "chunking":
+        size = int(args.size_mb * 1e6)
+        corpora = {
+            "synthetic-ru": synthetic_text(_RU_WORDS, size, seed=1),
+            "synthetic-en": synthetic_text(_EN_WORDS, size, seed=2),
+            "synthetic-ru-small": synthetic_text(_RU_WORDS, 1500, seed=3),
+        }
+        for path in args.files:
+            corpora[path[-24:]] = normalize_text(_read_text_best_effort(path))
+        print(f"{INFO_COLOR}chunk_size={args.chunk_size} overlap={args.overlap} repeat={args.repeat}{Colors.RESET}")
+        return 0 if bench_chunking(corpora, args.repeat, args.chunk_size, args.overlap) else 1
+    if args.command == "extractors":
+        size = int(args.size_mb * 1e6)
+        with tempfile.TemporaryDirectory() as tmp:
+            files = {"synthetic.html": os.path.join(tmp, "synthetic.html"),
+                     "synthetic.docx": os.path.join(tmp, "synthetic.docx")}
+            synthetic_html(files["synthetic.html"], size, seed=1)
+            synthetic_docx(files["synthetic.docx"], size, seed=2)
+            for path in args.files:
+                files[path[-28:]] = path
+            print(f"{INFO_COLOR}repeat={args.repeat}{Colors.RESET}")
+            return 0 if bench_extractors(files, args.repeat) else 1
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+# app/bulk_import.py
+"""
+Bulk corpus importer.
+
+    python -m app.bulk_import <directory | archive.zip> [--workers 8] [--manifest storage/import_manifest.jsonl]
+
+Text extraction and chunking run in a process pool; the main process embeds
+chunks in batches and stores them. Every file's outcome is appended to a JSONL
+manifest, so re-running the same command after an interruption resumes where
+it stopped. Files whose content hash is already indexed are skipped.
+"""
+import argparse
+import json
+import mimetypes
+import os
+import shutil
+import sys
+import time
+import uuid
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+from app.chroma_client import ChromaClient, chunk_document, chunking_params
+from app.colors import ERROR_COLOR, INFO_COLOR, SUCCESS_COLOR, WARNING_COLOR, Colors
+from app.embedding_client import EmbeddingClient
+from app.ingest import extract_text_from_file
+from app.text_cache import TextCache, file_sha256
+from app.token_counter import TokenCounter
+
+STORAGE_RAW_DIR = os.getenv("STORAGE_RAW_DIR", "./storage/raw")
+CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "./storage/chroma")
+LLAMACPP_EMBED_BASE = os.getenv("LLAMACPP_EMBED_BASE", "http://127.0.0.1:11435").replace("localhost", "127.0.0.1")
+
+# --------- worker side (runs in the process pool) ---------
+
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(indexed_hashes: Set[str], chunk_size: int, chunk_overlap: int, chunk_unit: str):
+    _worker["indexed"] = indexed_hashes
+    _worker["chunking"] = (chunk_size, chunk_overlap, chunk_unit)
+    _worker["text_cache"] = TextCache(STORAGE_RAW_DIR)
+    _worker["token_counter"] = TokenCounter(base=LLAMACPP_EMBED_BASE)
+
+
+def _process_file(source: str, key: str) -> Dict[str, Any]:
+    """
+    Copies one file into STORAGE_RAW_DIR, extracts and chunks it.
+    `key` is a path for directory sources and a member name for zip archives.
+    """
+    name = os.path.basename(key)
+    ext = os.path.splitext(name)[1].lower().lstrip(".")
+    doc_id = str(uuid.uuid4())
+    raw_path = os.path.join(STORAGE_RAW_DIR, f"{doc_id}.{ext}")
+    result: Dict[str, Any] = {"key": key, "name": name, "doc_id": doc_id, "raw_path": raw_path}
+    try:
+        if os.path.isdir(source):
+            shutil.copyfile(key, raw_path)
+        else:
+            # one open archive per worker: re-reading the central directory per member is O(n^2)
+            if "zip" not in _worker:
+                _worker["zip"] = zipfile.ZipFile(source)
+            with _worker["zip"].open(key) as src, open(raw_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+
+        sha256 = file_sha256(raw_path)
+        size = os.path.getsize(raw_path)
+        result.update(sha256=sha256, size=size)
+        if sha256 in _worker["indexed"]:
+            os.remove(raw_path)
+            result["status"] = "skipped"
+            return result
+
+        file_type = mimetypes.guess_type(name)[0] or f"application/{ext}"
+        text = _worker["text_cache"].get(sha256)
+        if text is None:
+            text = extract_text_from_file(raw_path, file_type)
+            _worker["text_cache"].put(sha256, text)
+
+        chunk_size, chunk_overlap, chunk_unit = _worker["chunking"]
+        chunks, stats = chunk_document(text, name, chunk_size, chunk_overlap, chunk_unit, _worker["token_counter"].count)
+        result.update(status="extracted", type=file_type, chunks=chunks, stats=stats)
+    except Exception as e:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+        result.update(status="error", error=f"{type(e).__name__}: {e}")
+    return result
+
+# --------- main process ---------
+
+
+def iter_source(source: str) -> Iterator[str]:
+    """
+    Yields file keys of a directory (recursively, sorted) or of a zip archive.
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for f in sorted(files):
+                yield os.path.join(root, f)
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield info.filename
+    else:
+        raise ValueError(f"{source} is neither a directory nor a zip archive.")
+
+
+class Manifest:
+    """
+    Append-only JSONL record of per-file import state; the last record for a key wins.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line after a crash
+                    self.state[record["key"]] = record
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._f = open(path, "a", encoding="utf-8")
+
+    def is_finished(self, key: str, retry_errors: bool) -> bool:
+        status = self.state.get(key, {}).get("status")
+        return status in ("done", "skipped") or (status == "error" and not retry_errors)
+
+    def record(self, key: str, **fields):
+        record = {"key": key, "at": datetime.utcnow().isoformat(), **fields}
+        self.state[key] = record
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class Throughput:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.files = self.chunks = self.bytes = self.skipped = self.errors = 0
+
+    def line(self) -> str:
+        dt = max(time.perf_counter() - self.t0, 1e-9)
+        return (f"{self.files} files ({self.skipped} skipped, {self.errors} errors), {self.chunks} chunks in {dt:.1f}s: "
+                f"{self.files / dt:.2f} files/s, {self.chunks / dt:.1f} chunks/s, {self.bytes / dt / 1e6:.2f} MB/s")
+
+
+def manifest_key(source: str, key: str) -> str:
+    """
+    Manifest key of a file: its path, or "<archive>!<member>" for zip members.
+    """
+    return key if os.path.isdir(source) else f"{source}!{key}"
+
+
+class BulkImporter:
+    def __init__(self, chroma_client: ChromaClient, manifest: Manifest, source: str, embed_batch: int = 64):
+        """
+        :param source: The imported directory or zip archive.
+        :param embed_batch: How many chunks (possibly from several files) to embed at once.
+        """
+        self.chroma_client = chroma_client
+        self.source = source
+        self.manifest = manifest
+        self.embed_batch = embed_batch
+        self.pending: List[Dict[str, Any]] = []
+        self.pending_chunks = 0
+        self.seen_hashes: Set[str] = set()
+        self.stats = Throughput()
+
+    def handle(self, result: Dict[str, Any]):
+        self.stats.files += 1
+        self.stats.bytes += result.get("size", 0)
+        if result["status"] == "error":
+            self.stats.errors += 1
+            self.manifest.record(manifest_key(self.source, result["key"]), status="error", error=result["error"])
+            print(f"{ERROR_COLOR}{result['key']}: {result['error']}{Colors.RESET}")
+            return
+        if result["status"] == "skipped" or result["sha256"] in self.seen_hashes:
+            # duplicates inside this import are only detectable here, after extraction
+            if os.path.exists(result["raw_path"]):
+                os.remove(result["raw_path"])
+            self.stats.skipped += 1
+            self.manifest.record(manifest_key(self.source, result["key"]), status="skipped", sha256=result["sha256"])
+            return
+        self.seen_hashes.add(result["sha256"])
+        self.pending.append(result)
+        self.pending_chunks += len(result["chunks"])
+        if self.pending_chunks >= self.embed_batch:
+            self.flush()
+
+    def flush(self):
+        """
+        Embeds the buffered files' chunks together and stores each file.
+        """
+        if not self.pending:
+            return
+        texts = [c for r in self.pending for c in r["chunks"]]
+        embeddings = self.chroma_client.embedding_client.embed_texts(texts)
+        offset = 0
+        for r in self.pending:
+            n = len(r["chunks"])
+            doc_embeddings, offset = embeddings[offset:offset + n], offset + n
+            try:
+                if len(doc_embeddings) != n or not all(doc_embeddings):
+                    raise ValueError("embedding server returned no embedding for some chunks")
+                metadoc = {
+                    "doc_id": r["doc_id"],
+                    "name": r["name"],
+                    "type": r["type"],
+                    "size": r["size"],
+                    "uploadedAt": datetime.utcnow().isoformat(),
+                    "sha256": r["sha256"],
+                }
+                self.chroma_client.store_document(r["doc_id"], r["chunks"], doc_embeddings, metadoc, r["stats"])
+                self.stats.chunks += n
+                self.manifest.record(manifest_key(self.source, r["key"]), status="done", doc_id=r["doc_id"], sha256=r["sha256"], chunks=n)
+            except Exception as e:
+                self.stats.errors += 1
+                self.seen_hashes.discard(r["sha256"])
+                if os.path.exists(r["raw_path"]):
+                    os.remove(r["raw_path"])
+                self.manifest.record(manifest_key(self.source, r["key"]), status="error", error=f"{type(e).__name__}: {e}")
+                print(f"{ERROR_COLOR}{r['key']}: {e}{Colors.RESET}")
+        self.pending, self.pending_chunks = [], 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk import a directory or zip archive into the RAG index")
+    parser.add_argument("source", help="directory or .zip archive")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="extraction processes")
+    parser.add_argument("--manifest", default="./storage/import_manifest.jsonl")
+    parser.add_argument("--retry-errors", action="store_true", help="retry files that failed in a previous run")
+    parser.add_argument("--embed-batch", type=int, default=64, help="chunks per embedding round")
+    parser.add_argument("--chunk-unit", choices=["words", "tokens"], default=None)
+    parser.add_argument("--progress-every", type=int, default=100, help="print throughput every N files")
+    args = parser.parse_args(argv)
+
+    source = os.path.abspath(args.source)
+    os.makedirs(STORAGE_RAW_DIR, exist_ok=True)
+    chunk_size, chunk_overlap, chunk_unit = chunking_params(args.chunk_unit)
+
+    chroma_client = ChromaClient(EmbeddingClient(LLAMACPP_EMBED_BASE), CHROMA_PERSIST_DIR, raw_dir=STORAGE_RAW_DIR)
+    manifest = Manifest(args.manifest)
+    importer = BulkImporter(chroma_client, manifest, source, args.embed_batch)
+    indexed = chroma_client.get_indexed_hashes()
+    importer.seen_hashes |= indexed
+
+    keys = (k for k in iter_source(source) if not manifest.is_finished(manifest_key(source, k), args.retry_errors))
+    max_in_flight = args.workers * 4  # bounded, so 50k files never sit in memory at once
+    print(f"{INFO_COLOR}Importing {source} with {args.workers} workers ({len(indexed)} documents already indexed).{Colors.RESET}")
+
+    try:
+        with ProcessPoolExecutor(args.workers, initializer=_init_worker, initargs=(indexed, chunk_size, chunk_overlap, chunk_unit)) as pool:
+            in_flight: Set[Future] = set()
+            exhausted = False
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    key = next(keys, None)
+                    if key is None:
+                        exhausted = True
+                    else:
+                        in_flight.add(pool.submit(_process_file, source, key))
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    importer.handle(future.result())
+                    if importer.stats.files % args.progress_every == 0:
+                        print(f"{INFO_COLOR}{importer.stats.line()}{Colors.RESET}")
+            importer.flush()
+    except KeyboardInterrupt:
+        importer.flush()  # store what is already extracted, so it isn't redone on resume
+        print(f"{WARNING_COLOR}Interrupted; re-run the same command to resume.{Colors.RESET}")
+        print(f"{INFO_COLOR}{importer.stats.line()}{Colors.RESET}")
+        return 130
+    finally:
+        manifest.close()
+
+    print(f"{SUCCESS_COLOR}{importer.stats.line()}{Colors.RESET}")
+    return 1 if importer.stats.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
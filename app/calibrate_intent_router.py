@@ -0,0 +1,64 @@
+# app/calibrate_intent_router.py
+"""
+Calibrates the embedding intent router from stored threads and saves its prototypes.
+
+    python -m app.calibrate_intent_router
+    python -m app.calibrate_intent_router --target-precision 0.98 --dry-run
+
+Turns are labelled by what the agent did (answer with or without retrieved documents);
+the threshold is the lowest one whose routed decisions reach the target precision.
+"""
+import argparse
+import json
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+from app.chroma_client import ChromaClient
+from app.colors import ERROR_COLOR, INFO_COLOR, SUCCESS_COLOR, Colors
+from app.embedding_client import EmbeddingClient
+from app.intent_router import INTENT_ROUTER_MAX_PROTOTYPES, INTENT_ROUTER_PATH, IntentRouter
+from app.thread_store import ThreadStore
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Calibrate the intent router from stored threads")
+    parser.add_argument("--threads", default="storage/threads", help="thread storage directory")
+    parser.add_argument("--out", default=INTENT_ROUTER_PATH, help="where to save prototypes and threshold")
+    parser.add_argument("--target-precision", type=float, default=0.95)
+    parser.add_argument("--max-prototypes", type=int, default=INTENT_ROUTER_MAX_PROTOTYPES)
+    parser.add_argument("--dry-run", action="store_true", help="report metrics without saving")
+    args = parser.parse_args(argv)
+
+    embed_client = EmbeddingClient(os.getenv("LLAMACPP_EMBED_BASE", "http://127.0.0.1:11435").replace("localhost", "127.0.0.1"))
+    chroma_client = ChromaClient(
+        embed_client,
+        os.getenv("CHROMA_PERSIST_DIR", "./storage/chroma"),
+        raw_dir=os.getenv("STORAGE_RAW_DIR", "./storage/raw"),
+    )
+    document_names = {doc["id"]: doc.get("name") or "" for doc in chroma_client.get_all_documents()}
+    thread_store = ThreadStore(args.threads)
+    threads = [thread_store.get_thread(t["id"]) for t in thread_store.get_all_threads()]
+
+    # start from the seeds, not from a previous calibration
+    router = IntentRouter(embed_client, path=None)
+    try:
+        metrics = router.calibrate([t for t in threads if t], document_names,
+                                   target_precision=args.target_precision, max_prototypes=args.max_prototypes)
+    except RuntimeError as e:
+        print(f"{ERROR_COLOR}{e}{Colors.RESET}")
+        return 1
+    print(f"{INFO_COLOR}Calibration:{Colors.RESET} {json.dumps(metrics, ensure_ascii=False, indent=2)}")
+    if metrics["precision"] is None:
+        print(f"{ERROR_COLOR}No threshold reaches precision {args.target_precision}: every turn will go to the LLM.{Colors.RESET}")
+    if not args.dry_run:
+        router.save(args.out)
+        print(f"{SUCCESS_COLOR}Saved to {args.out}; restart the server to use it.{Colors.RESET}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
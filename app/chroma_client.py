@@ -2,26 +2,90 @@ import os
 import uuid
 import chromadb
 from chromadb.api.types import QueryResult
-from typing import List, Dict, Any, Optional, Sequence
+from typing import Callable, List, Dict, Any, Optional, Sequence, Set, Tuple
 
+from app.colors import INFO_COLOR, WARNING_COLOR, Colors
 from app.embedding_client import EmbeddingClient
-from app.ingest import extract_text_from_file, normalize_text, chunk_text
+from app.ingest import extract_text_from_file, chunk_text, chunk_text_by_tokens, count_overflowing
+from app.text_cache import TextCache, file_sha256
+from app.token_counter import TokenCounter
+from app.tracing import set_attributes, traced
+
+# Сколько токенов реально влезает в один вход сервера эмбеддингов: min(-c, -ub) из его конфига
+EMBED_CTX_TOKENS = int(os.getenv("EMBED_CTX_TOKENS", "1024"))
+# Параметры «словесного» чанкинга — с ними сравниваем при подсчёте переполнений
+WORD_CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "800"))
+WORD_CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "120"))
+
+
+def chunking_params(chunk_unit: Optional[str] = None) -> Tuple[int, int, str]:
+    """
+    Returns the configured (chunk_size, chunk_overlap, chunk_unit) for the given
+    or configured (CHUNK_UNIT) unit.
+    """
+    chunk_unit = chunk_unit or os.getenv("CHUNK_UNIT", "words")
+    if chunk_unit == "tokens":
+        return int(os.getenv("CHUNK_SIZE_TOKENS", "512")), int(os.getenv("CHUNK_OVERLAP_TOKENS", "64")), chunk_unit
+    return int(os.getenv("CHUNK_SIZE", "800")), int(os.getenv("CHUNK_OVERLAP", "120")), "words"
+
+
+
+def chunk_document(text: str, file_name: str, chunk_size: int, chunk_overlap: int, chunk_unit: str, count_tokens: Callable[[str], int]) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    Chunks a document's text and collects chunking stats for its metadata.
+
+    :param chunk_unit: "words" (chunk_size/chunk_overlap in words) or "tokens"
+                       (in embedding model tokens, capped at EMBED_CTX_TOKENS).
+    :param count_tokens: Token counter of the embedding model; a TokenCounter with approximate
+                         counts gets its safety margin below the chunk size.
+    """
+    if chunk_unit == "tokens":
+        max_tokens = min(chunk_size, EMBED_CTX_TOKENS)
+        if isinstance(count_tokens, TokenCounter):
+            max_tokens = count_tokens.safe_limit(max_tokens)
+        chunks = chunk_text_by_tokens(text, max_tokens, chunk_overlap, count_tokens)
+        word_chunks = chunk_text(text, WORD_CHUNK_SIZE, WORD_CHUNK_OVERLAP)
+    else:
+        chunks = chunk_text(text, chunk_size, chunk_overlap)
+        word_chunks = chunks
+    if not chunks:
+        raise ValueError("No chunks were created from the document.")
+
+    overflow = count_overflowing(word_chunks, EMBED_CTX_TOKENS, count_tokens)
+    if overflow:
+        print(f"{WARNING_COLOR}{file_name}: {overflow}/{len(word_chunks)} word-based chunks exceed {EMBED_CTX_TOKENS} embedding tokens.{Colors.RESET}")
+    print(f"{INFO_COLOR}{file_name}: {len(chunks)} chunks ({chunk_unit}).{Colors.RESET}")
+
+    stats = {
+        "chunk_unit": chunk_unit,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "chunks": len(chunks),
+        "word_chunks": len(word_chunks),
+        "word_chunks_overflow": overflow,
+    }
+    return chunks, stats
 
 
 class ChromaClient:
-    def __init__(self, embedding_client: EmbeddingClient, path: str = os.getenv("CHROMA_PERSIST_DIR", "chroma_db"), collection_name: str = "rag_collection"):
+    def __init__(self, embedding_client: EmbeddingClient, path: str = os.getenv("CHROMA_PERSIST_DIR", "chroma_db"), collection_name: str = "rag_collection", token_counter: Optional[TokenCounter] = None, raw_dir: str = os.getenv("STORAGE_RAW_DIR", "./storage/raw")):
         """
         Initializes the ChromaClient for persistent storage.
 
         :param embedding_client: An instance of EmbeddingClient.
         :param path: The directory path for ChromaDB's persistent storage.
         :param collection_name: The name of the collection to use.
+        :param token_counter: Tokenizer used for token-aware chunking and overflow reports.
+        :param raw_dir: Directory with raw files; extracted text is cached there too.
         """
         self.embedding_client = embedding_client
+        self.token_counter = token_counter or TokenCounter(base=embedding_client.base)
+        self.text_cache = TextCache(raw_dir)
         self.client = chromadb.PersistentClient(path=path)
         self.collection = self.client.get_or_create_collection(name=collection_name)
         self.documents_collection = self.client.get_or_create_collection(name="documents_metadata")
 
+    @traced("chroma.store_chunks")
     def store_chunks(self, chunks: List[str], embeddings: Sequence[List[float]], metadatas: Sequence[Dict[str, Any]]) -> List[str]:
         """
         Stores chunked data, embeddings, and metadata in ChromaDB using unique IDs.
@@ -56,6 +120,7 @@ class ChromaClient:
         return self.collection.count()
 
 
+    @traced("chroma.delete_chunks")
     def delete_chunks(self, chunk_ids: List[str]):
         """
         Deletes chunks from the collection by their IDs.
@@ -72,20 +137,53 @@ class ChromaClient:
         """
         return [c.name for c in self.client.list_collections()]
 
-    def ingest_file(self, doc_id: str, raw_path: str, file_name: str, file_type: str, uploaded_at: str, chunk_size: int, chunk_overlap: int) -> int:
+    def _load_text(self, raw_path: str, file_type: Optional[str]) -> Tuple[str, str]:
         """
-        Handles the ingestion process for a single file.
+        Returns (sha256, normalized text) of a raw file, extracting it only on a cache miss.
         """
-        text = extract_text_from_file(raw_path, file_type)
-        text = normalize_text(text)
+        sha256 = file_sha256(raw_path)
+        text = self.text_cache.get(sha256)
+        if text is None:
+            text = extract_text_from_file(raw_path, file_type)
+            self.text_cache.put(sha256, text)
+        else:
+            print(f"{INFO_COLOR}Using cached extracted text for {os.path.basename(raw_path)}{Colors.RESET}")
+        return sha256, text
 
-        chunks = chunk_text(text, chunk_size, chunk_overlap)
-        if not chunks:
-            raise ValueError("No chunks were created from the document.")
+    def _chunk_and_embed(self, text: str, file_name: str, chunk_size: int, chunk_overlap: int, chunk_unit: str) -> Tuple[List[str], List[List[float]], Dict[str, Any]]:
+        """
+        Chunks and embeds a document's text.
 
+        :return: chunks, their embeddings and chunking stats for the document metadata.
+        """
+        chunks, stats = chunk_document(text, file_name, chunk_size, chunk_overlap, chunk_unit, self.token_counter.count)
         embeddings = self.embedding_client.embed_texts(chunks)
         if not embeddings or len(embeddings) != len(chunks):
             raise ValueError(f"Embeddings mismatch: chunks={len(chunks)} != embeddings={len(embeddings) if embeddings else 0}")
+        return chunks, embeddings, stats
+
+    def store_document(self, doc_id: str, chunks: List[str], embeddings: Sequence[List[float]], metadoc: Dict[str, Any], stats: Dict[str, Any]):
+        """
+        Stores already chunked and embedded document: its chunks and its metadata entry.
+        """
+        self.store_chunks(chunks, embeddings, [metadoc] * len(chunks))
+        self.add_document(doc_id, metadoc["name"], {**metadoc, **stats})
+
+    def get_indexed_hashes(self) -> Set[str]:
+        """
+        Returns content hashes (sha256) of all indexed documents.
+        """
+        documents = self.documents_collection.get(include=["metadatas"]) # type: ignore
+        return {m["sha256"] for m in documents['metadatas'] or [] if m.get("sha256")}
+
+    @traced("chroma.ingest_file")
+    def ingest_file(self, doc_id: str, raw_path: str, file_name: str, file_type: str, uploaded_at: str, chunk_size: int, chunk_overlap: int, chunk_unit: str = "words") -> int:
+        """
+        Handles the ingestion process for a single file.
+        The extracted text is cached next to the raw file for later re-chunking.
+        """
+        sha256, text = self._load_text(raw_path, file_type)
+        chunks, embeddings, stats = self._chunk_and_embed(text, file_name, chunk_size, chunk_overlap, chunk_unit)
 
         metadoc = {
             "doc_id": doc_id,
@@ -93,11 +191,74 @@ class ChromaClient:
             "type": file_type,
             "size": os.path.getsize(raw_path),
             "uploadedAt": uploaded_at,
+            "sha256": sha256,
         }
+        self.store_document(doc_id, chunks, embeddings, metadoc, stats)
+        return len(chunks)
+
+    @traced("chroma.reindex_document")
+    def reindex_document(self, doc_id: str, chunk_size: int, chunk_overlap: int, chunk_unit: str = "words") -> int:
+        """
+        Rebuilds a document's chunks and embeddings from its cached extracted text
+        (falls back to extracting the raw file if the text isn't cached yet).
+        Old chunks are replaced only after the new ones are embedded successfully.
+
+        :return: The new number of chunks.
+        """
+        document = self.documents_collection.get(ids=[doc_id])
+        if not document or not document['ids']:
+            raise ValueError(f"Document with id {doc_id} not found.")
+        metadata = dict(document['metadatas'][0]) # type: ignore
+        file_name = metadata.get("name") or doc_id
+
+        text = self.text_cache.get(metadata["sha256"]) if metadata.get("sha256") else None
+        if text is None:
+            ext = os.path.splitext(file_name)[1].lower().lstrip(".")
+            raw_path = os.path.join(self.text_cache.raw_dir, f"{doc_id}.{ext}")
+            if not os.path.exists(raw_path):
+                raise ValueError(f"Neither cached text nor raw file found for document {doc_id}.")
+            metadata["sha256"], text = self._load_text(raw_path, metadata.get("type"))
+
+        chunks, embeddings, stats = self._chunk_and_embed(text, file_name, chunk_size, chunk_overlap, chunk_unit)
+
+        metadoc = {k: metadata[k] for k in ("doc_id", "name", "type", "size", "uploadedAt", "sha256") if k in metadata}
+        old_chunks = self.collection.get(where={"doc_id": doc_id})
+        if old_chunks and old_chunks['ids']:
+            self.delete_chunks(old_chunks['ids'])
         self.store_chunks(chunks, embeddings, [metadoc] * len(chunks))
-        self.add_document(doc_id, file_name, metadoc)
+        self.documents_collection.update(ids=[doc_id], metadatas=[{**metadata, **stats}])
         return len(chunks)
 
+    def get_chunking_report(self) -> Dict[str, Any]:
+        """
+        Aggregates how many word-based chunks overflowed the embedding context across all documents.
+        """
+        documents = self.documents_collection.get()
+        per_document = []
+        total_chunks = total_overflow = 0
+        for metadata in documents['metadatas'] or []:
+            if "word_chunks" not in metadata:
+                continue  # ingested before overflow accounting existed
+            word_chunks = int(metadata.get("word_chunks") or 0)
+            overflow = int(metadata.get("word_chunks_overflow") or 0)
+            total_chunks += word_chunks
+            total_overflow += overflow
+            per_document.append({
+                "id": metadata.get("doc_id"),
+                "name": metadata.get("name"),
+                "chunk_unit": metadata.get("chunk_unit"),
+                "word_chunks": word_chunks,
+                "word_chunks_overflow": overflow,
+            })
+        return {
+            "embed_ctx_tokens": EMBED_CTX_TOKENS,
+            "word_chunks": total_chunks,
+            "word_chunks_overflow": total_overflow,
+            "overflow_rate": (total_overflow / total_chunks) if total_chunks else 0.0,
+            "documents": per_document,
+        }
+
+    @traced("chroma.add_document")
     def add_document(self, doc_id: str, doc_name_for_embedding: str, metadata: Dict[str, Any]):
         """
         Adds a single document's metadata to the collection.
@@ -113,6 +274,7 @@ class ChromaClient:
             )
 
 
+    @traced("chroma.search_documents")
     def search_documents(self, query_text: str, top_k: int = 5, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """
         Searches for documents based on a query text.
@@ -144,13 +306,21 @@ class ChromaClient:
     def _get_collections(self):
         return [c.name for c in self.client.list_collections()]
 
+    @traced("chroma.delete_document")
     def delete_document(self, doc_id: str):
         """
         Deletes a document and all its associated chunks from the collections.
         """
+        document = self.documents_collection.get(ids=[doc_id])
+        sha256 = document['metadatas'][0].get("sha256") if document and document['metadatas'] else None # type: ignore
+
         # Delete the document metadata
         self.documents_collection.delete(ids=[doc_id])
 
+        # Drop the cached text unless another document has the same content
+        if sha256 and not self.documents_collection.get(where={"sha256": sha256})['ids']:
+            self.text_cache.delete(sha256)
+
         # Delete all chunks associated with the document
         chunk_ids_to_delete = []
         results = self.collection.get(where={"doc_id": doc_id})
@@ -160,6 +330,7 @@ class ChromaClient:
         if chunk_ids_to_delete:
             self.delete_chunks(chunk_ids_to_delete)
 
+    @traced("chroma.get_all_documents")
     def get_all_documents(self) -> List[Dict[str, Any]]:
         """
         Retrieves all documents from the documents_collection.
@@ -178,10 +349,11 @@ class ChromaClient:
                     "size": metadata.get("size"),
                     "uploadedAt": metadata.get("uploadedAt"),
                     "status": "completed",  # Assuming all stored docs are complete
-                    "chunks": 0, # This would require querying the other collection, maybe not needed for just a list
+                    "chunks": metadata.get("chunks", 0),
                 })
         return results
 
+    @traced("chroma.get_document")
     def get_document(self, doc_id: str) -> Optional[Dict[str, Any]]:
         """
         Retrieves a single document from the documents_collection by its ID.
@@ -196,10 +368,11 @@ class ChromaClient:
                 "size": metadata.get("size"),
                 "uploadedAt": metadata.get("uploadedAt"),
                 "status": "completed",
-                "chunks": 0,
+                "chunks": metadata.get("chunks", 0),
             }
         return None
 
+    @traced("chroma.get_document_by_name")
     def get_document_by_name(self, doc_name: str) -> Optional[Dict[str, Any]]:
         """
         Retrieves a single document from the documents_collection by its name.
@@ -214,10 +387,11 @@ class ChromaClient:
                 "size": metadata.get("size"),
                 "uploadedAt": metadata.get("uploadedAt"),
                 "status": "completed",
-                "chunks": 0,
+                "chunks": metadata.get("chunks", 0),
             }
         return None
 
+    @traced("chroma.search_chunks")
     def search_chunks(self, query_text: str, top_k: int = 5, doc_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
         """
         Searches for chunks based on a query text, with an optional filter for document IDs.
@@ -247,4 +421,62 @@ class ChromaClient:
                     "distance": results['distances'][0][i] # type: ignore
                 })
         
-        return formatted_results
\ No newline at end of file
+        set_attributes(top_k=top_k, results=len(formatted_results))
+        return formatted_results
+
+    def _chunk_count(self, doc_ids: Optional[List[str]] = None) -> int:
+        """
+        Chunks of the given documents from their `chunks` metadata, or of the whole collection
+        (also when a document has no such metadata).
+        """
+        if not doc_ids:
+            return self.collection.count()
+        documents = self.documents_collection.get(ids=doc_ids, include=["metadatas"]) # type: ignore
+        counts = [m.get("chunks") for m in documents['metadatas'] or []]
+        if len(counts) < len(set(doc_ids)) or any(not isinstance(c, int) for c in counts):
+            return self.collection.count()
+        return sum(counts)
+
+    @traced("chroma.search_chunks_many")
+    def search_chunks_many(self, query_texts: List[str], top_k: int = 5, doc_ids: Optional[List[str]] = None,
+                           exclude_ids: Optional[Set[str]] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Searches chunks for several queries at once: all queries are embedded in one batch
+        request and searched in one collection query.
+
+        :param exclude_ids: Chunk ids to leave out (e.g. already shown to the model); `top_k`
+                            other chunks are still returned per query when the collection has them.
+        :return: A result list per query, in the order of `query_texts` (empty if its embedding failed).
+        """
+        exclude_ids = exclude_ids or set()
+        embeddings = self.embedding_client.embed_texts(query_texts) if query_texts else []
+        embedded = [i for i, embedding in enumerate(embeddings) if embedding]
+        all_results: List[List[Dict[str, Any]]] = [[] for _ in query_texts]
+        if not embedded:
+            return all_results
+
+        # the excluded chunks are over-fetched, but never more than the searched documents have
+        n_results = min(top_k + len(exclude_ids), self._chunk_count(doc_ids))
+        if n_results <= 0:
+            return all_results
+        where_filter = {"doc_id": {"$in": doc_ids}} if doc_ids else None
+        results = self.collection.query(
+            query_embeddings=[embeddings[i] for i in embedded],
+            n_results=n_results,
+            where=where_filter # type: ignore
+        )
+        for row, i in enumerate(embedded):
+            chunks = all_results[i]
+            for j, chunk_id in enumerate(results['ids'][row]):
+                if chunk_id in exclude_ids:
+                    continue
+                chunks.append({
+                    "id": chunk_id,
+                    "text": results['documents'][row][j], # type: ignore
+                    "metadata": results['metadatas'][row][j], # type: ignore
+                    "distance": results['distances'][row][j] # type: ignore
+                })
+                if len(chunks) >= top_k:
+                    break
+        set_attributes(queries=len(query_texts), top_k=top_k, excluded=len(exclude_ids))
+        return all_results
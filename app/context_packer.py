@@ -0,0 +1,150 @@
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app.colors import WARNING_COLOR, Colors
+from app.schemas import Message
+from app.token_counter import TokenCounter
+
+# Context window of one chat slot when the server can't tell (llama-server reports its own n_ctx)
+LLM_CTX_SIZE = int(os.getenv("LLM_CTX_SIZE", "12000"))
+# Tokens kept free for the generated answer
+LLM_OUTPUT_RESERVE_TOKENS = int(os.getenv("LLM_OUTPUT_RESERVE_TOKENS", "2048"))
+# Share of the window left unused to absorb tokenizer mismatch (tiktoken vs the served model)
+CONTEXT_SAFETY_MARGIN = float(os.getenv("CONTEXT_SAFETY_MARGIN", "0.1"))
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "tiktoken")
+
+# Chat template tokens around every message / retrieved chunk markup
+MESSAGE_OVERHEAD_TOKENS = 8
+CHUNK_OVERHEAD_TOKENS = 16
+
+
+class PackedContext:
+    """
+    Result of ContextPacker.pack: what goes into the prompt and what was left out.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used_tokens = 0
+        self.history: List[Message] = []
+        self.chunks: List[Dict[str, Any]] = []
+        self.extras: List[str] = []
+        self.dropped: Dict[str, Any] = {"history_messages": 0, "history_tokens": 0,
+                                        "chunks": [], "chunk_tokens": 0, "extras": []}
+
+    @property
+    def truncated(self) -> bool:
+        return bool(self.dropped["history_messages"] or self.dropped["chunks"] or self.dropped["extras"])
+
+    def summary(self) -> str:
+        d = self.dropped
+        return (f"{self.used_tokens}/{self.budget} tokens; kept {len(self.history)} messages, "
+                f"{len(self.chunks)} chunks, {len(self.extras)} extras; dropped {d['history_messages']} messages "
+                f"({d['history_tokens']} tokens), chunks {d['chunks']} ({d['chunk_tokens']} tokens), extras {d['extras']}")
+
+
+class ContextPacker:
+    """
+    Fits a prompt into the model's context window.
+
+    The window is the slot's context size minus the reserved output budget and a safety
+    margin. Mandatory content (system prompt, the current request, the user's latest
+    message) is always kept; the rest is filled in priority order: retrieved chunks in
+    rank order (at most `top_k` and `max_context_chars` characters), then history from
+    the newest message back, then optional system content such as few-shot examples.
+    Everything left out is recorded in `PackedContext.dropped`.
+    """
+
+    def __init__(self,
+                 token_counter: Optional[TokenCounter] = None,
+                 context_size: int = LLM_CTX_SIZE,
+                 output_reserve: int = LLM_OUTPUT_RESERVE_TOKENS,
+                 max_context_chars: int = 12000,
+                 top_k: int = 4,
+                 safety_margin: float = CONTEXT_SAFETY_MARGIN):
+        """
+        :param token_counter: Tokenizer used for counting (tiktoken by default).
+        :param context_size: Context window of one llama-server slot, tokens.
+        :param output_reserve: Tokens kept free for the answer.
+        :param max_context_chars: Max total characters of retrieved chunks (MAX_CONTEXT_CHARS).
+        :param top_k: Max number of retrieved chunks (TOP_K).
+        :param safety_margin: Share of the window left unused.
+        """
+        self.token_counter = token_counter or TokenCounter(backend=CONTEXT_TOKENIZER, base=os.getenv("LLAMACPP_CHAT_BASE"))
+        self.context_size = context_size
+        self.output_reserve = output_reserve
+        self.max_context_chars = max_context_chars
+        self.top_k = top_k
+        self.safety_margin = safety_margin
+
+    def budget(self, output_reserve: Optional[int] = None) -> int:
+        reserve = self.output_reserve if output_reserve is None else output_reserve
+        return max(int(self.context_size * (1 - self.safety_margin)) - reserve, 0)
+
+    def count(self, text: str) -> int:
+        return self.token_counter.count(text)
+
+    def pack(self,
+             system: str = "",
+             fixed: Sequence[str] = (),
+             history: Sequence[Message] = (),
+             chunks: Sequence[Dict[str, Any]] = (),
+             extras: Sequence[Tuple[str, str]] = (),
+             output_reserve: Optional[int] = None,
+             label: str = "") -> PackedContext:
+        """
+        :param system: System prompt, always kept.
+        :param fixed: Other mandatory text of the request (the rewritten query, a DB schema...).
+        :param history: Thread history, oldest first; a trailing user message is always kept.
+        :param chunks: Retrieved chunks ({"text", "metadata"}) in rank order.
+        :param extras: Optional system content as (name, text), kept in order while it fits.
+        :param output_reserve: Overrides the reserved output budget (e.g. the call's max_tokens).
+        :param label: Step name for the log line.
+        """
+        packed = PackedContext(self.budget(output_reserve))
+        used = self.count(system) + MESSAGE_OVERHEAD_TOKENS + sum(self.count(t) + MESSAGE_OVERHEAD_TOKENS for t in fixed)
+
+        history = list(history)
+        pinned: List[Message] = []
+        if history and history[-1].sender == "user":
+            pinned = [history.pop()]
+            used += self.count(pinned[0].content) + MESSAGE_OVERHEAD_TOKENS
+
+        chars = 0
+        for index, chunk in enumerate(chunks):
+            text = chunk.get("text") or ""
+            cost = self.count(text) + CHUNK_OVERHEAD_TOKENS
+            if (len(packed.chunks) < self.top_k and chars + len(text) <= self.max_context_chars
+                    and used + cost <= packed.budget):
+                packed.chunks.append(chunk)
+                used += cost
+                chars += len(text)
+            else:
+                packed.dropped["chunks"].append(index)
+                packed.dropped["chunk_tokens"] += cost
+
+        kept: List[Message] = []
+        for position in range(len(history) - 1, -1, -1):
+            cost = self.count(history[position].content) + MESSAGE_OVERHEAD_TOKENS
+            if used + cost > packed.budget:
+                # older messages only make sense together with the newer ones
+                packed.dropped["history_messages"] = position + 1
+                packed.dropped["history_tokens"] = cost + sum(
+                    self.count(m.content) + MESSAGE_OVERHEAD_TOKENS for m in history[:position])
+                break
+            kept.append(history[position])
+            used += cost
+        packed.history = kept[::-1] + pinned
+
+        for name, text in extras:
+            cost = self.count(text)
+            if used + cost <= packed.budget:
+                packed.extras.append(text)
+                used += cost
+            else:
+                packed.dropped["extras"].append(name)
+
+        packed.used_tokens = used
+        if packed.truncated or used > packed.budget:
+            print(f"{WARNING_COLOR}Context packed{f' ({label})' if label else ''}: {packed.summary()}{Colors.RESET}")
+        return packed
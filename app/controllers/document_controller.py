@@ -4,9 +4,9 @@ import uuid
 import hashlib
 from datetime import datetime
 from typing import List, Any, Dict
-from app.chroma_client import ChromaClient
+from app.chroma_client import ChromaClient, chunking_params
 from app.embedding_client import EmbeddingClient
-from app.schemas import ChunkQuery, ChunkQueryResult, Document
+from app.schemas import ChunkQuery, ChunkQueryResult, Document, ReindexRequest
 from app.utils.helpers import safe_json
 from app.main import STORAGE_RAW_DIR, CHROMA_PERSIST_DIR
 
@@ -14,8 +14,7 @@ def get_document_router(llm_client, embed_client, chroma_client, thread_store, a
     router = APIRouter()
     
     # Set up dependencies
-    CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "800"))
-    CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "120"))
+    CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_UNIT = chunking_params()
     
     # Use provided dependencies
     _embed_client = embed_client
@@ -74,7 +73,7 @@ def get_document_router(llm_client, embed_client, chroma_client, thread_store, a
 
             try:
                 chunk_count = _chroma_client.ingest_file(
-                    doc_id, raw_path, filename, up.content_type or f"application/{ext}", uploaded_at, CHUNK_SIZE, CHUNK_OVERLAP
+                    doc_id, raw_path, filename, up.content_type or f"application/{ext}", uploaded_at, CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_UNIT
                 )
                 _finish("completed", chunk_count, None)
 
@@ -91,6 +90,33 @@ def get_document_router(llm_client, embed_client, chroma_client, thread_store, a
         documents = _chroma_client.get_all_documents()
         return safe_json(documents)
 
+    @router.post("/reindex")
+    def reindex_documents(req: ReindexRequest):
+        """
+        Re-chunks and re-embeds documents from their cached extracted text,
+        without re-uploading or re-parsing them. All documents if no ids are given.
+        """
+        size, overlap, unit = chunking_params(req.chunk_unit) if req.chunk_unit else (CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_UNIT)
+        size = req.chunk_size or size
+        overlap = req.chunk_overlap if req.chunk_overlap is not None else overlap
+        doc_ids = req.doc_ids or [doc["id"] for doc in _chroma_client.get_all_documents()]
+
+        results = []
+        for doc_id in doc_ids:
+            try:
+                chunks = _chroma_client.reindex_document(doc_id, size, overlap, unit)
+                results.append({"id": doc_id, "status": "completed", "chunks": chunks})
+            except Exception as e:
+                results.append({"id": doc_id, "status": "error", "chunks": 0, "metadata": {"error": str(e)}})
+        return safe_json(results)
+
+    @router.get("/chunking/report")
+    def get_chunking_report():
+        """
+        Reports how often word-based chunks overflow the embedding model context.
+        """
+        return safe_json(_chroma_client.get_chunking_report())
+
     @router.get("/{doc_id}", response_model=Document)
     def get_document(doc_id: str):
         """
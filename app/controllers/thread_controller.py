@@ -1,12 +1,18 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from typing import Optional, Dict, Any
 from app.thread_store import ThreadStore
 from app.agent import Agent
 from app.generator import Generator
+from app.llm_scheduler import OverloadedError
+from app.request_context import INTERACTIVE
+from app.resilience import BackendUnavailable
 from app.chroma_client import ChromaClient
-from app.schemas import UserMessageRequest, ThreadName, DocumentId
+from app.schemas import AgentDelta, AgentUsage, UserMessageRequest, ThreadName, DocumentId
+from app.tracing import tracer
 from app.utils.helpers import safe_json
+from app.usage import UsageBreakdown
+from app.utils.sse import cancel_on_disconnect
 import json
 
 def get_thread_router(llm_client, embed_client, chroma_client, thread_store, agent):
@@ -41,6 +47,16 @@ def get_thread_router(llm_client, embed_client, chroma_client, thread_store, age
             raise HTTPException(status_code=404, detail="Thread not found")
         return safe_json(thread.dict())
 
+    @router.get("/{thread_id}/usage")
+    def get_thread_usage(thread_id: str):
+        """
+        Cumulative tokens and time of the thread's turns, per agent step and backend.
+        """
+        thread = _thread_store.get_thread(thread_id)
+        if not thread:
+            raise HTTPException(status_code=404, detail="Thread not found")
+        return safe_json(thread.metadata.get("usage") or UsageBreakdown().to_dict())
+
     @router.put("/{thread_id}/metadata")
     async def update_thread_metadata(thread_id: str, metadata: Dict[str, Any]):
         try:
@@ -58,19 +74,60 @@ def get_thread_router(llm_client, embed_client, chroma_client, thread_store, age
             raise HTTPException(status_code=404, detail=str(e))
 
     @router.post("/{thread_id}/chat")
-    async def chat_in_thread(thread_id: str, message: UserMessageRequest):
+    async def chat_in_thread(thread_id: str, message: UserMessageRequest, request: Request):
         if message.use_db_explorer:
             stream_func = _agent.query_with_db_explorer
         else:
             stream_func = _agent.user_query
         try:
-            def stream_generator():
-                for chunk in stream_func(message.content, thread_id):
-                    # Log the chunk before sending it
-                    print(f"Sending chunk: {chunk}")
-                    yield f"data: {json.dumps({'type': 'chunk', 'data': chunk}, ensure_ascii=False)}\n\n"
+            # reject right away instead of opening a stream that would wait in a long queue
+            _llm_client.scheduler.check_admission(INTERACTIVE)
+        except OverloadedError as e:
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(int(e.retry_after_s))})
+        # None unless TRACING=1; the trace id goes back in the X-Trace-Id header
+        trace = tracer.start("chat", thread_id=thread_id, pipeline=stream_func.__name__)
+        try:
+            async def stream_generator():
+                tracer.use(trace)  # the response is streamed from another task
+                # the agent pipeline is async end to end: waiting on the LLM does not hold a worker thread;
+                # when the client goes away the pipeline is cancelled together with its LLM requests
+                try:
+                    async for chunk in cancel_on_disconnect(stream_func(message.content, thread_id), request.is_disconnected,
+                                                            name=stream_func.__name__):
+                        if isinstance(chunk, AgentDelta):
+                            # Token deltas go out as they arrive; the full answer follows as a regular chunk
+                            event = {'type': 'delta', 'data': chunk.delta}
+                            if chunk.reset:
+                                event['reset'] = True
+                            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+                            continue
+                        if isinstance(chunk, AgentUsage):
+                            # tokens and time of the turn per step and backend, the last event of the stream
+                            yield f"data: {json.dumps({'type': 'usage', 'data': chunk.usage}, ensure_ascii=False)}\n\n"
+                            continue
+                        # Log the chunk before sending it
+                        print(f"Sending chunk: {chunk}")
+                        yield f"data: {json.dumps({'type': 'chunk', 'data': chunk}, ensure_ascii=False)}\n\n"
+                except OverloadedError as e:
+                    # the stream has already started: report the rejection as an event
+                    tracer.finish(trace, e)
+                    event = {'type': 'error', 'status': 429, 'data': str(e), 'retry_after': e.retry_after_s}
+                    yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+                except BackendUnavailable as e:
+                    # the LLM backend is down (circuit open): fail fast instead of piling retries on it
+                    tracer.finish(trace, e)
+                    event = {'type': 'error', 'status': 503, 'data': str(e), 'retry_after': e.retry_after_s}
+                    yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+                except BaseException as e:
+                    tracer.finish(trace, e)
+                    raise
+                tracer.finish(trace)
+                if trace is not None and tracer.sse:
+                    # per-stage durations of the turn
+                    yield f"data: {json.dumps({'type': 'trace', 'data': trace.summary()}, ensure_ascii=False)}\n\n"
             
-            return StreamingResponse(stream_generator(), media_type="text/event-stream")
+            headers = {"X-Trace-Id": trace.trace_id} if trace is not None else None
+            return StreamingResponse(stream_generator(), media_type="text/event-stream", headers=headers)
         except ValueError as e:
             raise HTTPException(status_code=404, detail=str(e))
 
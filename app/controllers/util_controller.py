@@ -2,15 +2,20 @@ import os
 from fastapi import APIRouter
 from app.generator import Generator
 from app.embedding_client import EmbeddingClient
+from app.llm_log import llm_log
+from app.tracing import tracer
+from app.metrics import metrics
+from app.usage import usage_totals
 from app.utils.helpers import safe_json
 from app.main import MODELS_FOLDER
 
-def get_util_router(llm_client, embed_client):
+def get_util_router(llm_client, embed_client, intent_router=None):
     router = APIRouter()
 
     # Use provided dependencies
     _llm_client = llm_client
     _embed_client = embed_client
+    _intent_router = intent_router
 
     @router.get("/status")
     async def get_status():
@@ -24,6 +29,75 @@ def get_util_router(llm_client, embed_client):
     def get_embedding_model_handler():
         return safe_json({"model": _embed_client._get_model_from_server()})
 
+    @router.get("/llm_cache/stats")
+    def get_llm_cache_stats():
+        """
+        Hit/miss counters and hit rate of the exact-match LLM response cache.
+        """
+        return safe_json(_llm_client.cache.stats())
+
+    @router.post("/llm_cache/clear")
+    def clear_llm_cache():
+        _llm_client.cache.clear()
+        return safe_json({"status": "success"})
+
+    @router.get("/llm_router/stats")
+    def get_llm_router_stats():
+        """
+        State of the llama-server replicas: health, load, slots, errors.
+        """
+        llm_router = _llm_client.router
+        return safe_json({"replicas": llm_router.stats() if llm_router is not None else []})
+
+    @router.get("/llm_scheduler/stats")
+    def get_llm_scheduler_stats():
+        """
+        Running and waiting LLM requests per priority class, concurrency and queue limits.
+        """
+        return safe_json(_llm_client.scheduler.stats())
+
+    @router.get("/llm_resilience/stats")
+    def get_llm_resilience_stats():
+        """
+        Retry policy, circuit breaker state and retries per reason of the LLM backend.
+        """
+        return safe_json(_llm_client.resilience.stats())
+
+    @router.get("/metrics")
+    def get_metrics():
+        """
+        Process counters and summaries (cancelled streams and LLM calls, ...).
+        """
+        return safe_json(metrics.snapshot())
+
+    @router.get("/usage/stats")
+    def get_usage_stats():
+        """
+        Tokens and time of all LLM and embedding calls since start, per agent step and backend.
+        """
+        return safe_json(usage_totals.to_dict())
+
+    @router.get("/tracing/stats")
+    def get_tracing_stats():
+        """
+        Whether requests are traced, traces and spans finished, and the OTLP/JSON export writer counters.
+        """
+        return safe_json(tracer.stats())
+
+    @router.get("/llm_log/stats")
+    def get_llm_log_stats():
+        """
+        Counters of the LLM trace log writer: written, dropped on a full queue, sampled out, rotations.
+        """
+        return safe_json(llm_log.stats())
+
+    @router.get("/intent_router/stats")
+    def get_intent_router_stats():
+        """
+        Intent router decisions and skip rate (turns answered without the intent LLM call).
+        """
+        return safe_json(_intent_router.stats() if _intent_router is not None else {"enabled": False})
+
     @router.get("/get_loaded_models")
     def get_loaded_models():
         """
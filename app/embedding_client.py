@@ -1,8 +1,13 @@
 import os
-import requests
+import time
 from typing import List
 
+import httpx
+
 from app.colors import SUCCESS_COLOR, Colors
+from app.http_pool import get_client
+from app.tracing import set_attributes, traced
+from app.usage import record_embedding_usage
 
 class EmbeddingClient:
     def __init__(self, base: str = os.getenv("LLAMACPP_EMBED_BASE","http://localhost:8080")):
@@ -14,6 +19,7 @@ class EmbeddingClient:
         self.base = base
         print(f"{SUCCESS_COLOR}Embedding Server instantiated successfully.{Colors.RESET}")
     
+    @traced("embedding.embed_text")
     def embed_text(self, text: str) -> List[float]:
         """
         Generates an embedding for the given text.
@@ -23,12 +29,14 @@ class EmbeddingClient:
         """
         print(f"Embedding text: {text[:30]}...")  # Debug print
         try:
-            response = requests.post(
+            started = time.perf_counter()
+            response = get_client("embed").post(
                 f"{self.base}/embedding",
                 json={"content": text},
                 headers={"Content-Type": "application/json"},
             )
             response.raise_for_status()
+            record_embedding_usage("embed", 1, (time.perf_counter() - started) * 1000)
             
             data = response.json()
             try:
@@ -40,13 +48,14 @@ class EmbeddingClient:
                 print(f"Received data: {data}")
                 return []
 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"An error occurred while communicating with the embedding server: {e}")
             return []
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
             return []
 
+    @traced("embedding.embed_texts")
     def embed_texts(self, texts: List[str], batch_size: int = 20) -> List[List[float]]:
         """
         Generates embeddings for a list of texts in batches.
@@ -56,17 +65,20 @@ class EmbeddingClient:
         :return: A list of lists of floats representing the embeddings.
         """
         print(f"Embedding texts: {[text[:30] + '... len ->' + str(len(text)) for text in texts[:3]]}...")  # Debug print
+        set_attributes(texts=len(texts))
         all_embeddings = []
         for i in range(0, len(texts), batch_size):
             batch = texts[i:i + batch_size]
             
             try:
-                response = requests.post(
+                started = time.perf_counter()
+                response = get_client("embed").post(
                     f"{self.base}/embedding",
                     json={"content": batch},
                     headers={"Content-Type": "application/json"},
                 )
                 response.raise_for_status()
+                record_embedding_usage("embed", len(batch), (time.perf_counter() - started) * 1000)
                 
                 data = response.json()
                 
@@ -74,26 +86,27 @@ class EmbeddingClient:
                 batch_embeddings = [item['embedding'][0] for item in data]
                 all_embeddings.extend(batch_embeddings)
 
-            except requests.exceptions.RequestException as e:
+            except httpx.HTTPError as e:
                 print(f"An error occurred while communicating with the embedding server: {e}")
                 # Pad with empty embeddings for the failed batch
                 all_embeddings.extend([[]] * len(batch))
-            except (KeyError, TypeError) as e:
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                # ValueError: the body is not JSON (httpx decode errors are not httpx.HTTPError)
                 print(f"Failed to parse embeddings from server response: {e}")
-                print(f"Received data: {data}")
+                print(f"Received data: {response.text[:500]}")
                 all_embeddings.extend([[]] * len(batch))
         return all_embeddings
 
     def _get_model_from_server(self):
         try:
-            response = requests.get(f"{self.base}/models")
+            response = get_client("embed").get(f"{self.base}/models")
             print(response)
             response.raise_for_status()
             models = response.json().get("data", [])
             if models:
                 return models[0]["id"][models[0]["id"].rfind("\\") + 1:]
             return "No models found"
-        except requests.exceptions.RequestException as e:
+        except (httpx.HTTPError, ValueError, KeyError, IndexError, TypeError) as e:
             print(f"Error fetching models from server: {e}")
             return "Not available"
     
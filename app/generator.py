@@ -1,19 +1,30 @@
 # local_generator.py
 
+import asyncio
 from datetime import date
+import functools
 import os
 import json
 import time
-from typing import List, Type, TypeVar, Optional
+from typing import AsyncIterator, Iterable, List, Sequence, Tuple, Type, TypeVar, Optional, Union
 import dotenv
 import httpx
 from pydantic import BaseModel, Field, ValidationError
-import requests
 from app.google_gen import GoogleGenAI
+from app.http_pool import get_client
+from app.json_stream import JsonFieldStreamer
 from app.llama_gen import LlamaGenAI
+from app.context_packer import CONTEXT_TOKENIZER, LLM_CTX_SIZE
+from app.llm_cache import LLMCache
+from app.llm_router import LlmRouter, chat_bases_from_env
+from app.llm_scheduler import LLM_CLOUD_MAX_CONCURRENCY, LLM_MAX_CONCURRENCY, LlmScheduler
 from app.qwen_gen import QwenGenAI
+from app.request_context import BACKGROUND, RetryBudget, current_retry_budget, set_priority
+from app.resilience import BAD_OUTPUT, Resilience, allow_retry
 from app.schemas import *
 from app.colors import *
+from app.token_counter import TokenCounter
+from app.usage import UsageBreakdown, current_usage
 
 # A Generic Type Variable for our generator's return type
 T = TypeVar("T", bound=BaseModel)
@@ -21,41 +32,167 @@ T = TypeVar("T", bound=BaseModel)
 RETRIES = int(os.getenv("LLAMACPP_MAX_RETRIES", 3))
 TIMEOUT = int(os.getenv("LLAMACPP_TIMEOUT_S", 300))
 
+
+def _strict_schema(schema: dict) -> dict:
+    if isinstance(schema, list):
+        return [_strict_schema(s) for s in schema]
+    if not isinstance(schema, dict):
+        return schema
+    out = {k: _strict_schema(v) for k, v in schema.items() if k != "default"}
+    if out.get("type") == "object" and "properties" in out:
+        out["required"] = list(out["properties"])
+        out["additionalProperties"] = False
+    return out
+
+
+@functools.lru_cache(maxsize=None)
+def response_schema(pydantic_model: Type[BaseModel]) -> dict:
+    """
+    JSON schema that constrains decoding for `pydantic_model`, built once per model class.
+
+    llama-server compiles it into a grammar, Gemini and OpenRouter use their structured
+    output modes. Every property is required (optional ones stay nullable) and extra
+    properties are forbidden, as strict structured-output modes expect; for llama.cpp this
+    also fixes the key order, so `answer` is generated first and can be streamed.
+    """
+    return _strict_schema(pydantic_model.model_json_schema())
+
+
+class GenerationJob:
+    """
+    One independent prompt of an `agenerate_many` batch.
+    """
+
+    def __init__(self,
+                 pydantic_model: Type[BaseModel],
+                 prompt: Optional[str] = None,
+                 system_prompt: str = "",
+                 language: Optional[str] = None,
+                 temperature: float = 0.7,
+                 payload: Optional[LLamaMessageHistory] = None,
+                 context: Optional[str] = None,
+                 cacheable: Optional[bool] = None):
+        """
+        :param pydantic_model: The Pydantic class of the expected JSON answer.
+        :param prompt: Description of the object to generate (as in `agenerate_one_shot`).
+        :param system_prompt: Static instructions.
+        :param language: Language of the generated text content.
+        :param temperature: LLM temperature.
+        :param payload: Message history; the job is then run like `agenerate_with_payload` and `prompt` is ignored.
+        :param context: Per-call data placed after the history (payload jobs only).
+        :param cacheable: Exact-match response cache mode (see `agenerate_one_shot`).
+        """
+        self.pydantic_model = pydantic_model
+        self.prompt = prompt
+        self.system_prompt = system_prompt
+        self.language = language
+        self.temperature = temperature
+        self.payload = payload
+        self.context = context
+        self.cacheable = cacheable
+
+
+class GenerationResult:
+    """
+    Outcome of one job of a batch: the instance, or the error it failed with after its retries.
+    """
+
+    def __init__(self, index: int, job: GenerationJob):
+        self.index = index
+        self.job = job
+        self.result: Optional[BaseModel] = None
+        self.error: Optional[BaseException] = None
+        self.duration_ms = 0.0
+        self.output_tokens = 0
+        self.usage = UsageBreakdown()  # LLM calls of the job, retries included
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class BatchReport:
+    """
+    Result of Generator.generate_many: per-job results in input order and batch throughput.
+    """
+
+    def __init__(self, results: List[GenerationResult], duration_s: float, concurrency: int):
+        self.results = results
+        self.duration_s = duration_s
+        self.concurrency = concurrency
+        self.failed = sum(1 for r in results if not r.ok)
+        # tokens generated by the jobs' calls; wall time of the whole batch
+        self.output_tokens = sum(r.output_tokens for r in results)
+        self.tokens_per_s = self.output_tokens / duration_s if duration_s > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f"{len(self.results)} jobs ({self.failed} failed) in {self.duration_s:.1f}s, concurrency {self.concurrency}: "
+                f"{self.output_tokens} output tokens, {self.tokens_per_s:.1f} tokens/s")
+
+
 class Generator:
     """
     A class to generate instances of Pydantic models in a specified language
     by instructing a local Llama server to return a JSON object.
     """
 
-    def __init__(self, base: str):
+    def __init__(self, base: str, cache: Optional[LLMCache] = None, router: Optional[LlmRouter] = None):
         """
         Initializes the generator with the local Llama server URL.
+
+        :param cache: Exact-match response cache for deterministic calls (a default LLMCache if omitted).
+        :param router: llama-server replicas (by default LLAMACPP_CHAT_BASES, or just `base`).
+
+        Backend calls go through `self.resilience` (retries, circuit breaker) and
+        `self.scheduler` (concurrency cap, priority queue).
         """
             
         self.base = base
+        self.cache = cache if cache is not None else LLMCache()
+        self.router: Optional[LlmRouter] = None
         
         self.url = f"{self.base}/v1/chat/completions"
         
         if os.getenv("USE_GEMINI") == '1':
             print(f"{INFO_COLOR}Using GEMINI model as LLM backend{Colors.RESET}")
             self.google_client = GoogleGenAI()
-            self.complete_funtion =  self.google_client.complete
+            self.acomplete_function = self.google_client.acomplete
+            self.astream_function = self.google_client.astream
             self._backend_type = "gemini"
             self._get_model_from_server = self.google_client.get_model
         elif os.getenv("USE_QWEN") == '1':
             print(f"{INFO_COLOR}Using QWEN model as LLM backend{Colors.RESET}")
             self.qwen_client = QwenGenAI()
-            self.complete_funtion = self.qwen_client.complete
+            self.acomplete_function = self.qwen_client.acomplete
+            self.astream_function = self.qwen_client.astream
             self._backend_type = "qwen"
             self._get_model_from_server = self.qwen_client.get_model
         else: 
             print(f"{INFO_COLOR}Using local Llama server as LLM backend{Colors.RESET}")
-            self.llama_client = LlamaGenAI(base)
-            self.complete_funtion = self.llama_client.complete
-            self._backend_type = f"local <{self.base}>"
+            self.router = router or LlmRouter(chat_bases_from_env(base))
+            self.llama_client = LlamaGenAI(base, router=self.router)
+            self.acomplete_function = self.llama_client.acomplete
+            self.astream_function = self.llama_client.astream
+            self._backend_type = f"local <{', '.join(r.base for r in self.router.replicas)}>"
+            self._get_model_from_server = self.llama_client.get_model
+        # context window available to one request, for ContextPacker
+        self.context_size = getattr(getattr(self, "llama_client", None), "n_ctx", 0) or LLM_CTX_SIZE
+
+        # every backend call, including direct astream_function calls, waits for a scheduler slot
+        if self.router is not None:
+            concurrency = LLM_MAX_CONCURRENCY or sum(r.total_slots for r in self.router.replicas) or 4
+        else:
+            concurrency = LLM_MAX_CONCURRENCY or LLM_CLOUD_MAX_CONCURRENCY
+        self.scheduler = LlmScheduler("llama" if self.router is not None else self._backend_type, concurrency)
+        # transient errors are retried with backoff outside the slot; the circuit breaker fails fast in an outage
+        self.resilience = Resilience(self.scheduler.backend)
+        self.acomplete_function = self.resilience.wrap_acomplete(self.scheduler.wrap_acomplete(self.acomplete_function))
+        self.astream_function = self.resilience.wrap_astream(self.scheduler.wrap_astream(self.astream_function))
         
         print(f"{SUCCESS_COLOR}Generator instantiated successfully.{Colors.RESET}")
         self.model = self._get_model_from_server()
+        # output tokens of batch jobs whose backend doesn't report usage (generate_many)
+        self.token_counter = TokenCounter(backend=CONTEXT_TOKENIZER, base=os.getenv("LLAMACPP_CHAT_BASE"))
     
 
         
@@ -78,82 +215,213 @@ class Generator:
 
         raise ValueError("No JSON object found in the response.")
 
-    def generate_with_payload(self,
+    def _fields_prompt(self, pydantic_model: Type[T]) -> str:
+        """
+        Short field list for the prompt. The structure itself is enforced by the response
+        schema (see `response_schema`), the model only needs to know what each field means.
+        """
+        return "\n".join(f"- `{name}`: {field.description or name}" for name, field in pydantic_model.model_fields.items())
+
+    def _language_instruction(self, language: Optional[str]) -> str:
+        if not language:
+            return ""
+        return f"CRITICAL: All generated text content (like names, descriptions, effects, etc.) MUST be in the following language: {language}."
+
+    def _system_prompt(self, pydantic_model: Type[T], system_prompt: Optional[str], language: Optional[str]) -> str:
+        """
+        System prompt of a structured request: the caller's instructions, the field list and the
+        language. It depends only on the step and the model class, so it is byte-identical between
+        calls and llama-server reuses its KV cache; everything that varies goes after it.
+        """
+        parts = [system_prompt.strip()] if system_prompt and system_prompt.strip() else []
+        parts.append(f"Respond with a single JSON object with the following fields:\n{self._fields_prompt(pydantic_model)}")
+        language_instruction = self._language_instruction(language)
+        if language_instruction:
+            parts.append(language_instruction)
+        return "\n\n".join(parts)
+
+    def _one_shot_prompt(self, prompt: Optional[str]) -> str:
+        if prompt:
+            return f"Generate an object based on this description: '{prompt}'."
+        return "Generate a completely new, creative, and random object."
+
+    def _payload_request(self, payload: LLamaMessageHistory, pydantic_model: Type[T], language: Optional[str],
+                         system_prompt: Optional[str], context: Optional[str], temperature: float) -> dict:
+        payload.messages.insert(0, SystemLamaMessage(role="system", content=self._system_prompt(pydantic_model, system_prompt, language)))
+        instruction = "Based on our conversation, generate the JSON object now."
+        if context:
+            # variable context goes last, after the cacheable system prompt and history
+            instruction = f"{context.strip()}\n\n{instruction}"
+        payload.messages.append(UserLamaMessage(role="user", content=instruction))
+        return dict(payload=payload, temperature=temperature, max_tokens=2048, json_schema=response_schema(pydantic_model))
+
+    def _one_shot_request(self, pydantic_model: Type[T], prompt: Optional[str], language: Optional[str],
+                          system_prompt: str, temperature: float) -> dict:
+        return dict(
+            system_prompt=self._system_prompt(pydantic_model, system_prompt, language),
+            user=self._one_shot_prompt(prompt),
+            temperature=temperature,
+            max_tokens=2048,
+            json_schema=response_schema(pydantic_model))
+
+    def _parse_response(self, response_text: str, pydantic_model: Type[T]) -> T:
+        print(f"{SUCCESS_COLOR}Response received from Llama server.{Colors.RESET}")
+        cleaned_response = self._clean_json_response(response_text)
+        try:
+            parsed_data = json.loads(cleaned_response)
+        except json.JSONDecodeError as e:
+            print(f"{ERROR_COLOR}Error decoding JSON: {e}{Colors.RESET}")
+            print(f"{WARNING_COLOR}Cleaned Response that failed parsing:{Colors.RESET}")
+            print(cleaned_response)
+            raise e
+        return pydantic_model(**parsed_data)
+
+    def _cache_key(self, request: dict, cacheable: Optional[bool]) -> Optional[str]:
+        """
+        Cache key of a request, or None when it must not be cached: by default only
+        temperature 0 calls are cached, `cacheable=True` forces caching, `False` bypasses it.
+        """
+        if cacheable is False:
+            self.cache.record_bypass()
+            return None
+        if cacheable is None and request.get("temperature") != 0:
+            return None
+        # the backend kind, not the replica list: replicas serve the same model
+        return self.cache.key(self.scheduler.backend, self.model, request)
+
+    async def _cached(self, key: Optional[str], pydantic_model: Type[T]) -> Optional[T]:
+        if key is None:
+            return None
+        cached = await self.cache.aget(key)
+        if cached is None:
+            return None
+        try:
+            print(f"{SUCCESS_COLOR}LLM cache hit for {pydantic_model.__name__}{Colors.RESET}")
+            return self._parse_response(cached, pydantic_model)
+        except (json.JSONDecodeError, ValidationError, ValueError):
+            return None
+
+    def _cached_delta(self, result: BaseModel, stream_field: str):
+        text = getattr(result, stream_field, None)
+        if isinstance(text, str) and text:
+            yield AgentDelta(delta=text)
+
+    async def _run(self, request: dict, pydantic_model: Type[T], language: Optional[str], retries: int, delay: int,
+                   cacheable: Optional[bool] = None, stream_field: Optional[str] = None) -> AsyncIterator[Union[AgentDelta, T]]:
+        """
+        The structured-generation loop behind every public method: cache lookup, the backend call
+        (streamed through JsonFieldStreamer when `stream_field` is set), parsing and re-asks.
+        Yields AgentDelta pieces of `stream_field` (reset=True before a re-ask that follows streamed
+        text; a cache hit yields the whole field at once), then the validated instance as the last item.
+
+        The call gets a RetryBudget of `retries - 1` on top of the chat turn's: re-asks and the
+        transient-error retries of `self.resilience` both spend it, so it makes at most `retries` attempts.
+        """
+        key = self._cache_key(request, cacheable)
+        result = await self._cached(key, pydantic_model)
+        if result is not None:
+            if stream_field:
+                for delta in self._cached_delta(result, stream_field):
+                    yield delta
+            yield result
+            return
+        mode = "Sending" if stream_field is None else "Streaming"
+        previous = current_retry_budget.get()
+        current_retry_budget.set(RetryBudget(max(retries - 1, 0), parent=previous))
+        try:
+            attempt = 0
+            while True:
+                attempt += 1
+                print(
+                    f"{HEADER_COLOR}{mode} async request to Local Llama Server{Colors.RESET} for: {ENTITY_COLOR}{pydantic_model.__name__}{Colors.RESET} (Language: {INFO_COLOR}{language or 'Default'}{Colors.RESET})"
+                )
+                streamed = False
+                try:
+                    if stream_field is None:
+                        response_text = await self.acomplete_function(**request)
+                    else:
+                        field = JsonFieldStreamer(stream_field)
+                        parts = []
+                        async for delta in self.astream_function(**request):
+                            parts.append(delta)
+                            text = field.feed(delta)
+                            if text:
+                                streamed = True
+                                yield AgentDelta(delta=text)
+                        response_text = "".join(parts)
+                    result = self._parse_response(response_text, pydantic_model)
+                except (json.JSONDecodeError, ValidationError, ValueError) as e:
+                    print(
+                        f"Error processing response (attempt {attempt}/{retries}): {e}"
+                    )
+                    if streamed:
+                        yield AgentDelta(delta="", reset=True)
+                    if allow_retry(self.scheduler.backend, BAD_OUTPUT):
+                        print(f"Retrying in {delay} seconds...")
+                        await asyncio.sleep(delay)
+                        continue
+                    raise e
+                if key is not None:
+                    await self.cache.aput(key, response_text)
+                break
+        finally:
+            # set instead of a reset token: async generators may be resumed in another context copy
+            current_retry_budget.set(previous)
+        yield result
+
+    async def _agenerate(self, request: dict, pydantic_model: Type[T], language: Optional[str], retries: int, delay: int,
+                         cacheable: Optional[bool] = None) -> T:
+        result = None
+        async for result in self._run(request, pydantic_model, language, retries, delay, cacheable):
+            pass
+        return result  # type: ignore
+
+    async def agenerate_with_payload(self,
         payload: LLamaMessageHistory,
         pydantic_model: Type[T],
         system_prompt: Optional[str] = None,
         language: Optional[str] = None,
         retries: int = RETRIES,
         delay: int = 0,
+        context: Optional[str] = None,
+        cacheable: Optional[bool] = None,
+        temperature: float = 0.7,
     ) -> T:
         """
         Generates a Pydantic instance by asking the model for a JSON response.
 
         Args:
             pydantic_model: The Pydantic class to create an instance of.
-        """    
-        schema_json = json.dumps(pydantic_model.model_json_schema(), indent=2)
-
-        language_instruction = ""
-        if language:
-            language_instruction = f"CRITICAL: All generated text content (like names, descriptions, effects, etc.) MUST be in the following language: {language}."
-
-        system_prompt = f"""You are a JSON generation robot. Your sole purpose is to generate a single, valid JSON object that conforms to the provided JSON schema.
+            system_prompt: Static instructions, placed before the history.
+            context: Per-call data (e.g. retrieved chunks), placed after the history.
+            temperature: LLM temperature (0 makes the call cacheable by default, see `agenerate_one_shot`).
+        """
+        request = self._payload_request(payload, pydantic_model, language, system_prompt, context, temperature)
+        return await self._agenerate(request, pydantic_model, language, retries, delay, cacheable)
 
-JSON Schema to follow:
-```json
-{schema_json}
-```
+    def astream_with_payload(self,
+        payload: LLamaMessageHistory,
+        pydantic_model: Type[T],
+        system_prompt: Optional[str] = None,
+        language: Optional[str] = None,
+        retries: int = RETRIES,
+        delay: int = 0,
+        stream_field: str = "answer",
+        context: Optional[str] = None,
+        cacheable: Optional[bool] = None,
+        temperature: float = 0.7,
+    ) -> AsyncIterator[Union[AgentDelta, T]]:
+        """
+        Same as `agenerate_with_payload`, but streams the value of `stream_field` as it is generated.
 
-Language Instruction:
-{language_instruction}
+        Yields:
+            AgentDelta pieces of `stream_field` (reset=True when a failed attempt is retried),
+            then the instance of the Pydantic class as the last item.
+        """
+        request = self._payload_request(payload, pydantic_model, language, system_prompt, context, temperature)
+        return self._run(request, pydantic_model, language, retries, delay, cacheable, stream_field)
 
-Your response MUST be the raw JSON object, starting with `{{` and ending with `}}`.
-DO NOT include any introductory text, explanations, apologies, or markdown code fences.
-Your output will be directly parsed by a machine. Any character outside of the JSON object will cause a failure.
-Begin your response immediately with the opening curly brace `{{`."""
-        
-        payload.messages.insert(0, SystemLamaMessage(role="system", content=system_prompt)) 
-        payload.messages.append(UserLamaMessage(role="user", content="Based on our conversation, generate the JSON object now."))
-        
-        for i in range(retries):
-            print(
-                f"{HEADER_COLOR}Sending request to Local Llama Server{Colors.RESET} for: {ENTITY_COLOR}{pydantic_model.__name__}{Colors.RESET} (Language: {INFO_COLOR}{language or 'Default'}{Colors.RESET})"
-            )
-            try:
-                print(f"{INFO_COLOR} url {self.url}:{Colors.RESET}")
-                
-                # response = requests.post(self.url, headers=headers, json=data)
-                response_text = self.complete_funtion(
-                    payload=payload,
-                    temperature=0.7,
-                    max_tokens=2048)
-                
-                    
-                print(f"{SUCCESS_COLOR}Response received from Llama server.{Colors.RESET}")
-                cleaned_response = self._clean_json_response(response_text)
-                try:
-                    parsed_data = json.loads(cleaned_response)
-                    print(parsed_data)
-                except json.JSONDecodeError as e:
-                    print(f"{ERROR_COLOR}Error decoding JSON: {e}{Colors.RESET}")
-                    print(f"{WARNING_COLOR}Cleaned Response that failed parsing:{Colors.RESET}")
-                    print(cleaned_response)
-                    raise e
-                return pydantic_model(**parsed_data)
-            except (requests.exceptions.RequestException, json.JSONDecodeError, ValidationError, ValueError) as e:
-                print(
-                    f"Error processing response (attempt {i + 1}/{retries}): {e}"
-                )
-                if i < retries - 1:
-                    print(f"Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                else:
-                    raise e
-        raise Exception("Failed to generate object after multiple retries.")
-        
-        
-    def generate_one_shot(
+    async def agenerate_one_shot(
         self,
         pydantic_model: Type[T],
         prompt: Optional[str] = None,
@@ -161,7 +429,8 @@ Begin your response immediately with the opening curly brace `{{`."""
         retries: int = RETRIES,
         delay: int = 0,
         system_prompt: str = "",
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        cacheable: Optional[bool] = None,
     ) -> T:
         """
         Generates a Pydantic instance by asking the model for a JSON response.
@@ -170,88 +439,132 @@ Begin your response immediately with the opening curly brace `{{`."""
             pydantic_model: The Pydantic class to create an instance of.
             prompt: A specific description of the object to generate.
             language: The desired language for the generated text content (e.g., "Russian").
-            retries: The number of times to retry the request if it fails.
-            delay: The delay in seconds between retries.
+            retries: Attempts in total, re-asks for output that does not parse or validate and
+                retries of transient backend errors (`self.resilience`) together.
+            delay: The delay in seconds before such a re-ask.
+            cacheable: Use the exact-match response cache: None caches only temperature 0 calls,
+                True always, False bypasses the cache.
 
         Returns:
             An instance of the specified Pydantic class.
         """
-        schema_json = json.dumps(pydantic_model.model_json_schema(), indent=2)
+        request = self._one_shot_request(pydantic_model, prompt, language, system_prompt, temperature)
+        return await self._agenerate(request, pydantic_model, language, retries, delay, cacheable)
 
-        if prompt:
-            user_request = f"Generate an object based on this description: '{prompt}'."
-        else:
-            user_request = "Generate a completely new, creative, and random object."
-
-        language_instruction = ""
-        if language:
-            language_instruction = f"CRITICAL: All generated text content (like names, descriptions, effects, etc.) MUST be in the following language: {language}."
-
-        # --- Construct the full prompt with the new language instruction ---
-        full_prompt = f"""You are a JSON generation robot. Your sole purpose is to generate a single, valid JSON object that conforms to the provided JSON schema.
-
-JSON Schema to follow:
-```json
-{schema_json}
-```
-
-User's request for the object's content:
-{user_request}
-{language_instruction}
-
-Your response MUST be the raw JSON object, starting with `{{` and ending with `}}`.
-DO NOT include any introductory text, explanations, apologies, or markdown code fences.
-Your output will be directly parsed by a machine. Any character outside of the JSON object will cause a failure.
-Begin your response immediately with the opening curly brace `{{`."""
-
-
-        for i in range(retries):
-            print(
-                f"{HEADER_COLOR}Sending request to Local Llama Server{Colors.RESET} for: {ENTITY_COLOR}{pydantic_model.__name__}{Colors.RESET} (Language: {INFO_COLOR}{language or 'Default'}{Colors.RESET})"
-            )
-            try:
-                print(f"{INFO_COLOR} url {self.url}:{Colors.RESET}")
-                # response = requests.post(self.url, headers=headers, json=data)
-                response_text = self.complete_funtion(
-                    system_prompt=system_prompt,
-                    user=full_prompt,
-                    temperature=temperature,
-                    max_tokens=2048)
-                    
-                print(f"{SUCCESS_COLOR}Response received from Llama server.{Colors.RESET}")
-                cleaned_response = self._clean_json_response(response_text)
+    def astream_one_shot(
+        self,
+        pydantic_model: Type[T],
+        prompt: Optional[str] = None,
+        language: Optional[str] = None,
+        retries: int = RETRIES,
+        delay: int = 0,
+        system_prompt: str = "",
+        temperature: float = 0.7,
+        stream_field: str = "answer",
+        cacheable: Optional[bool] = None,
+    ) -> AsyncIterator[Union[AgentDelta, T]]:
+        """
+        Same as `agenerate_one_shot`, but streams the value of `stream_field` as it is generated.
+
+        Yields:
+            AgentDelta pieces of `stream_field` (reset=True when a failed attempt is retried),
+            then the instance of the Pydantic class as the last item.
+        """
+        request = self._one_shot_request(pydantic_model, prompt, language, system_prompt, temperature)
+        return self._run(request, pydantic_model, language, retries, delay, cacheable, stream_field)
+
+    def _job_request(self, job: GenerationJob) -> dict:
+        if job.payload is not None:
+            return self._payload_request(job.payload, job.pydantic_model, job.language, job.system_prompt, job.context,
+                                         job.temperature)
+        return self._one_shot_request(job.pydantic_model, job.prompt, job.language, job.system_prompt, job.temperature)
+
+    def _batch(self, jobs: Iterable[Union[GenerationJob, Tuple[str, Type[BaseModel]]]],
+               concurrency: Optional[int]) -> Tuple[List[GenerationResult], int]:
+        results = [GenerationResult(i, job if isinstance(job, GenerationJob) else GenerationJob(job[1], prompt=job[0]))
+                   for i, job in enumerate(jobs)]
+        # more in flight than the scheduler runs at once would only wait in its queue
+        concurrency = max(1, min(concurrency or self.scheduler.max_concurrency, len(results) or 1))
+        print(f"{HEADER_COLOR}Batch of {len(results)} LLM jobs{Colors.RESET}, concurrency {concurrency}")
+        return results, concurrency
+
+    def _finish_job(self, item: GenerationResult, started: float):
+        item.duration_ms = (time.perf_counter() - started) * 1000
+        item.output_tokens = item.usage.total.completion_tokens
+        if item.result is not None and item.usage.total.llm_calls and not item.output_tokens:
+            # the backend didn't report usage (a cache hit makes no calls and generates nothing)
+            item.output_tokens = self.token_counter.count(item.result.model_dump_json())
+        if item.result is None:
+            print(f"{ERROR_COLOR}Batch job {item.index} ({item.job.pydantic_model.__name__}) failed: {item.error}{Colors.RESET}")
+
+    def _report(self, results: List[GenerationResult], started: float, concurrency: int) -> BatchReport:
+        report = BatchReport(results, time.perf_counter() - started, concurrency)
+        print(f"{SUCCESS_COLOR}Batch done:{Colors.RESET} {report}")
+        return report
+
+    def generate_many(self,
+                      jobs: Sequence[Union[GenerationJob, Tuple[str, Type[BaseModel]]]],
+                      concurrency: Optional[int] = None,
+                      retries: int = RETRIES,
+                      priority: int = BACKGROUND) -> BatchReport:
+        """
+        Blocking `agenerate_many` for scripts: runs the batch in its own event loop, so it must
+        not be called from a running one (await `agenerate_many` there).
+        """
+        return asyncio.run(self.agenerate_many(jobs, concurrency, retries, priority))
+
+    async def agenerate_many(self,
+                             jobs: Sequence[Union[GenerationJob, Tuple[str, Type[BaseModel]]]],
+                             concurrency: Optional[int] = None,
+                             retries: int = RETRIES,
+                             priority: int = BACKGROUND) -> BatchReport:
+        """
+        Runs independent structured-generation jobs concurrently, for offline work (re-summarizing
+        documents, replaying an evaluation set). `generate_many` is the blocking version.
+
+        Args:
+            jobs: GenerationJob objects or (prompt, pydantic_model) pairs.
+            concurrency: Jobs in flight at once; by default what the scheduler runs at once
+                (llama-server slots of all replicas, or the cloud concurrency limit).
+            retries: Attempts per job, as in `agenerate_one_shot`. A job that still fails gets its
+                error in the result, the rest of the batch goes on.
+            priority: Scheduler priority of the jobs (background by default, so chat turns go first).
+
+        Returns:
+            BatchReport with the results in input order, output tokens and tokens/sec.
+        """
+        results, concurrency = self._batch(jobs, concurrency)
+        started = time.perf_counter()
+        pending = iter(results)
+
+        async def worker():
+            # `concurrency` workers share one iterator: no task per job for large batches
+            set_priority(priority)
+            for item in pending:
+                current_usage.set(item.usage)
+                job_started = time.perf_counter()
                 try:
-                    parsed_data = json.loads(cleaned_response)
-                    print(parsed_data)
-                except json.JSONDecodeError as e:
-                    print(f"{ERROR_COLOR}Error decoding JSON: {e}{Colors.RESET}")
-                    print(f"{WARNING_COLOR}Cleaned Response that failed parsing:{Colors.RESET}")
-                    print(cleaned_response)
-                    raise e
-                return pydantic_model(**parsed_data)
-            except (requests.exceptions.RequestException, json.JSONDecodeError, ValidationError, ValueError) as e:
-                print(
-                    f"Error processing response (attempt {i + 1}/{retries}): {e}"
-                )
-                if i < retries - 1:
-                    print(f"Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                else:
-                    raise e
-        raise Exception("Failed to generate object after multiple retries.")
-    
+                    item.result = await self._agenerate(self._job_request(item.job), item.job.pydantic_model,
+                                                        item.job.language, retries, 0, item.job.cacheable)
+                except Exception as e:
+                    item.error = e
+                self._finish_job(item, job_started)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return self._report(results, started, concurrency)
+
     def get_model_info(self):
         return self.model
         
     def _get_model_from_server(self):
         try:
-            response = requests.get(f"{self.base}/v1/models", timeout=5)
+            response = get_client("llama").get(f"{self.base}/v1/models", timeout=5)
             response.raise_for_status()
             models = response.json().get("data", [])
             if models:
                 return models[0]["id"][models[0]["id"].rfind("\\") + 1:]
             return "No models found"
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"Error fetching models from server: {e}")
             return "Not available"
         
\ No newline at end of file
@@ -1,10 +1,17 @@
+import asyncio
 import os
-from typing import Optional, List
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Optional, List
 from google import genai
 from google.genai import types
 from pydantic import BaseModel, Field
-from app.colors import INFO_COLOR, Colors
+from app.colors import ERROR_COLOR, INFO_COLOR, Colors
+from app.http_pool import get_async_client, get_client
+from app.llm_log import llm_log
+from app.metrics import metrics
 from app.schemas import LLamaMessageHistory
+from app.usage import record_llm_usage
 
 # --- Main Class ---
 
@@ -24,6 +31,9 @@ class GoogleGenAI:
             raise ValueError("GEMINI_API_KEY environment variable not set.")
         self.client = genai.Client(
             api_key=api_key,
+            # reuse the pooled keep-alive connection instead of a client-private one
+            http_options=types.HttpOptions(httpx_client=get_client("gemini"),
+                                           httpx_async_client=get_async_client("gemini")),
         )
         
         self.model_name = os.getenv("GEMINI_MODEL")
@@ -31,24 +41,9 @@ class GoogleGenAI:
     def get_model(self):
         return self.model_name
     
-    def complete(self,
-                 system_prompt: Optional[str] = None,
-                 user: Optional[str] = None,
-                 temperature: Optional[float] = 0.7,
-                 max_tokens: Optional[int] = 1024,
-                 payload: Optional[LLamaMessageHistory] = None) -> str:
+    def _request(self, system_prompt, user, temperature, max_tokens, payload, json_schema=None):
         """
-        Generates a response from the Gemini model.
-
-        Args:
-            system_prompt: The system instruction or context.
-            user: The user's prompt (used if payload is not provided).
-            temperature: The sampling temperature.
-            max_tokens: The maximum number of tokens to generate.
-            payload: A message history object.
-
-        Returns:
-            The generated text response from the model.
+        Builds the Gemini contents and generation config from a prompt or a message history.
         """
         system_prompt = system_prompt or ""
         
@@ -80,27 +75,92 @@ class GoogleGenAI:
             genai.types.Part.from_text(text=system_prompt),
         ],
         )
-        
-        print("Contents sent to Gemini model:")
+        if json_schema is not None:
+            # Gemini structured output: the response is constrained to the schema
+            generation_config.response_mime_type = "application/json"
+            generation_config.response_json_schema = json_schema
+        return contents, generation_config
+
+    def _log_response(self, contents, generation_config, text: Optional[str], mode: str, started: float,
+                      error: Optional[BaseException] = None):
+        llm_log.log("gemini", request={"contents": contents, "config": generation_config}, response=text, error=error,
+                    model=self.model_name, mode=mode, duration_ms=round((time.perf_counter() - started) * 1000, 1))
+
+    def _record_usage(self, usage_metadata, started: float):
+        # token counts of the whole call come with the last streamed chunk
+        usage_metadata = usage_metadata or types.GenerateContentResponseUsageMetadata()
+        record_llm_usage("gemini", (time.perf_counter() - started) * 1000,
+                         prompt_tokens=usage_metadata.prompt_token_count or 0,
+                         completion_tokens=usage_metadata.candidates_token_count or 0,
+                         cached_tokens=usage_metadata.cached_content_token_count or 0)
+
+    async def acomplete(self,
+                        system_prompt: Optional[str] = None,
+                        user: Optional[str] = None,
+                        temperature: Optional[float] = 0.7,
+                        max_tokens: Optional[int] = 1024,
+                        payload: Optional[LLamaMessageHistory] = None,
+                        json_schema: Optional[dict] = None) -> str:
+        """
+        Generates a response from the Gemini model (`client.aio`, pooled `httpx.AsyncClient`).
+
+        Args:
+            system_prompt: The system instruction or context.
+            user: The user's prompt (used if payload is not provided).
+            temperature: The sampling temperature.
+            max_tokens: The maximum number of tokens to generate.
+            payload: A message history object.
+            json_schema: JSON schema for Gemini structured output.
+
+        Returns:
+            The generated text response from the model.
+
+        Raises:
+            google.genai.errors.APIError, httpx.HTTPError; retries are up to the caller.
+        """
+        try:
+            text = "".join([delta async for delta in self.astream(system_prompt, user, temperature, max_tokens, payload, json_schema)])
+        except Exception as e:
+            print(f"{ERROR_COLOR}Error during Gemini model call: {e}{Colors.RESET}")
+            raise
+        print(f"{INFO_COLOR}Response from {self.__class__.__name__}:{Colors.RESET} {len(text)} chars")
+        return text
+
+    async def astream(self,
+                      system_prompt: Optional[str] = None,
+                      user: Optional[str] = None,
+                      temperature: Optional[float] = 0.7,
+                      max_tokens: Optional[int] = 1024,
+                      payload: Optional[LLamaMessageHistory] = None,
+                      json_schema: Optional[dict] = None) -> AsyncIterator[str]:
+        """
+        Same as `acomplete`, but yields the text of each streamed chunk as it arrives.
+
+        Yields:
+            Generated text deltas.
+        """
+        contents, generation_config = self._request(system_prompt, user, temperature, max_tokens, payload, json_schema)
+        started = time.perf_counter()
+        text = ""
+        usage_metadata = None
         try:
-            text = ""
-            print(f"{INFO_COLOR}Response from {self.__class__.__name__}:{Colors.RESET}")
-            for chunk in self.client.models.generate_content_stream(
+            # aclosing: a cancelled stream closes its HTTP response right away, not when collected
+            async with aclosing(await self.client.aio.models.generate_content_stream(
                 model=self.model_name, # type: ignore
                 contents=contents, # type: ignore
                 config=generation_config,
-            ):
-                print(chunk.text, end="")
-                if chunk.text: text += chunk.text
-            with open("./storage/dev/response.txt", "a", encoding="utf-8") as f:
-                f.write("\n" + "-" * 10)
-                f.write(str(text))
-                f.write("\n" + "-" * 10)
-                
-            print(f"Response from Gemini model: {text}")
-            return text
+            )) as chunks:
+                async for chunk in chunks:
+                    usage_metadata = chunk.usage_metadata or usage_metadata
+                    if chunk.text:
+                        text += chunk.text
+                        yield chunk.text
+        except (asyncio.CancelledError, GeneratorExit) as e:
+            metrics.inc("llm_calls_cancelled", backend="gemini")
+            self._log_response(contents, generation_config, text, "stream", started, error=e)
+            raise
         except Exception as e:
-            # Basic error handling
-            print(f"Error during Gemini model call: {e}")
-            return f"An error occurred: {e}"
-
+            self._log_response(contents, generation_config, text, "stream", started, error=e)
+            raise
+        self._record_usage(usage_metadata, started)
+        self._log_response(contents, generation_config, text, "stream", started)
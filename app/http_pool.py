@@ -0,0 +1,158 @@
+import asyncio
+import os
+import threading
+from typing import Dict, Optional
+
+import httpx
+
+from app.colors import INFO_COLOR, Colors
+
+try:
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+HTTP_CONNECT_TIMEOUT_S = float(os.getenv("HTTP_CONNECT_TIMEOUT_S", "5"))
+HTTP_READ_TIMEOUT_S = float(os.getenv("HTTP_READ_TIMEOUT_S", "300"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "10"))
+HTTP_KEEPALIVE_EXPIRY_S = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_S", "60"))
+
+
+class HttpPool:
+    """
+    Shared, long-lived httpx clients, one per backend ("llama", "embed", "openrouter", "gemini", "mcp"),
+    in a sync (`client`) and an asyncio (`async_client`) flavour with the same settings.
+
+    Every backend gets its own connection pool with keep-alive, its own connection limit and
+    timeouts, and HTTP/2 when it is enabled for the backend and `h2` is installed. Clients are
+    created on first use, so API clients can be constructed before the pool is configured.
+    After a fork (bulk import workers) the clients are recreated instead of sharing the
+    parent's sockets.
+    """
+
+    def __init__(self,
+                 connect_timeout: float = HTTP_CONNECT_TIMEOUT_S,
+                 read_timeout: float = HTTP_READ_TIMEOUT_S,
+                 max_connections: int = HTTP_MAX_CONNECTIONS):
+        """
+        :param connect_timeout: Default connect timeout, seconds.
+        :param read_timeout: Default read timeout, seconds.
+        :param max_connections: Default max connections per backend.
+        """
+        self.defaults = dict(connect_timeout=connect_timeout, read_timeout=read_timeout,
+                             max_connections=max_connections, http2=False)
+        self._config: Dict[str, dict] = {}
+        self._clients: Dict[str, httpx.Client] = {}
+        self._async_clients: Dict[str, httpx.AsyncClient] = {}
+        self._async_loops: Dict[str, Optional[asyncio.AbstractEventLoop]] = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def configure(self, name: str, **options):
+        """
+        Sets options of a backend: connect_timeout, read_timeout, max_connections, http2.
+        An already created client is replaced on next use.
+
+        :param name: Backend name.
+        """
+        unknown = set(options) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"Unknown HTTP pool options: {', '.join(sorted(unknown))}")
+        with self._lock:
+            self._config.setdefault(name, {}).update(options)
+            old = self._clients.pop(name, None)
+            self._async_clients.pop(name, None)  # not used yet at configuration time
+            self._async_loops.pop(name, None)
+        if old is not None:
+            old.close()
+
+    def client(self, name: str) -> httpx.Client:
+        """
+        Returns the shared client of a backend, creating it on first use.
+        """
+        client = self._clients.get(name)
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked child: the inherited connections belong to the parent
+                self._clients, self._pid = {}, os.getpid()
+            client = self._clients.get(name)
+            if client is None:
+                client = self._clients[name] = self._create(name)
+        return client
+
+    def async_client(self, name: str) -> httpx.AsyncClient:
+        """
+        Returns the shared asyncio client of a backend, creating it on first use.
+        Meant for the application's event loop; clients are not shared across loops, but a client
+        whose loop has been closed (an earlier `asyncio.run`, e.g. `Generator.generate_many`) is
+        replaced, its connections died with that loop. Callers that keep a client (the Gemini SDK)
+        hold on to the old one.
+        """
+        try:
+            loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        client = self._async_clients.get(name)
+        if client is None or self._async_loops.get(name) is not loop:
+            with self._lock:
+                client = self._async_clients.get(name)
+                owner = self._async_loops.get(name)
+                if client is None or (owner is not None and owner is not loop and owner.is_closed()):
+                    client = self._async_clients[name] = self._create(name, httpx.AsyncClient)
+                    self._async_loops[name] = loop
+                elif owner is None:
+                    # created outside a loop: it belongs to the first loop that uses it
+                    self._async_loops[name] = loop
+        return client
+
+    def _create(self, name: str, client_class=httpx.Client):
+        opts = {**self.defaults, **self._config.get(name, {})}
+        http2 = bool(opts["http2"]) and HTTP2_AVAILABLE
+        print(f"{INFO_COLOR}HTTP pool '{name}' ({client_class.__name__}): max_connections={opts['max_connections']}, "
+              f"timeouts={opts['connect_timeout']}s/{opts['read_timeout']}s, http2={http2}{Colors.RESET}")
+        return client_class(
+            http2=http2,
+            timeout=httpx.Timeout(opts["read_timeout"], connect=opts["connect_timeout"]),
+            limits=httpx.Limits(max_connections=opts["max_connections"],
+                                max_keepalive_connections=opts["max_connections"],
+                                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_S),
+        )
+
+    def close(self):
+        """
+        Closes all clients (on application shutdown).
+        """
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+    async def aclose(self):
+        """
+        Closes all clients, including the asyncio ones (on application shutdown).
+        """
+        self.close()
+        with self._lock:
+            clients, self._async_clients, self._async_loops = list(self._async_clients.values()), {}, {}
+        for client in clients:
+            await client.aclose()
+
+
+http_pool = HttpPool()
+
+
+def get_client(name: str) -> httpx.Client:
+    """
+    Shortcut for `http_pool.client(name)`.
+    """
+    return http_pool.client(name)
+
+
+def get_async_client(name: str) -> httpx.AsyncClient:
+    """
+    Shortcut for `http_pool.async_client(name)`.
+    """
+    return http_pool.async_client(name)
@@ -1,32 +1,24 @@
 # app/ingest.py
 from __future__ import annotations
-import os, re
-from typing import List
+import codecs, io, mmap, os, re, zipfile
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 import pdfplumber
+from lxml import etree
 from bs4 import BeautifulSoup
+from bs4.dammit import EntitySubstitution, UnicodeDammit
 from docx import Document as DocxDocument
 import chardet
 
 # --------- простая, без NLTK, токенизация/чанкинг ---------
 
-# Разделяем по . ! ? … или ... , с возможными завершающими кавычками/скобками
-# и допускаем кавычки/скобки/пробелы перед началом следующего предложения.
-_SENT_SPLIT = re.compile(
-    r"""                # конец предложения:
-        (?:
-            (?<!\b[А-ЯA-Z]\.)   # простая защита от инициалов "И." (эвристика)
-            (?<!\b[А-ЯA-Z]\.[А-ЯA-Z]\.)  # "И.О."
-            (?<!\bт\.д) (?<!\bт\.п) (?<!\bи\.т\.д) (?<!\bи\.т\.п)  # популярные сокращения
-            (?<=[\.\!\?])       # обычные . ! ?
-            | (?<=\u2026)       # …
-            | (?<=\.\.\.)       # ...
-        )
-        [\"»”)\]]*              # завершающие кавычки/скобки
-        \s+                     # пробелы/перевод строки
-        (?=[^\s])               # затем что-то «начинается»
-    """,
-    flags=re.U | re.X
-)
+# Граница предложения: . ! ? или …, затем необязательные закрывающие кавычки/скобки,
+# пробелы/перевод строки и что-то «начинающееся». Без lookbehind-ов: регэксп только находит
+# кандидатов за один проход, а исключения (инициалы "И.", "И.О.") проверяются в Python.
+# Раньше исключения были lookbehind-ами прямо в регэкспе, результат разбиения тот же.
+_SENT_END = re.compile(r"""[.!?\u2026][\"»”)\]]*\s+(?=\S)""", flags=re.U)
+
+_INITIAL_CAPS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZАБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ")
 
 _WS = re.compile(r"[ \t\u00A0\u2000-\u200B\u202F\u205F\u3000]+")  # добавлены тонкие/узкие/идеографические пробелы
 
@@ -34,26 +26,53 @@ _LOW = r"[a-zа-яё]"
 
 _HYPHENS = r"[\-\u00AD\u2010\u2011]"
 
-def _split_sentences(text: str) -> List[str]:
+def _is_initial(text: str, end: int) -> bool:
+    """
+    True, если text[:end] оканчивается на инициал вида "И." (отдельная заглавная буква с точкой).
+    """
+    if end < 2 or text[end - 1] != "." or text[end - 2] not in _INITIAL_CAPS:
+        return False
+    if end == 2:
+        return True
+    prev = text[end - 3]
+    return not (prev.isalnum() or prev == "_")
+
+
+def _split_sentences_ex(text: str) -> Tuple[List[str], bool]:
+    """
+    Разбивает текст на предложения за один линейный проход.
+    Второе значение — True, если использовался обычный (пунктуационный) режим:
+    такие предложения при склейке через пробел разбиваются обратно точно так же.
+    """
     # если предложений мало — режем по переносам
     if "\n" in text and len(text) < 2000:
         parts = [p.strip() for p in text.splitlines() if p.strip()]
-        return parts if len(parts) > 1 else [text.strip()]
+        return (parts if len(parts) > 1 else [text.strip()]), False
     # обычный режим
-    parts = _SENT_SPLIT.split(text)
-    parts = [p.strip() for p in parts if p and p.strip()]
-    return parts if parts else [text.strip()]
+    parts, start = [], 0
+    for m in _SENT_END.finditer(text):
+        end = m.start() + 1  # знак препинания остаётся в предложении
+        if _is_initial(text, end):
+            continue
+        p = text[start:end].strip()
+        if p:
+            parts.append(p)
+        start = m.end()
+    p = text[start:].strip()
+    if p:
+        parts.append(p)
+    return (parts if parts else [text.strip()]), True
 
-def extract_text_from_file(path: str, mime: str | None = None) -> str:
-    ext = os.path.splitext(path)[1].lower()
-    if ext == ".pdf":
-        return extract_pdf(path)
-    if ext == ".docx" or (mime and "wordprocessingml" in mime):
-        return extract_docx(path)
-    if ext in [".html", ".htm"]:
-        return extract_html(path)
-    # всё остальное — как текст
-    return _read_text_best_effort(path)
+
+def _split_sentences(text: str) -> List[str]:
+    return _split_sentences_ex(text)[0]
+
+def extract_text_from_file(path: str, mime: str | None = None, engine: str | None = None) -> str:
+    """
+    Извлекает текст из файла; результат уже нормализован (normalize_text).
+    engine — движок из EXTRACTORS (по умолчанию INGEST_EXTRACTOR_ENGINE).
+    """
+    return get_extractor(detect_format(path, mime), engine)(path)
 
 
 def _dehyphenate_lines(text: str) -> str:
@@ -85,35 +104,77 @@ def extract_pdf(path: str) -> str:
     return normalize_text(text)
 
 
-def _read_text_best_effort(path: str) -> str:
-    with open(path, "rb") as f:
-        raw_data = f.read()
+# Большие текстовые файлы читаем через mmap блоками: память ограничена размером результата,
+# а кодировку угадываем по выборке, а не по всему файлу.
+_DECODE_BLOCK = 1 << 20
+_DETECT_SAMPLE = 32 * 1024  # байт из начала, середины и конца файла для chardet
 
-    # 1. Try UTF-8 first, as it's most common
-    try:
-        return raw_data.decode("utf-8")
-    except UnicodeDecodeError:
-        pass
 
-    # 2. If UTF-8 fails, use chardet
-    detection = chardet.detect(raw_data)
-    encoding = detection.get("encoding")
-    
-    if encoding:
-        try:
-            return raw_data.decode(encoding)
-        except (UnicodeDecodeError, TypeError):
-            pass # It failed, so we'll try other encodings
+def _sample(mm) -> bytes:
+    n = len(mm)
+    if n <= 3 * _DETECT_SAMPLE:
+        return mm[:]
+    mid = n // 2
+    return mm[:_DETECT_SAMPLE] + mm[mid:mid + _DETECT_SAMPLE] + mm[n - _DETECT_SAMPLE:]
+
 
-    # 3. Try common fallbacks
-    for enc in ("cp1251", "latin-1"):
+def _candidate_encodings(mm) -> List[str]:
+    """
+    Порядок попыток: UTF-8, затем то, что chardet нашёл по выборке, затем частые запасные.
+    """
+    candidates = ["utf-8"]
+    detected = chardet.detect(_sample(mm)).get("encoding")
+    if detected:
+        candidates.append(detected)
+    candidates += ["cp1251", "latin-1"]
+    seen, out = set(), []
+    for enc in candidates:
         try:
-            return raw_data.decode(enc)
-        except (UnicodeDecodeError, TypeError):
+            key = codecs.lookup(enc).name
+        except LookupError:
             continue
-    
-    # 4. Last resort
-    return raw_data.decode("utf-8", errors="ignore")
+        if key not in seen:
+            seen.add(key); out.append(enc)
+    return out
+
+
+def _iter_decoded(mm, encoding: str, errors: str = "strict") -> Iterator[str]:
+    """
+    Инкрементально декодирует mmap блоками; UnicodeDecodeError всплывает на первом битом блоке.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    n = len(mm)
+    for i in range(0, n, _DECODE_BLOCK):
+        yield decoder.decode(mm[i:i + _DECODE_BLOCK], final=i + _DECODE_BLOCK >= n)
+
+
+def _read_blocks(path: str, consume: Callable[[Iterator[str]], str]) -> str:
+    """
+    Открывает файл через mmap и отдаёт поток декодированных блоков в consume.
+    Кодировка подтверждается по ходу декодирования: если кандидат ломается на середине,
+    результат отбрасывается и поток перезапускается со следующим кандидатом.
+    """
+    if os.path.getsize(path) == 0:
+        return consume(iter(()))
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for enc in _candidate_encodings(mm):
+            try:
+                return consume(_iter_decoded(mm, enc))
+            except UnicodeDecodeError:
+                continue
+        # последний шанс
+        return consume(_iter_decoded(mm, "utf-8", errors="ignore"))
+
+
+def _read_text_best_effort(path: str) -> str:
+    return _read_blocks(path, "".join)
+
+
+def _read_text_normalized(path: str) -> str:
+    """
+    То же, что normalize_text(_read_text_best_effort(path)), но без промежуточных копий всего текста.
+    """
+    return _read_blocks(path, normalize_blocks)
 
 
 
@@ -157,7 +218,261 @@ def extract_html(path: str) -> str:
         tag.extract()
     text = soup.get_text("\n")
     lines = [l.strip() for l in text.splitlines() if l.strip()]
-    return "\n".join(lines)
+    return normalize_text("\n".join(lines))
+
+
+# --------- потоковые движки извлечения (без построения DOM) ---------
+
+# Теги, текст внутри которых BeautifulSoup не отдаёт в get_text(): script/style/noscript мы вырезаем сами,
+# а rt/rp/template bs4 хранит как особые строки, которые get_text() пропускает.
+_HTML_SKIP = frozenset(["script", "style", "noscript", "rt", "rp", "template"])
+_HTML_VOID = frozenset([
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta",
+    "param", "source", "track", "wbr", "basefont", "bgsound", "command", "frame", "image", "isindex",
+    "nextid", "spacer",
+])
+
+
+class _HtmlTextParser(HTMLParser):
+    """
+    Потоковый аналог extract_html: вместо дерева держит только стек открытых тегов
+    и повторяет правила BeautifulSoup (html.parser) — где кончается строка, какие теги
+    закрываются и чей текст попадает в get_text("\n").
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack: List[str] = []
+        self.skip = 0              # сколько тегов из _HTML_SKIP сейчас открыто
+        self.cut = 0               # сколько script/style/noscript открыто (их вырезаем целиком, даже CDATA)
+        self.closed_void: Dict[str, int] = {}  # void-теги без своего "</tag>" (у bs4 — список)
+        self.buf: List[str] = []
+        self.lines: List[str] = []
+
+    def _add(self, text: str):
+        for line in text.splitlines():
+            line = line.strip()
+            if line:
+                self.lines.append(line)
+
+    def flush(self):
+        if self.buf:
+            if not self.skip:
+                self._add("".join(self.buf))
+            self.buf = []
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        if tag in _HTML_VOID:
+            self.closed_void[tag] = self.closed_void.get(tag, 0) + 1
+            return
+        self.stack.append(tag)
+        if tag in _HTML_SKIP:
+            self.skip += 1
+            self.cut += tag in ("script", "style", "noscript")
+
+    def handle_startendtag(self, tag, attrs):
+        self.flush()
+
+    def handle_endtag(self, tag):
+        if self.closed_void.get(tag):
+            # bs4 игнорирует "</br>" после "<br>" целиком, даже не заканчивая текущую строку
+            self.closed_void[tag] -= 1
+            return
+        self.flush()
+        if tag not in self.stack:
+            return
+        while True:
+            top = self.stack.pop()
+            if top in _HTML_SKIP:
+                self.skip -= 1
+                self.cut -= top in ("script", "style", "noscript")
+            if top == tag:
+                break
+
+    def handle_data(self, data):
+        self.buf.append(data)
+
+    def handle_charref(self, name):
+        # та же расшифровка, что у bs4: 128–159 как windows-1252, мусор после цифр — обычный текст
+        base, digits = (16, name[1:]) if name[:1] in "xX" else (10, name)
+        extra = ""
+        try:
+            code = int(digits, base)
+        except ValueError:
+            m = re.match(r"([0-9a-f]+)(.*)" if base == 16 else r"([0-9]+)(.*)", digits)
+            if m is None:
+                self.buf.append(digits)
+                return
+            code, extra = int(m.group(1), base), m.group(2)
+        self.buf.append(UnicodeDammit.numeric_character_reference(code)[0] + extra)
+
+    def handle_entityref(self, name):
+        self.buf.append(EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name, f"&{name}"))
+
+    def handle_comment(self, data):
+        self.flush()
+
+    def handle_decl(self, decl):
+        self.flush()
+
+    def handle_pi(self, data):
+        self.flush()
+
+    def unknown_decl(self, data):
+        self.flush()
+        if data.upper().startswith("CDATA[") and not self.cut:
+            self._add(data[len("CDATA["):])
+
+
+def _html_text(markup: str) -> str:
+    parser = _HtmlTextParser()
+    # Один feed() на весь документ: на битой разметке ("&#;", оборванные теги) html.parser
+    # разбирает по-разному в зависимости от того, где прошла граница между вызовами feed().
+    parser.feed(markup)
+    parser.close()
+    parser.flush()
+    return normalize_text("\n".join(parser.lines))
+
+
+def extract_html_stream(path: str) -> str:
+    """
+    То же, что extract_html, но без DOM: текст разбирается потоком событий html.parser,
+    в памяти только исходная строка и стек открытых тегов.
+    """
+    return _html_text(_read_text_best_effort(path))
+
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P, _W_TBL, _W_TR, _W_TC, _W_R, _W_HYPERLINK = (_W + t for t in ("p", "tbl", "tr", "tc", "r", "hyperlink"))
+_W_VAL = _W + "val"
+# Текстовые эквиваленты содержимого w:r — как у python-docx (Run.text).
+_W_RUN_TEXT = {_W + "tab": "\t", _W + "ptab": "\t", _W + "cr": "\n", _W + "noBreakHyphen": "-"}
+_DOCX_MAIN_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+
+
+def _docx_run_text(r, out: List[str]):
+    for e in r:
+        tag = e.tag
+        if tag == _W + "t":
+            out.append(e.text or "")
+        elif tag == _W + "br":
+            if e.get(_W + "type", "textWrapping") == "textWrapping":
+                out.append("\n")
+        else:
+            t = _W_RUN_TEXT.get(tag)
+            if t:
+                out.append(t)
+
+
+def _docx_par_text(p) -> str:
+    out: List[str] = []
+    for child in p:
+        if child.tag == _W_R:
+            _docx_run_text(child, out)
+        elif child.tag == _W_HYPERLINK:
+            for r in child.iterchildren(_W_R):
+                _docx_run_text(r, out)
+    return "".join(out).strip()
+
+
+def _docx_int(parent, path: str, default: int) -> int:
+    e = parent.find(path) if parent is not None else None
+    try:
+        return int(e.get(_W_VAL)) if e is not None else default
+    except (TypeError, ValueError):
+        return default
+
+
+def _docx_table_lines(tbl) -> Iterator[str]:
+    """
+    Строки таблицы как "c1 | c2 | c3" — по правилам python-docx row.cells: ячейка с gridSpan
+    повторяется по числу колонок, продолжение вертикального объединения берёт ячейку сверху.
+    """
+    above: dict = {}  # смещение в сетке -> ячейки, выданные строкой выше
+    for tr in tbl.iterchildren(_W_TR):
+        row: dict = {}
+        cells: List[str] = []
+        offset = _docx_int(tr.find(_W + "trPr"), _W + "gridBefore", 0)
+        for tc in tr.iterchildren(_W_TC):
+            tc_pr = tc.find(_W + "tcPr")
+            span = _docx_int(tc_pr, _W + "gridSpan", 1)
+            vmerge = tc_pr.find(_W + "vMerge") if tc_pr is not None else None
+            if vmerge is not None and vmerge.get(_W_VAL, "continue") == "continue":
+                texts = above.get(offset) or [""] * span
+            else:
+                text = "\n".join(t for t in map(_docx_par_text, tc.iterchildren(_W_P)) if t).strip()
+                texts = [text] * span
+            row[offset] = texts
+            cells.extend(texts)
+            offset += span
+        above = row
+        if any(cells):
+            yield " | ".join(cells)
+
+
+def _docx_main_part(zf: zipfile.ZipFile) -> str:
+    try:
+        rels = etree.fromstring(zf.read("_rels/.rels"))
+        for rel in rels:
+            if rel.get("Type") == _DOCX_MAIN_REL:
+                return rel.get("Target").lstrip("/")
+    except (KeyError, etree.XMLSyntaxError):
+        pass
+    return "word/document.xml"
+
+
+def extract_docx_stream(path: str) -> str:
+    """
+    То же, что extract_docx, но через iterparse по word/document.xml: каждый абзац и таблица
+    верхнего уровня обрабатываются сразу после разбора и выбрасываются из дерева.
+    """
+    paragraphs: List[str] = []
+    tables: List[str] = []
+    with zipfile.ZipFile(path) as zf, zf.open(_docx_main_part(zf)) as f:
+        for _, elem in etree.iterparse(f, events=("end",), tag=(_W_P, _W_TBL), huge_tree=True):
+            body = elem.getparent()
+            if body is None or body.tag != _W + "body":
+                continue  # вложенные абзацы/таблицы разберём вместе с их таблицей
+            if elem.tag == _W_P:
+                t = _docx_par_text(elem)
+                if t:
+                    paragraphs.append(t)
+            else:
+                tables.extend(_docx_table_lines(elem))
+            elem.clear()
+            while elem.getprevious() is not None:
+                del body[0]
+    return normalize_text("\n".join(paragraphs + tables))
+
+
+# Реестр движков: формат -> {движок -> функция}. "dom" — BeautifulSoup/python-docx, "stream" — потоковые.
+# Движок выбирается INGEST_EXTRACTOR_ENGINE; если у формата такого нет — берётся единственный имеющийся.
+EXTRACTORS = {
+    "pdf": {"dom": extract_pdf},
+    "docx": {"dom": extract_docx, "stream": extract_docx_stream},
+    "html": {"dom": extract_html, "stream": extract_html_stream},
+    "text": {"stream": _read_text_normalized},
+}
+EXTRACTOR_ENGINE = os.getenv("INGEST_EXTRACTOR_ENGINE", "stream")
+
+
+def get_extractor(fmt: str, engine: str | None = None) -> Callable[[str], str]:
+    engines = EXTRACTORS[fmt]
+    return engines.get(engine or EXTRACTOR_ENGINE) or next(iter(engines.values()))
+
+
+def detect_format(path: str, mime: str | None = None) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        return "pdf"
+    if ext == ".docx" or (mime and "wordprocessingml" in mime):
+        return "docx"
+    if ext in [".html", ".htm"]:
+        return "html"
+    # всё остальное — как текст
+    return "text"
+
 
 def normalize_text(text: str) -> str:
     text = text.replace("\r\n", "\n").replace("\r", "\n")
@@ -172,27 +487,167 @@ def normalize_text(text: str) -> str:
             out.append(l); blank = False
     return "\n".join(out).strip()
 
+def normalize_blocks(blocks: Iterable[str]) -> str:
+    """
+    Потоковый вариант normalize_text: принимает текст блоками произвольной длины
+    и даёт тот же результат, что normalize_text("".join(blocks)).
+    """
+    out = io.StringIO()
+    started = blank = False
+
+    def emit(lines: List[str]):
+        nonlocal started, blank
+        for line in [_WS.sub(" ", l).strip() for l in lines]:
+            if not line:
+                blank = started
+                continue
+            if started:
+                out.write("\n\n" if blank else "\n")
+            out.write(line)
+            started, blank = True, False
+
+    partial: List[str] = []  # начало текущей строки, пришедшее в прошлых блоках
+    pending_cr = False
+    for block in blocks:
+        if pending_cr:
+            block = "\r" + block
+        pending_cr = block.endswith("\r")  # может оказаться половиной \r\n
+        if pending_cr:
+            block = block[:-1]
+        lines = block.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        partial.append(lines[0])
+        if len(lines) == 1:
+            continue
+        lines[0] = "".join(partial)
+        partial = [lines.pop()]
+        emit(lines)
+    if pending_cr:
+        emit(["".join(partial)]); partial = []
+    emit(["".join(partial)])
+    return out.getvalue()
+
 def chunk_text(text: str, chunk_size: int = 800, overlap: int = 120) -> List[str]:
-    # chunk_size и overlap считаем в словах
-    sents = _split_sentences(text)
-    chunks, cur, cur_len = [], [], 0
+    # chunk_size и overlap считаем в словах.
+    # Один проход: длины предложений в словах считаются один раз, хвост для перекрытия
+    # (последние одно-два предложения) берётся из уже известных границ, а не повторным разбиением.
+    sents, regex_mode = _split_sentences_ex(text)
+    chunks: List[str] = []
+    cur: List[str] = []      # предложения текущего чанка
+    lens: List[int] = []     # их длины в словах
+    cur_len = 0
+    atomic = regex_mode      # разбиение склейки cur совпадёт с самим cur
     for s in sents:
         slen = len(s.split())
         if cur and cur_len + slen > chunk_size:
-            joined = " ".join(cur).strip()
-            if joined:
-                chunks.append(joined)
+            joined = " ".join(cur)
+            chunks.append(joined)
             if overlap > 0:
                 # возьмём хвост из последнего предложения (или двух), а не по словам
-                tail_sents = _split_sentences(joined)
-                tail = " ".join(tail_sents[-2:]) if len(tail_sents) >= 2 else (tail_sents[-1] if tail_sents else "")
-                cur, cur_len = ([tail] if tail else []), len(tail.split()) if tail else 0
+                if atomic and ("\n" not in joined or len(joined) >= 2000):
+                    cur, lens = cur[-2:], lens[-2:]
+                else:
+                    # склейка попадает в режим «по строкам» — границы не совпадают, переразбиваем
+                    tail_sents, tail_regex = _split_sentences_ex(joined)
+                    tail = " ".join(tail_sents[-2:])
+                    # дальше к хвосту добавятся предложения текста — они тоже должны быть «пунктуационными»
+                    atomic = tail_regex and regex_mode
+                    if atomic:
+                        cur = tail_sents[-2:]
+                        lens = [len(t.split()) for t in cur]
+                    else:
+                        cur, lens = [tail], [len(tail.split())]
+                cur_len = sum(lens)
             else:
-                cur, cur_len = [], 0
-        cur.append(s); cur_len += slen
+                cur, lens, cur_len, atomic = [], [], 0, regex_mode
+        cur.append(s); lens.append(slen); cur_len += slen
     if cur:
-        joined = " ".join(cur).strip()
-        if joined:
-            chunks.append(joined)
+        chunks.append(" ".join(cur))
     # фильтр совсем коротких
-    return [c for c in chunks if len(c.split()) >= 5]
\ No newline at end of file
+    return [c for c in chunks if len(c.split()) >= 5]
+
+def _fit_prefix(units: List[str], start: int, sep: str, max_tokens: int, count_tokens: Callable[[str], int]) -> int:
+    """
+    Бинарным поиском находит наибольшее end, при котором sep.join(units[start:end])
+    укладывается в max_tokens. Возвращает start, если не влезает даже один элемент.
+    """
+    lo, hi = start, len(units)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(sep.join(units[start:mid])) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _split_to_fit(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """
+    Режет слишком длинный фрагмент на куски по словам (а одно гигантское «слово» — по символам),
+    каждый из которых гарантированно не длиннее max_tokens.
+    """
+    words = text.split()
+    out, i = [], 0
+    while i < len(words):
+        end = _fit_prefix(words, i, " ", max_tokens, count_tokens)
+        if end > i:
+            out.append(" ".join(words[i:end]))
+            i = end
+            continue
+        # одно слово не влезает целиком (base64, длинные URL и т.п.)
+        chars, j = list(words[i]), 0
+        while j < len(chars):
+            cut = max(_fit_prefix(chars, j, "", max_tokens, count_tokens), j + 1)
+            out.append("".join(chars[j:cut]))
+            j = cut
+        i += 1
+    return out
+
+
+def chunk_text_by_tokens(text: str, max_tokens: int, overlap: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """
+    Токенный вариант chunk_text: max_tokens и overlap считаются в токенах модели эмбеддингов,
+    и ни один чанк не превышает max_tokens (иначе сервер эмбеддингов молча обрежет хвост).
+    Перекрытие — последние одно-два предложения, если они помещаются в overlap.
+    """
+    pieces = []
+    for s in _split_sentences(text):
+        n = count_tokens(s)
+        if n <= max_tokens:
+            pieces.append((s, n))
+        else:
+            pieces.extend((p, count_tokens(p)) for p in _split_to_fit(s, max_tokens, count_tokens))
+
+    chunks: List[str] = []
+    cur: List[tuple] = []
+    cur_len = 0
+    for s, n in pieces:
+        if cur and cur_len + n > max_tokens:
+            chunks.append(" ".join(p for p, _ in cur))
+            tail, tail_len = [], 0
+            if overlap > 0:
+                for p, pn in reversed(cur[-2:]):
+                    if tail_len + pn > overlap:
+                        break
+                    tail.insert(0, (p, pn)); tail_len += pn
+            if tail_len + n > max_tokens:
+                tail, tail_len = [], 0
+            cur, cur_len = tail, tail_len
+        cur.append((s, n)); cur_len += n
+    if cur:
+        chunks.append(" ".join(p for p, _ in cur))
+
+    # суммы по предложениям приблизительны (токены на стыках), поэтому проверяем склейку целиком
+    fitted: List[str] = []
+    for c in chunks:
+        if count_tokens(c) <= max_tokens:
+            fitted.append(c)
+        else:
+            fitted.extend(_split_to_fit(c, max_tokens, count_tokens))
+    return [c for c in fitted if len(c.split()) >= 5]
+
+
+def count_overflowing(chunks: List[str], max_tokens: int, count_tokens: Callable[[str], int]) -> int:
+    """
+    Сколько чанков не помещается в контекст модели эмбеддингов (их хвост не будет проиндексирован).
+    """
+    return sum(1 for c in chunks if count_tokens(c) > max_tokens)
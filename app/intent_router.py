@@ -0,0 +1,370 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from operator import mul
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app.colors import INFO_COLOR, WARNING_COLOR, Colors
+from app.embedding_client import EmbeddingClient
+from app.schemas import Thread
+
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER", "1") == "1"
+INTENT_ROUTER_PATH = os.getenv("INTENT_ROUTER_PATH", "./storage/intent_router.json")
+# Min margin between the best and the second best label to skip the LLM, when the calibration file has none
+INTENT_ROUTER_THRESHOLD = float(os.getenv("INTENT_ROUTER_THRESHOLD", "0.1"))
+INTENT_ROUTER_MAX_PROTOTYPES = int(os.getenv("INTENT_ROUTER_MAX_PROTOTYPES", "100"))
+
+RETRIEVE, NO_RETRIEVE, REWRITE = "retrieve", "no_retrieve", "rewrite"
+LABELS = (RETRIEVE, NO_RETRIEVE, REWRITE)
+
+# Labelled examples the router starts from; calibration adds the user's own turns
+SEED_PROTOTYPES: Dict[str, List[str]] = {
+    NO_RETRIEVE: [
+        "привет", "здравствуйте", "hi there", "hello", "спасибо", "спасибо, всё понятно", "thanks!",
+        "ок", "понятно", "пока", "как дела?", "кто ты?", "что ты умеешь?", "what can you do?",
+    ],
+    RETRIEVE: [
+        "что сказано в документе о сроках выполнения работ?",
+        "опиши по порядку содержание файла",
+        "какие требования указаны в техническом задании?",
+        "найди в документах информацию о бюджете проекта",
+        "перечисли основные выводы из отчёта",
+        "summarize the uploaded document",
+        "what does the report say about the test results?",
+        "какая точность измерений указана в пояснительной записке?",
+    ],
+    REWRITE: [
+        "а подробнее?", "а второй пункт?", "расскажи об этом больше", "а почему так?", "и что дальше?",
+        "а в нём что ещё есть?", "what about the other one?", "tell me more about it", "а это где написано?",
+    ],
+}
+
+# Words that point back at the conversation: the message can't be searched as is
+FOLLOW_UP_MARKERS = {
+    "это", "этот", "эта", "эти", "этого", "этом", "том", "тот", "та", "те", "того", "он", "она", "оно", "они",
+    "его", "её", "ее", "их", "нём", "нем", "ней", "них", "там", "тоже", "ещё", "еще", "подробнее", "дальше",
+    "it", "its", "this", "that", "these", "those", "they", "them", "there", "more", "above", "previous",
+}
+FOLLOW_UP_MAX_WORDS = 12
+# Score adjustments from non-embedding features
+DOC_NAME_BONUS = 0.15
+FOLLOW_UP_BONUS = 0.1
+TOP_N_SIMILARITIES = 3
+
+
+def query_terms(text: str) -> set:
+    # crude stemming: inflected forms of a word (especially in Russian) share the first 5 letters
+    return {word[:5] for word in re.findall(r"\w+", text.lower()) if len(word) > 3}
+
+
+def _normalize(vector: Sequence[float]) -> Optional[List[float]]:
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector] if norm else None
+
+
+class RouteDecision:
+    """
+    What the router decided for one turn.
+
+    `routed` is True when the LLM intent analysis can be skipped: the thread has no
+    documents, or the router is calibrated, the best label isn't `rewrite` and it wins by at
+    least the threshold.
+    """
+
+    def __init__(self, label: str, confidence: float, routed: bool, reason: str,
+                 scores: Optional[Dict[str, float]] = None, features: Optional[Dict[str, Any]] = None):
+        self.label = label
+        self.confidence = confidence
+        self.routed = routed
+        self.reason = reason
+        self.scores = scores or {}
+        self.features = features or {}
+
+    @property
+    def need_for_retrieval(self) -> bool:
+        return self.label == RETRIEVE
+
+    def __str__(self) -> str:
+        scores = ", ".join(f"{label} {score:.3f}" for label, score in self.scores.items())
+        return f"{self.label} ({self.reason}, confidence {self.confidence:.3f}; {scores})"
+
+
+class IntentRouter:
+    """
+    Decides retrieve / no-retrieve / needs-rewrite for a chat turn without an LLM call.
+
+    The user message is embedded and compared with labelled prototypes (mean of the top
+    cosine similarities per label). Query terms found in the names of the thread's documents
+    push towards `retrieve`; short messages with words pointing back at the conversation push
+    towards `rewrite`, which always goes to the LLM since the query has to be rewritten.
+    Confidence is the margin between the two best labels; below `threshold` the LLM decides.
+
+    Prototypes and the threshold come from `calibrate` (offline, from stored threads) and are
+    kept in `path`. Until they are loaded, every turn with documents goes to the LLM: the seed
+    prototypes alone are only the starting point of calibration, not a tested threshold.
+    """
+
+    def __init__(self,
+                 embedding_client: EmbeddingClient,
+                 path: Optional[str] = INTENT_ROUTER_PATH,
+                 threshold: Optional[float] = None,
+                 enabled: bool = INTENT_ROUTER_ENABLED):
+        """
+        :param embedding_client: Client of the embedding server (the one used for the documents).
+        :param path: JSON file with calibrated prototypes; empty or None keeps the seeds.
+        :param threshold: Overrides the confidence threshold (calibrated or INTENT_ROUTER_THRESHOLD).
+        :param enabled: False sends every turn with documents to the LLM (the stats still count them).
+        """
+        self.embedding_client = embedding_client
+        self.path = path or None
+        self.enabled = enabled
+        self.threshold = INTENT_ROUTER_THRESHOLD
+        self.calibration: Dict[str, Any] = {}
+        self.calibrated = False
+        self._texts: Dict[str, List[str]] = {label: list(texts) for label, texts in SEED_PROTOTYPES.items()}
+        self._vectors: Optional[Dict[str, List[Tuple[str, List[float]]]]] = None  # label -> (text, vector)
+        self._lock = threading.Lock()
+        self._stats = {"turns": 0, "no_documents": 0, "low_confidence": 0, "rewrite": 0, "disabled": 0, "uncalibrated": 0,
+                       "routed": {RETRIEVE: 0, NO_RETRIEVE: 0}, "llm_checked": 0, "llm_agreed": 0}
+        self.load()
+        if threshold is not None:
+            self.threshold = threshold
+        if self.enabled and self.path and not self.calibrated:
+            print(f"{WARNING_COLOR}Intent router: not calibrated, intent is decided by the LLM "
+                  f"(run python -m app.calibrate_intent_router){Colors.RESET}")
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            texts = {label: [p["text"] for p in data["prototypes"][label]] for label in LABELS}
+            vectors = {label: [(p["text"], _normalize(p["embedding"])) for p in data["prototypes"][label]]
+                       for label in LABELS}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"{WARNING_COLOR}Intent router: failed to load {self.path}, using seed prototypes: {e}{Colors.RESET}")
+            return
+        self._texts = texts
+        self._vectors = {label: [(t, v) for t, v in pairs if v] for label, pairs in vectors.items()}
+        self.threshold = float(data.get("threshold", self.threshold))
+        self.calibration = data.get("metrics", {})
+        self.calibrated = True
+        print(f"{INFO_COLOR}Intent router: {sum(len(t) for t in texts.values())} prototypes, "
+              f"threshold {self.threshold:.3f} from {self.path}{Colors.RESET}")
+
+    def _embed(self, texts: List[str]) -> List[Optional[List[float]]]:
+        return [_normalize(v) if v else None for v in self.embedding_client.embed_texts(texts)]
+
+    def _prototypes(self, exclude: Optional[str] = None) -> Optional[Dict[str, List[List[float]]]]:
+        """
+        Prototype vectors per label, embedded on first use.
+
+        :param exclude: Text whose prototypes are left out (leave-one-out calibration).
+        """
+        if self._vectors is None:
+            vectors = {label: list(zip(texts, self._embed(texts))) for label, texts in self._texts.items()}
+            if not all(any(v for _, v in pairs) for pairs in vectors.values()):
+                return None  # embedding server unavailable, try again next turn
+            self._vectors = {label: [(t, v) for t, v in pairs if v] for label, pairs in vectors.items()}  # type: ignore
+        return {label: [v for t, v in pairs if t != exclude] for label, pairs in self._vectors.items()}
+
+    def route(self, thread: Thread, document_names: Sequence[str] = ()) -> RouteDecision:
+        """
+        Decides the turn whose user message is the last one of the thread's history.
+
+        :param document_names: Names of the thread's documents.
+        """
+        if not thread.document_ids:
+            # user_query only retrieves from the thread's documents
+            decision = RouteDecision(NO_RETRIEVE, 1.0, True, "no documents")
+        elif not self.enabled:
+            decision = RouteDecision(RETRIEVE, 0.0, False, "disabled")
+        elif not self.calibrated:
+            decision = RouteDecision(RETRIEVE, 0.0, False, "uncalibrated")
+        else:
+            message = thread.history[-1].content
+            embedding = (self._embed([message]) or [None])[0]
+            decision = self.classify(message, embedding, len(thread.history) > 1, document_names)
+        self._record(decision)
+        return decision
+
+    def classify(self, message: str, embedding: Optional[List[float]], has_history: bool,
+                 document_names: Sequence[str] = (),
+                 prototypes: Optional[Dict[str, List[List[float]]]] = None) -> RouteDecision:
+        """
+        Scores a message against the prototypes. Used by `route` and by calibration.
+
+        :param embedding: Normalized embedding of the message (None if embedding failed).
+        :param has_history: Whether the message has earlier messages in the thread.
+        :param prototypes: Prototype vectors to use instead of the router's own.
+        """
+        prototypes = prototypes or self._prototypes()
+        if embedding is None or not prototypes:
+            return RouteDecision(RETRIEVE, 0.0, False, "no embedding")
+        with self._lock:
+            if any(len(vs[0]) != len(embedding) for vs in prototypes.values() if vs):
+                # the embedding model changed since the prototypes were embedded
+                print(f"{WARNING_COLOR}Intent router: embedding size changed, re-embedding prototypes{Colors.RESET}")
+                self._vectors = None
+                prototypes = self._prototypes()
+                if not prototypes:
+                    return RouteDecision(RETRIEVE, 0.0, False, "no embedding")
+
+        scores: Dict[str, float] = {}
+        for label in LABELS:
+            similarities = sorted((sum(map(mul, embedding, v)) for v in prototypes[label]), reverse=True)
+            top = similarities[:TOP_N_SIMILARITIES]
+            scores[label] = sum(top) / len(top) if top else -1.0
+
+        terms = query_terms(message)
+        doc_overlap = bool(terms & set().union(*(query_terms(name) for name in document_names))) if document_names else False
+        words = re.findall(r"\w+", message.lower())
+        follow_up = has_history and len(words) <= FOLLOW_UP_MAX_WORDS and bool(FOLLOW_UP_MARKERS.intersection(words))
+        if doc_overlap:
+            scores[RETRIEVE] += DOC_NAME_BONUS
+        if not has_history:
+            scores[REWRITE] = -1.0  # nothing to resolve the message against
+        elif follow_up:
+            scores[REWRITE] += FOLLOW_UP_BONUS
+
+        ranked = sorted(scores, key=scores.get, reverse=True)  # type: ignore
+        label = ranked[0]
+        confidence = scores[ranked[0]] - scores[ranked[1]]
+        features = {"doc_overlap": doc_overlap, "follow_up": follow_up, "has_history": has_history, "words": len(words)}
+        if label == REWRITE:
+            return RouteDecision(label, confidence, False, "rewrite", scores, features)
+        if confidence < self.threshold:
+            return RouteDecision(label, confidence, False, "low confidence", scores, features)
+        return RouteDecision(label, confidence, True, "prototypes", scores, features)
+
+    def _record(self, decision: RouteDecision):
+        with self._lock:
+            self._stats["turns"] += 1
+            if decision.reason == "no documents":
+                self._stats["no_documents"] += 1
+            elif decision.routed:
+                self._stats["routed"][decision.label] += 1
+            elif decision.reason == "rewrite":
+                self._stats["rewrite"] += 1
+            elif decision.reason in ("disabled", "uncalibrated"):
+                self._stats[decision.reason] += 1
+            else:
+                self._stats["low_confidence"] += 1
+
+    def record_llm(self, decision: RouteDecision, need_for_retrieval: bool):
+        """
+        Compares a low-confidence guess with the LLM's answer, to see how the threshold behaves online.
+        """
+        if decision.label == REWRITE or decision.reason not in ("low confidence", "disabled"):
+            return
+        with self._lock:
+            self._stats["llm_checked"] += 1
+            self._stats["llm_agreed"] += int(decision.need_for_retrieval == need_for_retrieval)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Decision counters since start; skip rate is the share of turns answered without the intent LLM call.
+        """
+        with self._lock:
+            stats = {**self._stats, "routed": dict(self._stats["routed"])}
+        skipped = stats["no_documents"] + sum(stats["routed"].values())
+        stats["skipped"] = skipped
+        stats["skip_rate"] = round(skipped / stats["turns"], 4) if stats["turns"] else 0.0
+        stats["llm_agreement"] = round(stats["llm_agreed"] / stats["llm_checked"], 4) if stats["llm_checked"] else None
+        stats.update(enabled=self.enabled, calibrated=self.calibrated, threshold=self.threshold,
+                     prototypes={label: len(texts) for label, texts in self._texts.items()},
+                     calibration=self.calibration)
+        return stats
+
+    def calibrate(self, threads: List[Thread], document_names: Dict[str, str],
+                  target_precision: float = 0.95,
+                  max_prototypes: int = INTENT_ROUTER_MAX_PROTOTYPES) -> Dict[str, Any]:
+        """
+        Builds prototypes from stored turns and picks the lowest threshold whose routed decisions
+        reach `target_precision` (leave-one-out, so a turn is never compared with itself).
+
+        A turn is labelled by what the agent did: an answer with `retrieved_docs` means retrieval,
+        an answer without them means none. Threads without documents are skipped. The `rewrite`
+        prototypes stay the seeds, since stored turns don't tell whether the query was rewritten.
+
+        :param threads: Stored threads.
+        :param document_names: Document id -> name.
+        :param target_precision: Required share of correct routed decisions.
+        :param max_prototypes: Max stored turns kept per label (the most recent ones).
+        :return: Calibration metrics; the result is applied to the router (see `save`).
+        """
+        examples: List[Tuple[str, str, bool, List[str]]] = []  # (message, label, has_history, document names)
+        for thread in sorted(threads, key=lambda t: t.created_at):
+            if not thread.document_ids:
+                continue
+            names = [document_names[d] for d in thread.document_ids if d in document_names]
+            for i, message in enumerate(thread.history[:-1]):
+                answer = thread.history[i + 1]
+                if message.sender != "user" or answer.sender != "agent" or message.content.startswith("<internal>"):
+                    continue
+                label = RETRIEVE if getattr(answer, "retrieved_docs", None) is not None else NO_RETRIEVE
+                examples.append((message.content, label, i > 0, names))
+
+        for label in LABELS:
+            own = [e[0] for e in examples if e[1] == label][-max_prototypes:]
+            self._texts[label] = SEED_PROTOTYPES[label] + list(dict.fromkeys(own))
+        self._vectors = None
+        if self._prototypes() is None:
+            raise RuntimeError("Embedding server is not available.")
+
+        embeddings = self._embed([e[0] for e in examples])
+        saved_threshold, self.threshold = self.threshold, -math.inf
+        outcomes: List[Tuple[float, bool, bool, str, str]] = []  # (confidence, decidable, correct, label, guess)
+        for (message, label, has_history, names), embedding in zip(examples, embeddings):
+            # leave one out: the turn must not find itself among the prototypes
+            decision = self.classify(message, embedding, has_history, names, prototypes=self._prototypes(exclude=message))
+            outcomes.append((decision.confidence, decision.routed, decision.label == label, label, decision.label))
+        self.threshold = saved_threshold
+
+        threshold, precision, routed = None, None, 0
+        for candidate in sorted({o[0] for o in outcomes if o[1]}):
+            chosen = [o for o in outcomes if o[1] and o[0] >= candidate]
+            correct = sum(1 for o in chosen if o[2])
+            if chosen and correct / len(chosen) >= target_precision:
+                threshold, precision, routed = candidate, correct / len(chosen), len(chosen)
+                break
+        if threshold is None:
+            threshold = 1.0  # nothing reaches the precision: always ask the LLM
+        missed = sum(1 for o in outcomes if o[1] and o[0] >= threshold and o[3] == RETRIEVE and o[4] == NO_RETRIEVE)
+
+        self.threshold = threshold
+        self.calibration = {
+            "calibrated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "turns": len(examples),
+            "labels": {label: sum(1 for e in examples if e[1] == label) for label in (RETRIEVE, NO_RETRIEVE)},
+            "target_precision": target_precision,
+            "threshold": round(threshold, 4),
+            "precision": round(precision, 4) if precision is not None else None,
+            "skip_rate": round(routed / len(examples), 4) if examples else 0.0,
+            "missed_retrievals": missed,
+        }
+        self.calibrated = True
+        return self.calibration
+
+    def save(self, path: Optional[str] = None):
+        """
+        Writes prototypes (text and embedding), threshold and calibration metrics.
+        """
+        path = path or self.path
+        if not path or self._prototypes() is None:
+            raise RuntimeError("Nothing to save: no path or no prototype embeddings.")
+        data = {
+            "threshold": self.threshold,
+            "metrics": self.calibration,
+            "prototypes": {label: [{"text": text, "embedding": vector} for text, vector in pairs]
+                           for label, pairs in self._vectors.items()},  # type: ignore
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
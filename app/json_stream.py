@@ -0,0 +1,123 @@
+from typing import List, Optional
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonFieldStreamer:
+    """
+    Incremental, tolerant reader of a JSON object being generated token by token.
+
+    Feed it the raw text deltas of the model output; `feed` returns the newly decoded
+    characters of one top-level string field (e.g. `answer`) as soon as they arrive,
+    so the field can be shown to the user while the rest of the object is still being
+    generated. Everything else is only tracked, not decoded: the complete object is
+    still parsed and validated at the end (see Generator._parse_response).
+
+    Tolerates text before the object (code fences, "Here is the JSON:") and output cut
+    off mid-string; a field that is not a string is ignored.
+    """
+
+    def __init__(self, field: str = "answer"):
+        """
+        :param field: Name of the top-level string field to stream.
+        """
+        self.field = field
+        self.done = False          # the field's closing quote has been seen
+        self._started = False      # the opening "{" has been seen
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._is_key = False       # the current string is a key of the top-level object
+        self._expect_key = False
+        self._key: List[str] = []
+        self._last_key: Optional[str] = None
+        self._streaming = False    # inside the target field's value
+        self._unicode: Optional[str] = None  # hex digits of a pending \uXXXX escape
+        self._high_surrogate: Optional[int] = None
+
+    def feed(self, text: str) -> str:
+        """
+        Consumes the next piece of model output.
+
+        :param text: Raw text delta.
+        :return: Newly available characters of the streamed field (may be empty).
+        """
+        out: List[str] = []
+        for ch in text:
+            if not self._started:
+                if ch == "{":
+                    self._started, self._depth, self._expect_key = True, 1, True
+                continue
+            if self._in_str:
+                self._string_char(ch, out)
+            elif ch == '"':
+                self._in_str = True
+                self._is_key = self._depth == 1 and self._expect_key
+                self._key = []
+                self._streaming = (not self.done and self._depth == 1 and not self._is_key
+                                   and self._last_key == self.field)
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+            elif self._depth == 1:
+                if ch == ",":
+                    self._expect_key, self._last_key = True, None
+                elif ch == ":":
+                    self._expect_key = False
+        return "".join(out)
+
+    def _string_char(self, ch: str, out: List[str]):
+        if self._unicode is not None:
+            self._unicode += ch
+            if len(self._unicode) == 4:
+                try:
+                    code = int(self._unicode, 16)
+                except ValueError:
+                    code = 0xFFFD
+                self._unicode = None
+                self._emit_code(code, out)
+            return
+        if self._esc:
+            self._esc = False
+            if ch == "u":
+                self._unicode = ""
+                return
+            self._emit(_ESCAPES.get(ch, ch), out)
+            return
+        if ch == "\\":
+            self._esc = True
+        elif ch == '"':
+            self._in_str = False
+            if self._is_key:
+                self._last_key = "".join(self._key)
+            elif self._streaming:
+                self._flush_surrogate(out)
+                self._streaming, self.done = False, True
+        else:
+            self._emit(ch, out)
+
+    def _emit_code(self, code: int, out: List[str]):
+        if 0xD800 <= code <= 0xDBFF:
+            self._flush_surrogate(out)
+            self._high_surrogate = code
+        elif 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+            code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+            self._emit(chr(code), out)
+        else:
+            self._emit(chr(code), out)
+
+    def _flush_surrogate(self, out: List[str]):
+        if self._high_surrogate is not None:
+            self._high_surrogate = None
+            if self._streaming:
+                out.append("\ufffd")
+
+    def _emit(self, ch: str, out: List[str]):
+        if self._high_surrogate is not None:
+            self._flush_surrogate(out)
+        if self._is_key:
+            self._key.append(ch)
+        elif self._streaming:
+            out.append(ch)
@@ -1,22 +1,30 @@
 # llama_gen.py
 
+import asyncio
 from datetime import date
 import os
 import json
 import time
-from typing import List, Type, TypeVar, Optional
+from typing import AsyncIterator, List, Type, TypeVar, Optional
 import dotenv
 import httpx
 from pydantic import BaseModel, Field, ValidationError
-import requests
+from app.http_pool import get_async_client, get_client
+from app.llm_log import llm_log
+from app.llm_router import LlmRouter, Replica, is_replica_failure
+from app.metrics import metrics
+from app.request_context import current_thread_id
 from app.schemas import *
+from app.usage import record_openai_usage
 from app.colors import *
+from app.utils.sse import aiter_openai_deltas
 
 # A Generic Type Variable for our generator's return type
 T = TypeVar("T", bound=BaseModel)
 
-RETRIES = int(os.getenv("LLAMACPP_MAX_RETRIES", 3))
 TIMEOUT = int(os.getenv("LLAMACPP_TIMEOUT_S", 300))
+# Pin every chat thread to one llama-server replica and slot so its KV cache survives between turns
+SLOT_AFFINITY = os.getenv("LLAMACPP_SLOT_AFFINITY", "1") == "1"
 
 
 class LlamaGenAI:
@@ -24,28 +32,63 @@ class LlamaGenAI:
     A class to interact with a local Llama server for generating text and Pydantic models
     """
 
-    def __init__(self, base: str):
+    def __init__(self, base: str, router: Optional[LlmRouter] = None):
         """
         Initializes the generator with the local Llama server URL.
+
+        :param router: Replicas to spread requests over; a single-replica router for `base` if omitted.
         """
         self.base = base
+        self.router = router or LlmRouter([base])
         self.model = self._get_model_from_server()
+        # context window of one slot (the smallest one if replicas differ)
+        self.n_ctx = self.router.n_ctx
         self.url = f"{self.base}/v1/chat/completions"
         print(f"{SUCCESS_COLOR}LlamaGenAI instantiated successfully.{Colors.RESET}")
 
+    def get_model(self):
+        return self.model
+
     def _get_model_from_server(self):
-        try:
-            response = requests.get(f"{self.base}/v1/models", timeout=5)
-            response.raise_for_status()
-            models = response.json().get("data", [])
-            if models:
-                return models[0]["id"][models[0]["id"].rfind("\\") + 1:]
-            return "No models found"
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching models from server: {e}")
-            return "Not available"
+        # replicas serve the same model: the first one that answers tells its name
+        for replica in self.router.replicas:
+            try:
+                response = get_client("llama").get(f"{replica.base}/v1/models", timeout=5)
+                response.raise_for_status()
+                models = response.json().get("data", [])
+                if models:
+                    return models[0]["id"][models[0]["id"].rfind("\\") + 1:]
+                return "No models found"
+            except httpx.HTTPError as e:
+                print(f"Error fetching models from server {replica.base}: {e}")
+        return "Not available"
         
-    def _payload(self, system_prompt: str, user: str, temperature: Optional[float], max_tokens: Optional[int], grammar: Optional[str] = None):
+    def _cache_options(self, body: dict) -> dict:
+        # reuse the longest common prefix of the slot's previous prompt instead of re-evaluating it
+        body["cache_prompt"] = True
+        return body
+
+    def _choose(self, tried: List[str]) -> Replica:
+        return self.router.choose(current_thread_id.get() if SLOT_AFFINITY else None, tried)
+
+    def _for_replica(self, payload_dict: dict, replica: Replica) -> dict:
+        """
+        Request body for one attempt: sends the current chat thread to its slot on the chosen
+        replica when that slot is idle (reserved until `router.lease(replica, body.get("id_slot"))` ends).
+        """
+        slot = self.router.claim_slot(replica, current_thread_id.get()) if SLOT_AFFINITY else None
+        if slot is None:
+            return payload_dict
+        return {**payload_dict, "id_slot": slot}
+
+    def _report_usage(self, timings: Optional[dict], usage: Optional[dict], body: dict, replica: Replica, started: float):
+        tokens = record_openai_usage("llama", usage, timings, (time.perf_counter() - started) * 1000)
+        if not timings:
+            return
+        print(f"{INFO_COLOR}Prompt eval ({replica.base}, slot {body.get('id_slot')}): {tokens['evaluated_tokens']} evaluated, "
+              f"{tokens['cached_tokens']} from KV cache, {timings.get('prompt_ms', 0):.0f} ms{Colors.RESET}")
+
+    def _payload(self, system_prompt: str, user: str, temperature: Optional[float], max_tokens: Optional[int], grammar: Optional[str] = None, json_schema: Optional[dict] = None):
         body = {
             "model": self.model,
             "messages": [
@@ -59,15 +102,64 @@ class LlamaGenAI:
             body["max_tokens"] = max_tokens
         if grammar is not None:
             body["grammar"] = grammar
+        if json_schema is not None:
+            body["json_schema"] = json_schema
         return body
 
-    def complete(self, 
-                system_prompt: Optional[str] = None, 
-                user: Optional[str] = None, 
-                temperature: Optional[float] = None, 
-                max_tokens: Optional[int] = None,
-                payload: Optional[LLamaMessageHistory] = None,
-                grammar: Optional[str] = None) -> str:
+    def _request_body(self, system_prompt, user, temperature, max_tokens, payload, grammar, json_schema=None) -> dict:
+        if payload is None:
+            return self._cache_options(self._payload(system_prompt, user, temperature, max_tokens, grammar, json_schema)) # type: ignore
+        payload_dict = {
+            "model": self.model,
+            "messages": payload.to_dict()
+        }
+        if temperature is not None:
+            payload_dict["temperature"] = temperature
+        if max_tokens is not None:
+            payload_dict["max_tokens"] = max_tokens
+        if grammar is not None:
+            payload_dict["grammar"] = grammar
+        if json_schema is not None:
+            payload_dict["json_schema"] = json_schema
+        return self._cache_options(payload_dict)
+
+    def _message_text(self, data: dict) -> Optional[str]:
+        # обычный OAI-ответ
+        msg = (data.get("choices") or [{}])[0].get("message", {})
+        text = msg.get("content")
+        # некоторые сборки кладут в choices[0].text
+        if text is None:
+            text = (data.get("choices") or [{}])[0].get("text")
+        return text
+
+    def _log_response(self, payload_dict: dict, text: Optional[str], replica: Replica, started: float,
+                      error: Optional[BaseException] = None):
+        llm_log.log("llama", request=payload_dict, response=text, error=error, model=self.model,
+                    mode="stream" if payload_dict.get("stream") else "complete", replica=replica.base,
+                    duration_ms=round((time.perf_counter() - started) * 1000, 1))
+
+    def _log_cancelled(self, payload_dict: dict, text: Optional[str], replica: Replica, started: float,
+                       error: BaseException):
+        # the caller went away (SSE client disconnected): leaving the `async with` closes the
+        # connection, and llama-server stops generating for a closed connection
+        metrics.inc("llm_calls_cancelled", backend="llama")
+        self._log_response(payload_dict, text, replica, started, error=error)
+
+    def _fail_over(self, error: Exception, tried: List[str]) -> bool:
+        """
+        Whether to retry a failed attempt at once on a replica not tried yet. Backoff and retries of
+        the whole call, once every replica failed, are up to the caller (`Resilience` in Generator).
+        """
+        return is_replica_failure(error) and len(tried) < len(self.router.replicas)
+
+    async def acomplete(self,
+                        system_prompt: Optional[str] = None,
+                        user: Optional[str] = None,
+                        temperature: Optional[float] = None,
+                        max_tokens: Optional[int] = None,
+                        payload: Optional[LLamaMessageHistory] = None,
+                        grammar: Optional[str] = None,
+                        json_schema: Optional[dict] = None) -> str:
         """Uses LLM to generate a string
 
         Args:
@@ -76,48 +168,88 @@ class LlamaGenAI:
             temperature (Optional[float], optional): LLM temperature. Defaults to None.
             max_tokens (Optional[int], optional): LLM max tokens for generation. Defaults to None.
             grammar (Optional[str], optional): Llama.cpp grammar to constrain output. Defaults to None.
+            json_schema (Optional[dict], optional): JSON schema the output must follow; the server compiles it into a grammar. Defaults to None.
 
         Raises:
-            last_exc
+            The error of the last replica tried.
 
         Returns:
             str: generated string
         """
         headers = {"Content-Type": "application/json"}
-        if payload is None:
-            payload_dict = self._payload(system_prompt, user, temperature, max_tokens, grammar) # type: ignore
-        else:
-            payload_dict = {
-                "model": self.model,
-                "messages": payload.to_dict()
-            }
-            if temperature is not None:
-                payload_dict["temperature"] = temperature
-            if max_tokens is not None:
-                payload_dict["max_tokens"] = max_tokens
-            if grammar is not None:
-                payload_dict["grammar"] = grammar
-        
-        last_exc = None
-        for attempt in range(RETRIES + 1):
+        payload_dict = self._request_body(system_prompt, user, temperature, max_tokens, payload, grammar, json_schema)
+
+        tried: List[str] = []
+        for _ in range(len(self.router.replicas)):
+            replica = self._choose(tried)
+            body = self._for_replica(payload_dict, replica)
+            started = time.perf_counter()
             try:
-                print(payload_dict)
-                r = httpx.post(self.url, json=payload_dict, timeout=TIMEOUT, headers=headers)
-                r.raise_for_status()
-                data = r.json()
-                # обычный OAI-ответ
-                msg = (data.get("choices") or [{}])[0].get("message", {})
-                text = msg.get("content")
-                # некоторые сборки кладут в choices[0].text
-                if text is None:
-                    text = (data.get("choices") or [{}])[0].get("text")
-                with open("./storage/dev/response.txt", "a", encoding="utf-8") as f:
-                    f.write("\n" + "-" * 10)
-                    f.write(str(payload_dict))
-                    f.write(str(text))
-                    f.write("\n" + "-" * 10)
+                with self.router.lease(replica, body.get("id_slot")):
+                    r = await get_async_client("llama").post(replica.url, json=body, timeout=TIMEOUT, headers=headers)
+                    r.raise_for_status()
+                    data = r.json()
+                self.router.mark_success(replica)
+                text = self._message_text(data)
+                self._report_usage(data.get("timings"), data.get("usage"), body, replica, started)
+                self._log_response(body, text, replica, started)
                 return text or ""
+            except asyncio.CancelledError as e:
+                self._log_cancelled(body, None, replica, started, e)
+                raise
+            except Exception as e:
+                self.router.mark_failure(replica, e)
+                self._log_response(body, None, replica, started, error=e)
+                tried.append(replica.base)
+                if not self._fail_over(e, tried):
+                    raise
+
+    async def astream(self,
+                      system_prompt: Optional[str] = None,
+                      user: Optional[str] = None,
+                      temperature: Optional[float] = None,
+                      max_tokens: Optional[int] = None,
+                      payload: Optional[LLamaMessageHistory] = None,
+                      grammar: Optional[str] = None,
+                      json_schema: Optional[dict] = None) -> AsyncIterator[str]:
+        """Same as `acomplete`, but yields text deltas as the server generates them (`stream: true`).
+
+        Fails over to another replica only while nothing has been yielded yet: once text
+        has been sent downstream a failure is raised to the caller.
+
+        Yields:
+            str: generated text deltas
+        """
+        headers = {"Content-Type": "application/json"}
+        payload_dict = self._request_body(system_prompt, user, temperature, max_tokens, payload, grammar, json_schema)
+        payload_dict["stream"] = True
+
+        tried: List[str] = []
+        for _ in range(len(self.router.replicas)):
+            parts: List[str] = []
+            meta: dict = {}
+            replica = self._choose(tried)
+            body = self._for_replica(payload_dict, replica)
+            started = time.perf_counter()
+            try:
+                with self.router.lease(replica, body.get("id_slot")):
+                    async with get_async_client("llama").stream("POST", replica.url, json=body, timeout=TIMEOUT, headers=headers) as r:
+                        r.raise_for_status()
+                        async for delta in aiter_openai_deltas(r.aiter_lines(), meta):
+                            parts.append(delta)
+                            yield delta
+                self.router.mark_success(replica)
+                self._report_usage(meta.get("timings"), meta.get("usage"), body, replica, started)
+                self._log_response(body, "".join(parts), replica, started)
+                return
+            except (asyncio.CancelledError, GeneratorExit) as e:
+                self._log_cancelled(body, "".join(parts), replica, started, e)
+                raise
             except Exception as e:
-                last_exc = e
-                time.sleep(min(2.0, 0.5 * attempt + 0.1))
-        raise last_exc # type: ignore
\ No newline at end of file
+                self.router.mark_failure(replica, e)
+                self._log_response(body, "".join(parts), replica, started, error=e)
+                if parts:
+                    raise
+                tried.append(replica.base)
+                if not self._fail_over(e, tried):
+                    raise
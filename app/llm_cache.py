@@ -0,0 +1,285 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./storage/llm_cache")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512"))
+LLM_CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S", "86400"))
+# Limits of the disk tier, enforced by pruning the oldest files (0 = no limit)
+LLM_CACHE_DISK_MAX_ENTRIES = int(os.getenv("LLM_CACHE_DISK_MAX_ENTRIES", "20000"))
+LLM_CACHE_DISK_MAX_BYTES = int(os.getenv("LLM_CACHE_DISK_MAX_BYTES", str(200 * 1024 * 1024)))
+# Stores between two prunes of the disk tier
+LLM_CACHE_PRUNE_EVERY = int(os.getenv("LLM_CACHE_PRUNE_EVERY", "200"))
+
+
+def _canonical(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        to_dict = getattr(value, "to_dict", None)
+        return _canonical(to_dict() if to_dict else value.model_dump())
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+class LLMCache:
+    """
+    Exact-match cache of raw LLM responses for deterministic calls.
+
+    Keyed by SHA-256 of (backend, model, full request: messages, sampling params, schema),
+    so any byte of difference in the prompt is a miss. Two tiers: an in-memory LRU and
+    JSON files `<cache_dir>/<key>.json` that survive restarts. Entries older than `ttl_s`
+    are treated as misses and removed. The disk tier is pruned at start and every
+    `prune_every` stores: expired files and leftover temp files go, then the oldest files
+    until it fits `disk_max_entries` and `disk_max_bytes`. `aget`/`aput` keep the disk I/O
+    off the event loop. Generator decides what is cacheable (temperature 0 or an explicit
+    `cacheable=True`) and only stores responses that parsed and validated.
+    """
+
+    def __init__(self,
+                 cache_dir: Optional[str] = LLM_CACHE_DIR,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 ttl_s: float = LLM_CACHE_TTL_S,
+                 disk_max_entries: int = LLM_CACHE_DISK_MAX_ENTRIES,
+                 disk_max_bytes: int = LLM_CACHE_DISK_MAX_BYTES,
+                 prune_every: int = LLM_CACHE_PRUNE_EVERY):
+        """
+        :param cache_dir: Directory of the disk tier; empty or None keeps the cache in memory only.
+        :param max_entries: Size of the in-memory LRU tier.
+        :param ttl_s: Lifetime of an entry, seconds.
+        :param disk_max_entries: Max files of the disk tier (0 = no limit).
+        :param disk_max_bytes: Max total size of the disk tier, bytes (0 = no limit).
+        :param prune_every: Stores between two prunes of the disk tier.
+        """
+        self.cache_dir = cache_dir or None
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.disk_max_entries = disk_max_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.prune_every = max(1, prune_every)
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+        self._stores_since_prune = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypassed": 0, "pruned": 0}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.prune()
+
+    def key(self, backend: str, model: Optional[str], request: Dict[str, Any]) -> str:
+        """
+        Builds the cache key of a request (the keyword arguments of a backend's `acomplete`).
+        """
+        material = json.dumps([backend, model, _canonical(request)], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")  # type: ignore
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached response text, or None on a miss or an expired entry.
+        """
+        now = time.time()
+        text = self._memory_get(key, now)
+        return text if text is not None else self._disk_get(key, now)
+
+    async def aget(self, key: str) -> Optional[str]:
+        """
+        Asyncio counterpart of `get`: the memory tier is read inline, the disk tier in a worker
+        thread, so a slow disk doesn't stall the event loop.
+        """
+        now = time.time()
+        text = self._memory_get(key, now)
+        if text is not None:
+            return text
+        if not self.cache_dir:
+            return self._disk_get(key, now)  # only counts the miss
+        return await asyncio.to_thread(self._disk_get, key, now)
+
+    def put(self, key: str, text: str):
+        """
+        Stores a response text in both tiers. The file is written to a temp file first
+        so a crash never leaves a truncated entry behind.
+        """
+        entry = (time.time(), text)
+        due = self._memory_put(key, entry)
+        self._write(key, entry)
+        if due:
+            self.prune()
+
+    async def aput(self, key: str, text: str):
+        """
+        Asyncio counterpart of `put`: the file is written in a worker thread, a due prune of
+        the disk tier runs in the background without being awaited.
+        """
+        entry = (time.time(), text)
+        due = self._memory_put(key, entry)
+        if not self.cache_dir:
+            return
+        await asyncio.to_thread(self._write, key, entry)
+        if due:
+            asyncio.get_running_loop().run_in_executor(None, self.prune)
+
+    def _memory_get(self, key: str, now: float) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl_s:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return entry[1]
+            if entry is not None:
+                del self._memory[key]
+        return None
+
+    def _disk_get(self, key: str, now: float) -> Optional[str]:
+        entry = self._read(key, now)
+        with self._lock:
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            self._remember(key, entry)
+        return entry[1]
+
+    def _memory_put(self, key: str, entry: Tuple[float, str]) -> bool:
+        """
+        Stores an entry in the memory tier; True when the disk tier is due for pruning.
+        """
+        with self._lock:
+            self._stats["stores"] += 1
+            self._remember(key, entry)
+            self._stores_since_prune += 1
+            due = self._stores_since_prune >= self.prune_every
+            if due:
+                self._stores_since_prune = 0
+        return due and bool(self.cache_dir)
+
+    def _write(self, key: str, entry: Tuple[float, str]):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": entry[0], "text": entry[1]}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"LLM cache: failed to write {path}: {e}")
+
+    def prune(self) -> int:
+        """
+        Removes expired entries and temp files left by crashed writers from the disk tier,
+        then the oldest entries beyond `disk_max_entries` / `disk_max_bytes`.
+        Skipped when another thread is already pruning.
+
+        :return: Number of files removed.
+        """
+        if not self.cache_dir or not self._prune_lock.acquire(blocking=False):
+            return 0
+        try:
+            now = time.time()
+            files, stale = [], []
+            try:
+                with os.scandir(self.cache_dir) as entries:
+                    for entry in entries:
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        if entry.name.endswith(".json") and now - st.st_mtime <= self.ttl_s:
+                            files.append((st.st_mtime, st.st_size, entry.path))
+                        elif entry.name.endswith(".json") or (entry.name.endswith(".tmp") and now - st.st_mtime > 3600):
+                            stale.append(entry.path)
+            except OSError as e:
+                # also runs in the background (aput): report instead of raising
+                print(f"LLM cache: failed to prune {self.cache_dir}: {e}")
+                return 0
+            files.sort()  # oldest first
+            total = sum(size for _, size, _ in files)
+            excess = 0
+            while excess < len(files) and (
+                    (self.disk_max_entries and len(files) - excess > self.disk_max_entries)
+                    or (self.disk_max_bytes and total > self.disk_max_bytes)):
+                total -= files[excess][1]
+                stale.append(files[excess][2])
+                excess += 1
+            removed = 0
+            for path in stale:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self._stats["pruned"] += removed
+            return removed
+        finally:
+            self._prune_lock.release()
+
+    def record_bypass(self):
+        with self._lock:
+            self._stats["bypassed"] += 1
+
+    def clear(self):
+        """
+        Drops all entries from both tiers.
+        """
+        with self._lock:
+            self._memory.clear()
+        if self.cache_dir:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".json"):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except FileNotFoundError:
+                        pass
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Hit/miss counters since start, hit rate over cacheable lookups and the tier sizes.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        stats["disk_entries"] = (sum(1 for name in os.listdir(self.cache_dir) if name.endswith(".json"))
+                                 if self.cache_dir else 0)
+        stats.update(max_entries=self.max_entries, ttl_s=self.ttl_s, cache_dir=self.cache_dir,
+                     disk_max_entries=self.disk_max_entries, disk_max_bytes=self.disk_max_bytes)
+        return stats
+
+    def _remember(self, key: str, entry: Tuple[float, str]):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _read(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            entry = (float(data["created"]), str(data["text"]))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            entry = None
+        if entry is None or now - entry[0] > self.ttl_s:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return entry
@@ -0,0 +1,230 @@
+import atexit
+import glob
+import gzip
+import json
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+import time
+from typing import Any, Dict, Optional, TextIO
+
+from app.colors import WARNING_COLOR, Colors
+from app.request_context import current_thread_id
+from app.tracing import current_trace_id
+
+LLM_LOG_ENABLED = os.getenv("LLM_LOG", "1") == "1"
+LLM_LOG_PATH = os.getenv("LLM_LOG_PATH", "./storage/dev/llm_trace.jsonl")
+# Share of successful calls written (errors are always written)
+LLM_LOG_SAMPLE_RATE = float(os.getenv("LLM_LOG_SAMPLE_RATE", "1"))
+# The file is rotated when it reaches the size or the age, whichever comes first
+LLM_LOG_MAX_BYTES = int(os.getenv("LLM_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LLM_LOG_ROTATE_S = float(os.getenv("LLM_LOG_ROTATE_S", "86400"))
+LLM_LOG_BACKUPS = int(os.getenv("LLM_LOG_BACKUPS", "7"))
+LLM_LOG_COMPRESS = os.getenv("LLM_LOG_COMPRESS", "1") == "1"
+LLM_LOG_QUEUE_SIZE = int(os.getenv("LLM_LOG_QUEUE_SIZE", "1000"))
+
+REDACTED = "***"
+SECRET_KEYS = re.compile(r"^(api[_-]?key|x-api-key|authorization|password|passwd|secret|client[_-]?secret|"
+                         r"(access|refresh|auth|api|bearer)?[_-]?token)$", re.IGNORECASE)
+SECRET_VALUES = re.compile(r"(Bearer\s+[\w\-.=]{8,}|sk-[\w\-]{16,}|AIza[\w\-]{30,})")
+
+_STOP = object()
+
+
+def redact(value: Any) -> Any:
+    """
+    Replaces values of secret-looking keys and API keys / bearer tokens inside strings.
+    """
+    if isinstance(value, dict):
+        return {k: REDACTED if isinstance(k, str) and SECRET_KEYS.match(k) and v else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return SECRET_VALUES.sub(REDACTED, value)
+    if hasattr(value, "model_dump"):
+        return redact(value.model_dump(mode="json", exclude_none=True))
+    return value
+
+
+class LlmTraceLog:
+    """
+    JSONL trace of LLM calls (request, response, timing, errors) written by a background thread.
+
+    `log` only builds a small record and puts it on a bounded queue without blocking; when the
+    queue is full the record is dropped and counted. The writer thread redacts secrets, serializes
+    the record and appends it to `path`, rotating the file by size or age into
+    `<name>.<timestamp>.jsonl[.gz]` and keeping the newest `backups` rotated files.
+    """
+
+    def __init__(self,
+                 path: str = LLM_LOG_PATH,
+                 enabled: bool = LLM_LOG_ENABLED,
+                 sample_rate: float = LLM_LOG_SAMPLE_RATE,
+                 max_bytes: int = LLM_LOG_MAX_BYTES,
+                 rotate_s: float = LLM_LOG_ROTATE_S,
+                 backups: int = LLM_LOG_BACKUPS,
+                 compress: bool = LLM_LOG_COMPRESS,
+                 queue_size: int = LLM_LOG_QUEUE_SIZE):
+        """
+        :param path: Active trace file.
+        :param enabled: False makes `log` a no-op.
+        :param sample_rate: Share of successful calls written, 0..1.
+        :param max_bytes: Size that triggers rotation (0 = no size limit).
+        :param rotate_s: Age of the active file that triggers rotation, seconds (0 = no age limit).
+        :param backups: Rotated files kept.
+        :param compress: Gzip rotated files.
+        :param queue_size: Max records waiting for the writer.
+        """
+        self.path = path
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.rotate_s = rotate_s
+        self.backups = backups
+        self.compress = compress
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._file: Optional[TextIO] = None
+        self._opened_at = 0.0
+        self._stats = {"queued": 0, "written": 0, "dropped": 0, "sampled_out": 0, "rotations": 0, "write_errors": 0}
+
+    def log(self, backend: str, request: Any = None, response: Optional[str] = None,
+            error: Optional[BaseException] = None, **fields):
+        """
+        Queues a trace record; never blocks and never raises.
+
+        :param backend: Client that made the call ("llama", "qwen", "gemini").
+        :param request: Request body as sent (dicts, pydantic models).
+        :param response: Generated text.
+        :param error: Failure of the call, if any.
+        :param fields: Extra fields: model, mode, duration_ms, replica...
+        """
+        if not self.enabled:
+            return
+        if error is None and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self._stats["sampled_out"] += 1
+            return
+        record = {"ts": time.time(), "backend": backend, "thread_id": current_thread_id.get(),
+                  "trace_id": current_trace_id(), **fields, "request": request, "response": response}
+        if error is not None:
+            record["error"] = f"{type(error).__name__}: {error}"
+        self.write_record(record)
+
+    def write_record(self, record: Dict[str, Any]):
+        """
+        Queues a ready JSON-serializable record (e.g. an exported trace); never blocks and never raises.
+        """
+        if not self.enabled:
+            return
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(record)
+            self._stats["queued"] += 1
+        except queue.Full:
+            self._stats["dropped"] += 1
+
+    def _ensure_writer(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked child: the parent's writer thread and file handle don't exist here
+                self._pid, self._file = os.getpid(), None
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._thread = None
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="llm-trace-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            self._write(item)
+            if self._queue.empty() and self._file is not None:
+                self._file.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, record: Dict[str, Any]):
+        try:
+            line = json.dumps(redact(record), ensure_ascii=False, default=str)
+            self._maybe_rotate(len(line) + 1)
+            if self._file is None:
+                self._open()
+            self._file.write(line + "\n")  # type: ignore
+            self._stats["written"] += 1
+        except Exception as e:
+            self._stats["write_errors"] += 1
+            print(f"{WARNING_COLOR}LLM trace log: failed to write a record: {e}{Colors.RESET}")
+
+    def _open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._opened_at = time.time()
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            # age of an existing file is the time of its first record
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._opened_at = float(json.loads(f.readline()).get("ts", self._opened_at))
+            except (OSError, ValueError, AttributeError):
+                pass
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _maybe_rotate(self, incoming: int):
+        if self._file is None:
+            if not os.path.exists(self.path):
+                return
+            self._open()
+        size = self._file.tell()  # type: ignore
+        too_big = self.max_bytes and size and size + incoming > self.max_bytes
+        too_old = self.rotate_s and size and time.time() - self._opened_at >= self.rotate_s
+        if too_big or too_old:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()  # type: ignore
+        self._file = None
+        stem, ext = os.path.splitext(self.path)
+        rotated, n = f"{stem}.{time.strftime('%Y%m%d-%H%M%S')}{ext}", 0
+        while os.path.exists(rotated) or os.path.exists(f"{rotated}.gz"):
+            n += 1
+            rotated = f"{stem}.{time.strftime('%Y%m%d-%H%M%S')}-{n}{ext}"
+        os.replace(self.path, rotated)
+        if self.compress:
+            with open(rotated, "rb") as src, gzip.open(f"{rotated}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+        self._stats["rotations"] += 1
+        old = sorted(glob.glob(f"{glob.escape(stem)}.*{ext}") + glob.glob(f"{glob.escape(stem)}.*{ext}.gz"))
+        for path in old[:max(len(old) - self.backups, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def close(self, timeout: float = 5.0):
+        """
+        Writes out the queued records and stops the writer thread.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats.update(enabled=self.enabled, path=self.path, pending=self._queue.qsize(), sample_rate=self.sample_rate)
+        return stats
+
+
+llm_log = LlmTraceLog()
@@ -0,0 +1,308 @@
+import os
+import random
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import httpx
+
+from app.colors import ERROR_COLOR, INFO_COLOR, SUCCESS_COLOR, Colors
+from app.http_pool import get_client
+
+# Consecutive failures after which a replica is taken out of rotation, and for how long
+ROUTER_EJECT_AFTER_FAILURES = int(os.getenv("LLM_ROUTER_EJECT_AFTER_FAILURES", "3"))
+ROUTER_EJECT_S = float(os.getenv("LLM_ROUTER_EJECT_S", "30"))
+# Period of the background /health + /slots probes; 0 disables them (failures still eject)
+ROUTER_HEALTH_INTERVAL_S = float(os.getenv("LLM_ROUTER_HEALTH_INTERVAL_S", "10"))
+
+
+def chat_bases_from_env(default_base: str) -> List[str]:
+    """
+    Replica base URLs from LLAMACPP_CHAT_BASES (comma-separated), falling back to the single chat base.
+    """
+    bases = [b.strip().rstrip("/").replace("localhost", "127.0.0.1")
+             for b in os.getenv("LLAMACPP_CHAT_BASES", "").split(",") if b.strip()]
+    return bases or [default_base]
+
+
+def is_replica_failure(e: BaseException) -> bool:
+    """
+    Errors that say something about the replica (unreachable, timed out, 5xx), as opposed
+    to a bad request that would fail on any replica.
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+class Replica:
+    """
+    One llama-server instance and what the router knows about it.
+    """
+
+    def __init__(self, base: str):
+        self.base = base
+        self.url = f"{base}/v1/chat/completions"
+        self.total_slots = 0     # from /props; 0 = unknown
+        self.n_ctx = 0           # context window of one slot, from /props
+        self.idle_slots: Optional[int] = None  # from /slots, None when the endpoint is disabled
+        # slots not busy with other clients' requests at the last /slots probe (None = unknown)
+        self.free_slot_ids: Optional[Set[int]] = None
+        self.pinned: Set[int] = set()  # slots running a pinned request of this process
+        self.outstanding = 0     # requests sent by this process and not finished yet
+        self.failures = 0        # consecutive failures
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def capacity(self) -> int:
+        return max(self.total_slots, 1)
+
+    @property
+    def load(self) -> float:
+        busy = self.outstanding
+        if self.idle_slots is not None and self.total_slots:
+            # requests of other clients show up as busy slots
+            busy = max(busy, self.total_slots - self.idle_slots)
+        return busy / self.capacity
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def slot_for(self, thread_id: Optional[str]) -> Optional[int]:
+        """
+        Home slot of a chat thread on this replica: crc32(thread_id) % total_slots.
+        """
+        if not thread_id or not self.total_slots:
+            return None
+        return zlib.crc32(thread_id.encode("utf-8")) % self.total_slots
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "base": self.base,
+            "healthy": self.available(time.time()),
+            "ejected_for_s": round(max(self.ejected_until - time.time(), 0.0), 1),
+            "outstanding": self.outstanding,
+            "total_slots": self.total_slots,
+            "idle_slots": self.idle_slots,
+            "pinned_slots": sorted(self.pinned),
+            "n_ctx": self.n_ctx,
+            "consecutive_failures": self.failures,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+
+class LlmRouter:
+    """
+    Spreads chat requests over several llama-server replicas serving the same model.
+
+    A request of a chat thread goes to the thread's replica (rendezvous hashing over the
+    healthy replicas, so a thread only moves when its replica is down or saturated) to keep
+    its KV cache warm; other requests go to the least loaded replica, where load is the
+    number of outstanding requests or busy slots reported by `/slots` per slot. A replica is
+    ejected for `eject_s` seconds after `eject_after` consecutive failures (connection errors,
+    timeouts, 5xx) and put back once its `/health` answers again. Callers retry idempotent
+    requests on another replica by passing the failed ones in `exclude`. A streamed request
+    fails over only before its first token: once text has reached the caller, a failure is
+    raised to it (Generator then re-asks from scratch).
+    """
+
+    def __init__(self,
+                 bases: Iterable[str],
+                 eject_after: int = ROUTER_EJECT_AFTER_FAILURES,
+                 eject_s: float = ROUTER_EJECT_S,
+                 health_interval_s: float = ROUTER_HEALTH_INTERVAL_S):
+        """
+        :param bases: Base URLs of the replicas.
+        :param eject_after: Consecutive failures that eject a replica.
+        :param eject_s: How long an ejected replica stays out of rotation, seconds.
+        :param health_interval_s: Period of the background health probes, seconds (0 = off).
+        """
+        self.replicas = [Replica(base) for base in dict.fromkeys(bases)]
+        if not self.replicas:
+            raise ValueError("LlmRouter needs at least one backend.")
+        self.eject_after = eject_after
+        self.eject_s = eject_s
+        self.health_interval_s = health_interval_s
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread: Optional[threading.Thread] = None
+        for replica in self.replicas:
+            self.refresh_props(replica)
+
+    @property
+    def primary(self) -> Replica:
+        return self.replicas[0]
+
+    @property
+    def n_ctx(self) -> int:
+        """
+        Smallest known slot context of all replicas (0 if none reported it).
+        """
+        known = [r.n_ctx for r in self.replicas if r.n_ctx]
+        return min(known) if known else 0
+
+    def choose(self, thread_id: Optional[str] = None, exclude: Iterable[str] = ()) -> Replica:
+        """
+        Picks the replica for the next attempt of a request.
+
+        :param thread_id: Chat thread of the request, for affinity.
+        :param exclude: Bases that already failed for this request; ignored if nothing else is left.
+        """
+        now = time.time()
+        excluded = set(exclude)
+        with self._lock:
+            candidates = [r for r in self.replicas if r.available(now) and r.base not in excluded]
+            if not candidates:
+                candidates = [r for r in self.replicas if r.base not in excluded] or list(self.replicas)
+                # everything is down: try the one whose ejection ends first
+                return min(candidates, key=lambda r: r.ejected_until)
+            least = min(r.load for r in candidates)
+            if thread_id:
+                home = max(candidates, key=lambda r: zlib.crc32(f"{thread_id}|{r.base}".encode("utf-8")))
+                if home.load < 1 or home.load <= least:
+                    return home
+            return random.choice([r for r in candidates if r.load == least])
+
+    def claim_slot(self, replica: Replica, thread_id: Optional[str]) -> Optional[int]:
+        """
+        The thread's home slot on the replica if it is idle, reserved until the request's `lease`
+        ends; None (llama-server picks a free slot) when the home slot is busy with another request
+        of this process or, as of the last /slots probe, of another client. Pinning a thread to
+        a busy slot would queue it there while other slots idle.
+        """
+        slot = replica.slot_for(thread_id)
+        if slot is None:
+            return None
+        with self._lock:
+            if slot in replica.pinned or (replica.free_slot_ids is not None and slot not in replica.free_slot_ids):
+                return None
+            replica.pinned.add(slot)
+        return slot
+
+    @contextmanager
+    def lease(self, replica: Replica, slot: Optional[int] = None):
+        """
+        Counts a request as outstanding on the replica while it runs.
+
+        :param slot: Slot reserved by `claim_slot`, released at the end.
+        """
+        with self._lock:
+            replica.outstanding += 1
+            replica.requests += 1
+        try:
+            yield replica
+        finally:
+            with self._lock:
+                replica.outstanding -= 1
+                if slot is not None:
+                    replica.pinned.discard(slot)
+
+    def mark_success(self, replica: Replica):
+        with self._lock:
+            replica.failures = 0
+
+    def mark_failure(self, replica: Replica, error: BaseException):
+        """
+        Records a failed attempt; replica failures (see `is_replica_failure`) count towards ejection.
+        """
+        if not is_replica_failure(error):
+            return
+        with self._lock:
+            replica.errors += 1
+            replica.failures += 1
+            if replica.failures < self.eject_after or not replica.available(time.time()):
+                return
+            replica.ejected_until = time.time() + self.eject_s
+        print(f"{ERROR_COLOR}LLM router: ejecting {replica.base} for {self.eject_s:.0f}s after "
+              f"{replica.failures} failures ({error}){Colors.RESET}")
+
+    def refresh_props(self, replica: Replica):
+        try:
+            response = get_client("llama").get(f"{replica.base}/props", timeout=5)
+            response.raise_for_status()
+            props = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Error fetching server props of {replica.base}, slot affinity disabled: {e}")
+            return
+        replica.total_slots = int(props.get("total_slots") or 0)
+        # --ctx-size is split between --parallel slots
+        replica.n_ctx = int((props.get("default_generation_settings") or {}).get("n_ctx") or props.get("n_ctx") or 0)
+
+    def check(self, replica: Replica) -> bool:
+        """
+        Probes `/health` (and `/slots` for idle slots); reinstates an ejected replica that answers.
+        """
+        try:
+            response = get_client("llama").get(f"{replica.base}/health", timeout=5)
+            healthy = response.status_code == 200
+        except httpx.HTTPError:
+            healthy = False
+        if healthy:
+            self._probe_slots(replica)
+            if not replica.total_slots:
+                self.refresh_props(replica)
+        with self._lock:
+            if healthy and not replica.available(time.time()):
+                print(f"{SUCCESS_COLOR}LLM router: {replica.base} is back{Colors.RESET}")
+            if healthy:
+                replica.failures, replica.ejected_until = 0, 0.0
+            elif replica.available(time.time()):
+                replica.failures = max(replica.failures, self.eject_after)
+                replica.ejected_until = time.time() + self.eject_s
+                print(f"{ERROR_COLOR}LLM router: {replica.base} failed its health check{Colors.RESET}")
+        return healthy
+
+    def _probe_slots(self, replica: Replica):
+        """
+        Reads idle slots from `/slots`; both stay unknown (None) when the server runs without --slots.
+        """
+        with self._lock:
+            pinned = set(replica.pinned)
+        replica.idle_slots, replica.free_slot_ids = None, None
+        try:
+            response = get_client("llama").get(f"{replica.base}/slots", timeout=5)
+            if response.status_code != 200:
+                return  # started without --slots
+            slots = response.json()
+        except (httpx.HTTPError, ValueError):
+            return
+        if not isinstance(slots, list):
+            return
+        # newer builds report is_processing, older ones state (0 = idle)
+        idle = {int(s.get("id", i)) for i, s in enumerate(slots)
+                if not s.get("is_processing", s.get("state", 0) != 0)}
+        replica.idle_slots = len(idle)
+        # a slot busy with our own pinned request is tracked by `pinned`, not blocked until the next probe
+        replica.free_slot_ids = idle | pinned
+
+    def check_all(self):
+        for replica in self.replicas:
+            self.check(replica)
+
+    def start_health_checks(self):
+        """
+        Starts the background probe thread (no-op for a single replica or a zero interval).
+        """
+        if self._health_thread is not None or self.health_interval_s <= 0 or len(self.replicas) < 2:
+            return
+        self._stop.clear()
+        self._health_thread = threading.Thread(target=self._health_loop, name="llm-router-health", daemon=True)
+        self._health_thread.start()
+        print(f"{INFO_COLOR}LLM router: {len(self.replicas)} replicas, health checks every {self.health_interval_s:.0f}s{Colors.RESET}")
+
+    def stop_health_checks(self):
+        self._stop.set()
+        self._health_thread = None
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_interval_s):
+            self.check_all()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [r.to_dict() for r in self.replicas]
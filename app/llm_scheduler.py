@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+from app.colors import WARNING_COLOR, Colors
+from app.metrics import metrics
+from app.request_context import BACKGROUND, FOLLOW_UP, INTERACTIVE, current_priority
+
+# Concurrent LLM requests per backend; 0 = the llama-server slots (-np) of all replicas
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "0"))
+LLM_CLOUD_MAX_CONCURRENCY = int(os.getenv("LLM_CLOUD_MAX_CONCURRENCY", "8"))
+# Requests allowed to wait ahead of a new one before it is rejected (HTTP 429)
+LLM_QUEUE_MAX_DEPTH = int(os.getenv("LLM_QUEUE_MAX_DEPTH", "32"))
+# Longest wait for a slot before the request is rejected, seconds
+LLM_QUEUE_TIMEOUT_S = float(os.getenv("LLM_QUEUE_TIMEOUT_S", "120"))
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", FOLLOW_UP: "follow_up", BACKGROUND: "background"}
+
+
+class OverloadedError(Exception):
+    """
+    The LLM backend is saturated: the queue is too deep or the wait for a slot timed out.
+    Served as HTTP 429 with Retry-After.
+    """
+
+    def __init__(self, message: str, retry_after_s: float = 5.0):
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+class _Waiter:
+    def __init__(self, priority: int, loop: asyncio.AbstractEventLoop):
+        self.priority = priority
+        self.enqueued = time.perf_counter()
+        self.granted = False
+        self.abandoned = False
+        self.loop = loop
+        self.future: asyncio.Future = loop.create_future()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class LlmScheduler:
+    """
+    Admission control in front of one LLM backend.
+
+    At most `max_concurrency` requests run at once (match llama-server's `-np` slots, so
+    requests don't queue invisibly inside the server). Others wait in a priority queue:
+    interactive first turns, then follow-up research iterations, then background work,
+    FIFO within a class. A request is rejected right away with OverloadedError when
+    `max_queue_depth` requests of its class or a higher one are already waiting, and after
+    `queue_timeout_s` of waiting. The priority comes from `request_context.current_priority`.
+    Callers may run on different event loops (e.g. `generate_many`'s own loop).
+    """
+
+    def __init__(self,
+                 backend: str,
+                 max_concurrency: int,
+                 max_queue_depth: int = LLM_QUEUE_MAX_DEPTH,
+                 queue_timeout_s: float = LLM_QUEUE_TIMEOUT_S):
+        """
+        :param backend: Backend name for metrics and messages.
+        :param max_concurrency: Requests running at once.
+        :param max_queue_depth: Waiting requests of equal or higher priority that make a new one rejected.
+        :param queue_timeout_s: Max wait for a slot, seconds.
+        """
+        self.backend = backend
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_queue_depth = max_queue_depth
+        self.queue_timeout_s = queue_timeout_s
+        self._active = 0
+        self._heap: List[Any] = []
+        self._waiting = {priority: 0 for priority in PRIORITY_NAMES}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _enter(self, priority: int, loop: asyncio.AbstractEventLoop) -> Optional[_Waiter]:
+        """
+        Takes a free slot (returns None) or queues a waiter; raises when the queue ahead is too deep.
+        """
+        with self._lock:
+            ahead = sum(n for p, n in self._waiting.items() if p <= priority)
+            if self._active < self.max_concurrency and ahead == 0:
+                self._active += 1
+                return None
+            if ahead >= self.max_queue_depth:
+                rejected = True
+            else:
+                rejected = False
+                waiter = _Waiter(priority, loop)
+                heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+                self._waiting[priority] += 1
+        if rejected:
+            self._reject(priority, "queue_full")
+            raise OverloadedError(f"LLM backend '{self.backend}' is busy: {ahead} requests waiting.")
+        return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """
+        Takes a waiter that gave up out of the queue. Returns True if it got the slot meanwhile.
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.abandoned = True
+            self._waiting[waiter.priority] -= 1
+            return False
+
+    def _granted(self, waiter: _Waiter):
+        metrics.observe("llm_queue_wait_ms", (time.perf_counter() - waiter.enqueued) * 1000,
+                        backend=self.backend, priority=PRIORITY_NAMES[waiter.priority])
+
+    def _reject(self, priority: int, reason: str):
+        metrics.inc("llm_rejected", backend=self.backend, priority=PRIORITY_NAMES[priority], reason=reason)
+        print(f"{WARNING_COLOR}LLM scheduler ({self.backend}): rejected {PRIORITY_NAMES[priority]} request ({reason}){Colors.RESET}")
+
+    def release(self):
+        with self._lock:
+            self._active -= 1
+            while self._heap and self._active < self.max_concurrency:
+                _, _, waiter = heapq.heappop(self._heap)
+                if waiter.abandoned:
+                    continue
+                waiter.granted = True
+                self._waiting[waiter.priority] -= 1
+                self._active += 1
+                waiter.wake()
+
+    async def aacquire(self, priority: Optional[int] = None):
+        priority = current_priority.get() if priority is None else priority
+        waiter = self._enter(priority, asyncio.get_running_loop())
+        if waiter is None:
+            metrics.observe("llm_queue_wait_ms", 0.0, backend=self.backend, priority=PRIORITY_NAMES[priority])
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout_s)
+        except asyncio.TimeoutError:
+            if not self._abandon(waiter):
+                self._reject(priority, "timeout")
+                raise OverloadedError(f"LLM backend '{self.backend}' is busy: no free slot in {self.queue_timeout_s:g}s.")
+        except asyncio.CancelledError:
+            if self._abandon(waiter):
+                self.release()
+            raise
+        self._granted(waiter)
+
+    def check_admission(self, priority: int = INTERACTIVE):
+        """
+        Raises OverloadedError if a request of `priority` would be rejected now (for a fast 429
+        before a response stream starts).
+        """
+        with self._lock:
+            ahead = sum(n for p, n in self._waiting.items() if p <= priority)
+        if ahead >= self.max_queue_depth:
+            self._reject(priority, "queue_full")
+            raise OverloadedError(f"LLM backend '{self.backend}' is busy: {ahead} requests waiting.")
+
+    @asynccontextmanager
+    async def aslot(self, priority: Optional[int] = None):
+        await self.aacquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def wrap_acomplete(self, fn):
+        @functools.wraps(fn)
+        async def acomplete(*args, **kwargs):
+            async with self.aslot():
+                return await fn(*args, **kwargs)
+        return acomplete
+
+    def wrap_astream(self, fn):
+        @functools.wraps(fn)
+        async def astream(*args, **kwargs):
+            async with self.aslot():
+                async for delta in fn(*args, **kwargs):
+                    yield delta
+        return astream
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "active": self._active,
+                "max_concurrency": self.max_concurrency,
+                "waiting": {PRIORITY_NAMES[p]: n for p, n in self._waiting.items()},
+                "max_queue_depth": self.max_queue_depth,
+                "queue_timeout_s": self.queue_timeout_s,
+            }
@@ -1,7 +1,10 @@
 import os
 from dotenv import load_dotenv
 
-from fastapi import FastAPI
+# Load .env before importing modules that read settings at import time
+load_dotenv(override=True)
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 # Import dependencies
@@ -10,9 +13,15 @@ from app.embedding_client import EmbeddingClient
 from app.chroma_client import ChromaClient
 from app.thread_store import ThreadStore
 from app.agent import Agent
+from app.context_packer import ContextPacker
+from app.intent_router import IntentRouter
 from app.settings_store import SettingsStore
-
-load_dotenv(override=True)
+from app.http_pool import http_pool
+from app.llm_log import llm_log
+from app.tracing import tracer
+from app.llm_scheduler import OverloadedError
+from app.resilience import BackendUnavailable
+from app.utils.helpers import safe_json
 
 
 STORAGE_RAW_DIR = os.getenv("STORAGE_RAW_DIR", "./storage/raw")
@@ -40,14 +49,25 @@ os.makedirs(STORAGE_RAW_DIR, exist_ok=True)
 os.makedirs(CHROMA_PERSIST_DIR, exist_ok=True)
 LAUNCH_CONFIG_DIR = "./app/launch_configs"
 
+# Пулы HTTP-соединений: по одному на бэкенд, keep-alive, свои лимиты и таймауты.
+# Настраиваем до создания клиентов — Gemini получает свой httpx-клиент при создании.
+http_pool.configure("llama", read_timeout=LLAMACPP_TIMEOUT_S, max_connections=int(os.getenv("LLAMACPP_MAX_CONNECTIONS", "8")))
+http_pool.configure("embed", read_timeout=LLAMACPP_TIMEOUT_S, max_connections=int(os.getenv("EMBED_MAX_CONNECTIONS", "8")))
+http_pool.configure("openrouter", http2=True, max_connections=int(os.getenv("CLOUD_MAX_CONNECTIONS", "10")))
+http_pool.configure("gemini", http2=True, max_connections=int(os.getenv("CLOUD_MAX_CONNECTIONS", "10")))
+http_pool.configure("mcp", read_timeout=float(os.getenv("MCP_TIMEOUT_S", "30")), max_connections=4)
+
 # Initialize global dependencies
 llm_client = Generator(LLAMACPP_CHAT_BASE)
 embed_client = EmbeddingClient(LLAMACPP_EMBED_BASE)
-chroma_client = ChromaClient(embed_client, CHROMA_PERSIST_DIR)
+chroma_client = ChromaClient(embed_client, CHROMA_PERSIST_DIR, raw_dir=STORAGE_RAW_DIR)
 thread_store = ThreadStore()
 settings_store = SettingsStore()
 initial_settings = settings_store.get_settings()
-agent = Agent(llm_client, chroma_client, thread_store, language=initial_settings.get("language", "Russian"))
+context_packer = ContextPacker(context_size=llm_client.context_size, max_context_chars=MAX_CONTEXT_CHARS, top_k=DEFAULT_TOP_K)
+intent_router = IntentRouter(embed_client)
+agent = Agent(llm_client, chroma_client, thread_store, language=initial_settings.get("language", "Russian"), packer=context_packer,
+              intent_router=intent_router)
 
 # Import controllers after dependencies are initialized
 from app.controllers.server_controller import router as server_router
@@ -59,10 +79,42 @@ from app.controllers.util_controller import get_util_router
 document_router = get_document_router(llm_client, embed_client, chroma_client, thread_store, agent)
 thread_router = get_thread_router(llm_client, embed_client, chroma_client, thread_store, agent)
 settings_router = get_settings_router(llm_client, embed_client, chroma_client, thread_store, settings_store, agent)
-util_router = get_util_router(llm_client, embed_client)
+util_router = get_util_router(llm_client, embed_client, intent_router)
 
 app = FastAPI(title="RAGgie BOY", version="0.0.1")
 
+
+@app.exception_handler(OverloadedError)
+async def llm_overloaded_handler(request: Request, exc: OverloadedError):
+    # LLM admission control rejected the request: the client should retry later
+    response = safe_json({"detail": str(exc)}, status_code=429)
+    response.headers["Retry-After"] = str(int(exc.retry_after_s))
+    return response
+
+
+@app.exception_handler(BackendUnavailable)
+async def llm_unavailable_handler(request: Request, exc: BackendUnavailable):
+    # the circuit breaker of the LLM backend is open: fail fast until the probe succeeds
+    response = safe_json({"detail": str(exc)}, status_code=503)
+    response.headers["Retry-After"] = str(max(int(exc.retry_after_s), 1))
+    return response
+
+
+@app.on_event("startup")
+def start_llm_router():
+    if llm_client.router is not None:
+        llm_client.router.start_health_checks()
+
+
+@app.on_event("shutdown")
+async def close_http_pool():
+    if llm_client.router is not None:
+        llm_client.router.stop_health_checks()
+    await http_pool.aclose()
+    llm_log.close()
+    tracer.close()
+
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -70,6 +122,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # readable by the frontend: when to retry a rejected chat turn, and the trace of a turn
+    expose_headers=["Retry-After", "X-Trace-Id"],
 )
 
 # Include controllers
@@ -0,0 +1,56 @@
+import threading
+import time
+from typing import Any, Dict
+
+
+def _label_key(labels: Dict[str, Any]) -> str:
+    return ",".join(f"{k}={labels[k]}" for k in sorted(labels))
+
+
+class Metrics:
+    """
+    In-process counters and value summaries (count / sum / min / max), optionally labelled,
+    served as JSON at `/api/metrics`. Safe to update from worker threads.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._counters: Dict[str, Dict[str, float]] = {}
+        self._summaries: Dict[str, Dict[str, Dict[str, float]]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            summary = self._summaries.setdefault(name, {}).get(key)
+            if summary is None:
+                self._summaries[name][key] = {"count": 1, "sum": value, "min": value, "max": value}
+                return
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["min"] = min(summary["min"], value)
+            summary["max"] = max(summary["max"], value)
+
+    def get(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_label_key(labels), 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        All series as {name: {"label=value,...": value}}; summaries also get their mean.
+        """
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            summaries: Dict[str, Dict[str, Dict[str, float]]] = {
+                name: {key: dict(s, mean=s["sum"] / s["count"]) for key, s in series.items()}
+                for name, series in self._summaries.items()}
+        return {"uptime_s": round(time.time() - self.started, 1), "counters": counters, "summaries": summaries}
+
+
+metrics = Metrics()
@@ -1,10 +1,16 @@
+import asyncio
 import os
-import json
-import requests
-from typing import Optional, List
+import time
+import httpx
+from typing import AsyncIterator, Optional, List
 from pydantic import BaseModel, Field
 from app.schemas import LLamaMessageHistory
 from app.colors import *
+from app.http_pool import get_async_client
+from app.llm_log import llm_log
+from app.metrics import metrics
+from app.usage import record_openai_usage
+from app.utils.sse import aiter_openai_deltas
 
 
 class QwenGenAI:
@@ -25,24 +31,9 @@ class QwenGenAI:
     def get_model(self):
         return self.model_name
     
-    def complete(self,
-                 system_prompt: Optional[str] = None,
-                 user: Optional[str] = None,
-                 temperature: Optional[float] = 0.7,
-                 max_tokens: Optional[int] = 1024,
-                 payload: Optional[LLamaMessageHistory] = None) -> str:
+    def _request(self, system_prompt, user, temperature, max_tokens, payload, json_schema=None):
         """
-        Generates a response from the Qwen model via OpenRouter API.
-
-        Args:
-            system_prompt: The system instruction or context.
-            user: The user's prompt (used if payload is not provided).
-            temperature: The sampling temperature.
-            max_tokens: The maximum number of tokens to generate.
-            payload: A message history object.
-
-        Returns:
-            The generated text response from the model.
+        Builds the OpenRouter request headers and body from a prompt or a message history.
         """
         system_prompt = system_prompt or ""
         
@@ -81,38 +72,112 @@ class QwenGenAI:
             "temperature": temperature,
             "max_tokens": max_tokens,
         }
+        if json_schema is not None:
+            data["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": json_schema.get("title", "response"), "strict": True, "schema": json_schema},
+            }
 
-        print("Messages sent to Qwen model:")
-        print(json.dumps(messages, indent=2))
-        
+        return headers, data
+
+    async def acomplete(self,
+                        system_prompt: Optional[str] = None,
+                        user: Optional[str] = None,
+                        temperature: Optional[float] = 0.7,
+                        max_tokens: Optional[int] = 1024,
+                        payload: Optional[LLamaMessageHistory] = None,
+                        json_schema: Optional[dict] = None) -> str:
+        """
+        Generates a response from the Qwen model via OpenRouter API.
+
+        Args:
+            system_prompt: The system instruction or context.
+            user: The user's prompt (used if payload is not provided).
+            temperature: The sampling temperature.
+            max_tokens: The maximum number of tokens to generate.
+            payload: A message history object.
+            json_schema: JSON schema for OpenRouter structured outputs (response_format).
+
+        Returns:
+            The generated text response from the model.
+
+        Raises:
+            httpx.HTTPError and parsing errors of the response; retries are up to the caller.
+        """
+        headers, data = self._request(system_prompt, user, temperature, max_tokens, payload, json_schema)
+        started = time.perf_counter()
         try:
-            response = requests.post(self.base_url, headers=headers, json=data)
+            response = await get_async_client("openrouter").post(self.base_url, headers=headers, json=data)
             response.raise_for_status()
-            
-            result = response.json()
-            
-            # Extract the content from the response
-            content = result['choices'][0]['message']['content']
-            
-            print(f"{INFO_COLOR}Response from {self.__class__.__name__}:{Colors.RESET} {content}")
-            
-            # Write response to file for debugging
-            with open("./storage/dev/response.txt", "a", encoding="utf-8") as f:
-                f.write("\n" + "-" * 10)
-                f.write(str(content))
-                f.write("\n" + "-" * 10)
-            
+            content = self._content(response.json(), started)
+            self._log_response(data, content, started)
             return content
-        except requests.exceptions.RequestException as e:
-            print(f"{ERROR_COLOR}Error during Qwen model API call: {e}{Colors.RESET}")
-            if hasattr(e, 'response') and e.response is not None:
-                print(f"Response status code: {e.response.status_code}")
-                try:
-                    error_detail = e.response.json()
-                    print(f"Error details: {error_detail}")
-                except:
-                    print(f"Response text: {e.response.text}")
-            return f"An error occurred: {e}"
+        except asyncio.CancelledError as e:
+            metrics.inc("llm_calls_cancelled", backend="qwen")
+            self._log_response(data, None, started, error=e)
+            raise
+        except Exception as e:
+            self._log_response(data, None, started, error=e)
+            self._report_error(e)
+            raise
+
+    def _content(self, result: dict, started: float) -> str:
+        # Extract the content from the response
+        content = result['choices'][0]['message']['content']
+        record_openai_usage("qwen", result.get("usage"), None, (time.perf_counter() - started) * 1000)
+
+        print(f"{INFO_COLOR}Response from {self.__class__.__name__}:{Colors.RESET} {len(content or '')} chars")
+        return content
+
+    def _log_response(self, data: dict, content: Optional[str], started: float, error: Optional[BaseException] = None):
+        llm_log.log("qwen", request=data, response=content, error=error, model=self.model_name,
+                    mode="stream" if data.get("stream") else "complete",
+                    duration_ms=round((time.perf_counter() - started) * 1000, 1))
+
+    def _report_error(self, e: Exception):
+        print(f"{ERROR_COLOR}Error during Qwen model API call: {e}{Colors.RESET}")
+        if isinstance(e, httpx.HTTPStatusError):
+            print(f"Response status code: {e.response.status_code}")
+            try:
+                error_detail = e.response.json()
+                print(f"Error details: {error_detail}")
+            except:
+                print(f"Response text: {e.response.text}")
+
+    async def astream(self,
+                      system_prompt: Optional[str] = None,
+                      user: Optional[str] = None,
+                      temperature: Optional[float] = 0.7,
+                      max_tokens: Optional[int] = 1024,
+                      payload: Optional[LLamaMessageHistory] = None,
+                      json_schema: Optional[dict] = None) -> AsyncIterator[str]:
+        """
+        Same as `acomplete`, but yields text deltas as OpenRouter streams them.
+
+        Yields:
+            Generated text deltas.
+        """
+        headers, data = self._request(system_prompt, user, temperature, max_tokens, payload, json_schema)
+        data["stream"] = True
+        # OpenRouter sends token usage in the last event
+        data["usage"] = {"include": True}
+
+        parts = []
+        meta: dict = {}
+        started = time.perf_counter()
+        try:
+            async with get_async_client("openrouter").stream("POST", self.base_url, headers=headers, json=data) as response:
+                response.raise_for_status()
+                async for delta in aiter_openai_deltas(response.aiter_lines(), meta):
+                    parts.append(delta)
+                    yield delta
+        except (asyncio.CancelledError, GeneratorExit) as e:
+            # leaving the `async with` closes the OpenRouter stream
+            metrics.inc("llm_calls_cancelled", backend="qwen")
+            self._log_response(data, "".join(parts), started, error=e)
+            raise
         except Exception as e:
-            print(f"{ERROR_COLOR}Unexpected error during Qwen model call: {e}{Colors.RESET}")
-            return f"An unexpected error occurred: {e}"
\ No newline at end of file
+            self._log_response(data, "".join(parts), started, error=e)
+            raise
+        record_openai_usage("qwen", meta.get("usage"), None, (time.perf_counter() - started) * 1000)
+        self._log_response(data, "".join(parts), started)
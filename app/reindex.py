@@ -0,0 +1,63 @@
+# app/reindex.py
+"""
+Re-chunks and re-embeds stored documents from their cached extracted text.
+
+    python -m app.reindex --all
+    python -m app.reindex <doc_id> [<doc_id> ...] --chunk-unit tokens --chunk-size 384
+
+Chunking parameters default to the configured CHUNK_* settings.
+"""
+import argparse
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+from app.chroma_client import ChromaClient, chunking_params
+from app.colors import ERROR_COLOR, INFO_COLOR, SUCCESS_COLOR, Colors
+from app.embedding_client import EmbeddingClient
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Rebuild chunks and embeddings from cached extracted text")
+    parser.add_argument("doc_ids", nargs="*", help="documents to re-index")
+    parser.add_argument("--all", action="store_true", help="re-index every document")
+    parser.add_argument("--chunk-unit", choices=["words", "tokens"], default=None)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--chunk-overlap", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if not args.doc_ids and not args.all:
+        parser.error("pass document ids or --all")
+
+    size, overlap, unit = chunking_params(args.chunk_unit)
+    size = args.chunk_size or size
+    overlap = args.chunk_overlap if args.chunk_overlap is not None else overlap
+
+    embed_client = EmbeddingClient(os.getenv("LLAMACPP_EMBED_BASE", "http://127.0.0.1:11435").replace("localhost", "127.0.0.1"))
+    chroma_client = ChromaClient(
+        embed_client,
+        os.getenv("CHROMA_PERSIST_DIR", "./storage/chroma"),
+        raw_dir=os.getenv("STORAGE_RAW_DIR", "./storage/raw"),
+    )
+    doc_ids = args.doc_ids or [doc["id"] for doc in chroma_client.get_all_documents()]
+
+    print(f"{INFO_COLOR}Re-indexing {len(doc_ids)} documents: unit={unit} size={size} overlap={overlap}{Colors.RESET}")
+    failed = 0
+    t0 = time.perf_counter()
+    for doc_id in doc_ids:
+        try:
+            chunks = chroma_client.reindex_document(doc_id, size, overlap, unit)
+            print(f"{SUCCESS_COLOR}{doc_id}: {chunks} chunks{Colors.RESET}")
+        except Exception as e:
+            failed += 1
+            print(f"{ERROR_COLOR}{doc_id}: {e}{Colors.RESET}")
+    print(f"{INFO_COLOR}Done in {time.perf_counter() - t0:.1f}s, {failed} failed.{Colors.RESET}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
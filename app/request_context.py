@@ -0,0 +1,63 @@
+import os
+import threading
+from contextvars import ContextVar
+from typing import Optional
+
+from app.usage import TurnUsage, current_usage
+
+# Priority classes of LLM work (lower is served first, see LlmScheduler)
+INTERACTIVE, FOLLOW_UP, BACKGROUND = 0, 1, 2
+# Retries of LLM calls (transient errors and malformed output) allowed per chat turn
+LLM_RETRY_BUDGET = int(os.getenv("LLM_RETRY_BUDGET", "6"))
+
+
+class RetryBudget:
+    """
+    Retries left to the LLM calls of one chat turn, shared by its tasks and worker threads.
+    A budget with a parent (one structured call within a turn) spends from both.
+    """
+
+    def __init__(self, retries: int, parent: Optional["RetryBudget"] = None):
+        self.remaining = retries
+        self.spent = 0
+        self.parent = parent
+        self._lock = threading.Lock()
+
+    def spend(self) -> bool:
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            if self.parent is not None and not self.parent.spend():
+                return False
+            self.remaining -= 1
+            self.spent += 1
+            return True
+
+
+# Thread of the chat turn being processed: LLM clients use it for slot affinity.
+current_thread_id: ContextVar[Optional[str]] = ContextVar("current_thread_id", default=None)
+# Priority of LLM calls made from the current context; work outside a chat turn is background
+current_priority: ContextVar[int] = ContextVar("current_priority", default=BACKGROUND)
+# Retries left to the current chat turn; work outside a turn has no budget (per-call limits only)
+current_retry_budget: ContextVar[Optional[RetryBudget]] = ContextVar("current_retry_budget", default=None)
+
+
+def begin_turn(thread_id: Optional[str]) -> TurnUsage:
+    """
+    Marks the start of a chat turn in the current context (the request's task);
+    LLM and embedding calls made from it, including `asyncio.to_thread` workers, are
+    attributed to it (usage), scheduled as interactive, and their retries share one RetryBudget.
+    """
+    usage = TurnUsage()
+    current_thread_id.set(thread_id)
+    current_usage.set(usage)
+    current_priority.set(INTERACTIVE)
+    current_retry_budget.set(RetryBudget(LLM_RETRY_BUDGET))
+    return usage
+
+
+def set_priority(priority: int):
+    """
+    Sets the priority of the following LLM calls of the current context (e.g. FOLLOW_UP for research iterations).
+    """
+    current_priority.set(priority)
@@ -0,0 +1,333 @@
+import asyncio
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+import httpx
+
+from app.colors import ERROR_COLOR, SUCCESS_COLOR, WARNING_COLOR, Colors
+from app.llm_scheduler import OverloadedError
+from app.metrics import metrics
+from app.request_context import current_retry_budget
+
+# Retries of one LLM call after transient errors (network, timeouts, 5xx, 429), not counting the first attempt
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+# Exponential backoff with full jitter: a random delay up to min(max, base * 2^attempt)
+LLM_RETRY_BASE_DELAY_S = float(os.getenv("LLM_RETRY_BASE_DELAY_S", "0.5"))
+LLM_RETRY_MAX_DELAY_S = float(os.getenv("LLM_RETRY_MAX_DELAY_S", "10"))
+# Longest Retry-After of a 429/503 that is waited out; a longer one fails the call
+LLM_RETRY_AFTER_MAX_S = float(os.getenv("LLM_RETRY_AFTER_MAX_S", "30"))
+# Consecutive failed calls that open the circuit, and how long it stays open before a probe
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_S = float(os.getenv("LLM_BREAKER_RESET_S", "30"))
+
+# Error classes (see `classify`)
+RETRYABLE = "retryable"        # the backend is unreachable, timed out or failing: back off and retry
+RATE_LIMITED = "rate_limited"  # 429: retry after Retry-After
+BAD_OUTPUT = "bad_output"      # the model answered, but not with valid JSON / schema: re-ask
+FATAL = "fatal"                # a bad request or an open circuit: retrying won't help
+
+RETRYABLE_STATUS = {408, 409, 425, 500, 502, 503, 504}
+
+
+class BackendUnavailable(Exception):
+    """
+    The circuit breaker of an LLM backend is open: calls fail fast until it recovers.
+    Served as HTTP 503 with Retry-After.
+    """
+
+    def __init__(self, message: str, retry_after_s: float = 5.0):
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+def status_code(e: BaseException) -> Optional[int]:
+    """
+    HTTP status of a failed call: httpx errors and google-genai `APIError` (`code`).
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code
+    code = getattr(e, "code", None)
+    return code if isinstance(code, int) and 100 <= code < 600 else None
+
+
+def classify(e: BaseException) -> str:
+    if isinstance(e, (BackendUnavailable, OverloadedError)):
+        return FATAL
+    if isinstance(e, (httpx.TransportError, ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return RETRYABLE
+    code = status_code(e)
+    if code == 429:
+        return RATE_LIMITED
+    if code is not None:
+        return RETRYABLE if code in RETRYABLE_STATUS or code >= 500 else FATAL
+    if isinstance(e, ValueError):  # json.JSONDecodeError, pydantic ValidationError, empty answers
+        return BAD_OUTPUT
+    return FATAL
+
+
+def retry_after(e: BaseException) -> Optional[float]:
+    """
+    Seconds from the Retry-After header of the failed response (delta-seconds or an HTTP date).
+    """
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def allow_retry(backend: str, reason: str) -> bool:
+    """
+    Takes one retry from the current budget (a structured call's, which also spends from its
+    chat turn's); False (and counted) when it is spent. Direct calls outside a chat turn have no budget.
+    """
+    budget = current_retry_budget.get()
+    if budget is None or budget.spend():
+        metrics.inc("llm_retries", backend=backend, reason=reason)
+        return True
+    metrics.inc("llm_retry_budget_exhausted", backend=backend)
+    print(f"{WARNING_COLOR}LLM {backend}: retry budget of the request is spent, not retrying{Colors.RESET}")
+    return False
+
+
+class CircuitBreaker:
+    """
+    Per-backend circuit breaker.
+
+    Closed: calls pass, consecutive failures (RETRYABLE / RATE_LIMITED errors) are counted.
+    After `failure_threshold` of them the circuit opens and calls fail fast with
+    BackendUnavailable for `reset_timeout_s`. Then it is half-open: a single probe call is let
+    through; its success closes the circuit, its failure opens it again.
+    Bad requests and malformed output don't count: the backend did answer.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, backend: str,
+                 failure_threshold: int = LLM_BREAKER_FAILURES,
+                 reset_timeout_s: float = LLM_BREAKER_RESET_S):
+        """
+        :param backend: Backend name for metrics and messages.
+        :param failure_threshold: Consecutive failures that open the circuit (0 disables the breaker).
+        :param reset_timeout_s: How long the circuit stays open before a probe, seconds.
+        """
+        self.backend = backend
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        # called under the lock
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+        metrics.inc("llm_breaker_transitions", backend=self.backend, state=state)
+        color = SUCCESS_COLOR if state == self.CLOSED else ERROR_COLOR if state == self.OPEN else WARNING_COLOR
+        print(f"{color}LLM {self.backend}: circuit {state} ({self.failures} consecutive failures){Colors.RESET}")
+
+    def _admit(self) -> bool:
+        """
+        Lets a call through or raises BackendUnavailable. Returns True for the half-open probe.
+        """
+        if self.failure_threshold <= 0:
+            return False
+        with self._lock:
+            wait = 0.0
+            if self.state == self.OPEN:
+                wait = self.opened_at + self.reset_timeout_s - time.monotonic()
+                if wait <= 0:
+                    self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if not self._probing:
+                    self._probing = True
+                    return True
+                wait = self.reset_timeout_s
+            if wait <= 0:
+                return False
+            self.rejected += 1
+        metrics.inc("llm_breaker_rejected", backend=self.backend)
+        raise BackendUnavailable(f"LLM backend '{self.backend}' is unavailable (circuit open).", retry_after_s=max(wait, 1.0))
+
+    def _record(self, probe: bool, error: Optional[BaseException]):
+        if self.failure_threshold <= 0:
+            return
+        failed = error is not None and classify(error) in (RETRYABLE, RATE_LIMITED)
+        with self._lock:
+            if probe:
+                self._probing = False
+            if failed:
+                self.failures += 1
+                if probe or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                    self._set_state(self.OPEN)
+            else:
+                self.failures = 0
+                if probe:
+                    self._set_state(self.CLOSED)
+
+    @contextmanager
+    def guard(self):
+        """
+        Wraps one backend call (a whole stream included).
+        """
+        probe = self._admit()
+        try:
+            yield
+        except OverloadedError:
+            # rejected by the local scheduler: the backend was never contacted
+            self._release_probe(probe)
+            raise
+        except Exception as e:
+            self._record(probe, e)
+            raise
+        except BaseException:
+            # cancelled: says nothing about the backend, just free the probe
+            self._release_probe(probe)
+            raise
+        else:
+            self._record(probe, None)
+
+    def _release_probe(self, probe: bool):
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            opened_for = time.monotonic() - self.opened_at if self.state != self.CLOSED else 0.0
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "open_for_s": round(opened_for, 1),
+                "reset_timeout_s": self.reset_timeout_s,
+                "rejected": self.rejected,
+            }
+
+
+class Resilience:
+    """
+    Retries with backoff and a circuit breaker around the calls of one LLM backend.
+
+    Only RETRYABLE and RATE_LIMITED errors are retried, up to `max_retries` times, after an
+    exponential backoff with full jitter, or after the server's Retry-After (up to
+    `max_retry_after_s`). Every retry is taken from the chat turn's budget
+    (`request_context.RetryBudget`), so one request can't multiply load during an outage.
+    Streams are retried only while nothing has been yielded. Fatal errors and BAD_OUTPUT
+    are raised at once (malformed output is re-asked by Generator, on the same budget).
+    Wrap the scheduled function: backoff sleeps then don't hold a scheduler slot.
+    """
+
+    def __init__(self, backend: str,
+                 max_retries: int = LLM_MAX_RETRIES,
+                 base_delay_s: float = LLM_RETRY_BASE_DELAY_S,
+                 max_delay_s: float = LLM_RETRY_MAX_DELAY_S,
+                 max_retry_after_s: float = LLM_RETRY_AFTER_MAX_S,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        :param backend: Backend name for metrics and messages.
+        :param max_retries: Retries of one call after transient errors.
+        :param base_delay_s: Backoff of the first retry (upper bound of its jitter), seconds.
+        :param max_delay_s: Backoff cap, seconds.
+        :param max_retry_after_s: Longest Retry-After waited out, seconds.
+        :param breaker: Circuit breaker of the backend (a default one if omitted).
+        """
+        self.backend = backend
+        self.max_retries = max_retries
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.max_retry_after_s = max_retry_after_s
+        self.breaker = breaker or CircuitBreaker(backend)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** attempt))
+
+    def retry_delay(self, attempt: int, error: BaseException) -> Optional[float]:
+        """
+        Delay before retrying a call that failed with `error` on `attempt` (0-based), or None to give up.
+        """
+        kind = classify(error)
+        if kind not in (RETRYABLE, RATE_LIMITED) or attempt >= self.max_retries:
+            return None
+        if self.breaker.state == CircuitBreaker.OPEN:
+            # this failure opened the circuit: a retry would only be rejected
+            return None
+        delay = self.backoff(attempt)
+        wait = retry_after(error)
+        if wait is not None:
+            if wait > self.max_retry_after_s:
+                print(f"{WARNING_COLOR}LLM {self.backend}: Retry-After {wait:g}s is too long, not retrying{Colors.RESET}")
+                return None
+            delay = wait + random.uniform(0, self.base_delay_s)
+        if not allow_retry(self.backend, kind):
+            return None
+        message = str(error).splitlines()[0] if str(error) else ""
+        print(f"{WARNING_COLOR}LLM {self.backend}: {type(error).__name__}: {message}; "
+              f"retry {attempt + 1}/{self.max_retries} in {delay:.1f}s{Colors.RESET}")
+        return delay
+
+    def wrap_acomplete(self, fn):
+        @functools.wraps(fn)
+        async def acomplete(*args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    with self.breaker.guard():
+                        return await fn(*args, **kwargs)
+                except Exception as e:
+                    delay = self.retry_delay(attempt, e)
+                    if delay is None:
+                        raise
+                attempt += 1
+                await asyncio.sleep(delay)
+        return acomplete
+
+    def wrap_astream(self, fn):
+        @functools.wraps(fn)
+        async def astream(*args, **kwargs):
+            attempt = 0
+            while True:
+                started = False
+                try:
+                    with self.breaker.guard():
+                        async for delta in fn(*args, **kwargs):
+                            started = True
+                            yield delta
+                    return
+                except Exception as e:
+                    delay = None if started else self.retry_delay(attempt, e)
+                    if delay is None:
+                        raise
+                attempt += 1
+                await asyncio.sleep(delay)
+        return astream
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "max_retries": self.max_retries,
+            "base_delay_s": self.base_delay_s,
+            "max_delay_s": self.max_delay_s,
+            "max_retry_after_s": self.max_retry_after_s,
+            "breaker": self.breaker.stats(),
+            "retries": {k: v for k, v in metrics.snapshot()["counters"].get("llm_retries", {}).items()
+                        if k.startswith(f"backend={self.backend},")},
+        }
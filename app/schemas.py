@@ -69,6 +69,7 @@ class ResponseWithRetrieval(BaseModel):
     """
     answer: str = Field(description="The generated answer to the user's query. (MarkDown is suppoted)")
     any_more_info_needed: Optional[str] = Field(None, description="Any additional information in context of documents if not enough to fulfill user query.")
+    search_queries: List[str] = Field(default_factory=list, description="If more information is needed: short, independent search queries, each for a different missing part.")
     
 class ResponseWithoutRetrieval(BaseModel):
     """
@@ -121,6 +122,12 @@ class ChunkQuery(BaseModel):
     text: str
     top_k: int = 5
 
+class ReindexRequest(BaseModel):
+    doc_ids: Optional[List[str]] = None
+    chunk_size: Optional[int] = None
+    chunk_overlap: Optional[int] = None
+    chunk_unit: Optional[Literal["words", "tokens"]] = None
+
 class ChunkQueryResult(BaseModel):
     id: str
     text: str
@@ -131,6 +138,21 @@ class AgentResponse(BaseModel):
     answer: str
     retrieved_docs: Optional[List[RetrievedDocument]] = None
     follow_up: Optional[bool] = None
+
+class AgentDelta(BaseModel):
+    """
+    A piece of the answer being generated; the AgentResponse that follows carries the full text.
+    reset=True means the text streamed so far is discarded (the generation is being retried).
+    """
+    delta: str
+    reset: bool = False
+
+
+class AgentUsage(BaseModel):
+    """
+    Token and time usage of the chat turn (see app/usage.py), sent as the last event of the stream.
+    """
+    usage: Dict[str, Any]
     
     
 class ServerStartRequest(BaseModel):
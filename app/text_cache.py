@@ -0,0 +1,63 @@
+import gzip
+import hashlib
+import os
+import threading
+from typing import Optional
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """
+    Returns the SHA-256 of a file, reading it in blocks.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class TextCache:
+    """
+    Stores normalized extracted text of raw documents as gzip files keyed by
+    the raw file's content hash: `<raw_dir>/<sha256>.txt.gz`.
+
+    Lets documents be re-chunked and re-embedded without re-running the slow
+    PDF/DOCX extraction.
+    """
+
+    def __init__(self, raw_dir: str = os.getenv("STORAGE_RAW_DIR", "./storage/raw")):
+        """
+        :param raw_dir: Directory with the raw uploaded files (STORAGE_RAW_DIR).
+        """
+        self.raw_dir = raw_dir
+        os.makedirs(self.raw_dir, exist_ok=True)
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.raw_dir, f"{sha256}.txt.gz")
+
+    def get(self, sha256: str) -> Optional[str]:
+        """
+        Returns the cached text for the content hash, or None if it isn't cached.
+        """
+        try:
+            with gzip.open(self.path(sha256), "rt", encoding="utf-8") as f:
+                return f.read()
+        except (OSError, EOFError):
+            return None
+
+    def put(self, sha256: str, text: str):
+        """
+        Caches the text for the content hash. Written to a temp file first so
+        a crash never leaves a truncated cache entry behind.
+        """
+        path = self.path(sha256)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"  # concurrent writers of the same file
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def delete(self, sha256: str):
+        try:
+            os.remove(self.path(sha256))
+        except FileNotFoundError:
+            pass
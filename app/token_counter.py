@@ -0,0 +1,119 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from app.colors import WARNING_COLOR, Colors
+from app.http_pool import get_client
+
+# Which tokenizer to use for counting: "server" (exact, via llama-server /tokenize of the
+# embedding model) or "tiktoken" (local, approximate: cl100k_base is not the embedding model's vocabulary)
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "server")
+# Share of a token limit kept free when counts are approximate (tiktoken or the estimate)
+APPROX_TOKEN_MARGIN = float(os.getenv("APPROX_TOKEN_MARGIN", "0.2"))
+TIKTOKEN_ENCODING = os.getenv("TIKTOKEN_ENCODING", "cl100k_base")
+TOKENIZE_CACHE_SIZE = int(os.getenv("TOKENIZE_CACHE_SIZE", "20000"))
+
+
+class TokenCounter:
+    """
+    Counts tokens of a text either with a local tiktoken encoding or with the
+    llama-server `/tokenize` endpoint (exact for the served model).
+
+    Server results are kept in an LRU cache, since chunking asks for the same
+    sentences several times. If neither tokenizer is reachable, a conservative
+    character-based estimate is used so chunking never fails because of it.
+    Safe to share between threads.
+    """
+
+    def __init__(self, backend: str = CHUNK_TOKENIZER, base: Optional[str] = None, cache_size: int = TOKENIZE_CACHE_SIZE):
+        """
+        :param backend: "tiktoken" or "server".
+        :param base: Base URL of the llama-server, required for the "server" backend.
+        :param cache_size: Max number of texts whose token counts are cached.
+        """
+        if backend == "server" and not base:
+            raise ValueError("Base URL is required for the 'server' tokenizer backend.")
+        self.backend = backend
+        self.base = base
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._encoding = None
+        self._tiktoken_failed = False
+        self._warned = False
+
+    def _get_encoding(self):
+        if self._encoding is None:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        return self._encoding
+
+    def _count_server(self, text: str) -> int:
+        response = get_client("embed").post(
+            f"{self.base}/tokenize",
+            json={"content": text},
+            headers={"Content-Type": "application/json"},
+            timeout=30,
+        )
+        response.raise_for_status()
+        return len(response.json().get("tokens", []))
+
+    @property
+    def exact(self) -> bool:
+        """
+        Whether counts come from the served model's own tokenizer.
+        """
+        return self.backend == "server"
+
+    def safe_limit(self, max_tokens: int) -> int:
+        """
+        Limit to check counts against so that texts fit `max_tokens` of the model: `max_tokens`
+        itself for exact counts, less APPROX_TOKEN_MARGIN for approximate ones.
+        """
+        return max_tokens if self.exact else max(int(max_tokens * (1 - APPROX_TOKEN_MARGIN)), 1)
+
+    def _count_tiktoken(self, text: str) -> int:
+        return len(self._get_encoding().encode(text, disallowed_special=()))
+
+    @staticmethod
+    def _estimate(text: str) -> int:
+        # ~2.5 chars per token is pessimistic for both Russian and English BPE vocabularies
+        return int(len(text) / 2.5) + 1
+
+    def count(self, text: str) -> int:
+        """
+        Returns the number of tokens in the given text.
+        """
+        if not text:
+            return 0
+        with self._lock:
+            cached = self._cache.get(text)
+            if cached is not None:
+                self._cache.move_to_end(text)
+                return cached
+
+        if self.backend != "server" and self._tiktoken_failed:
+            return self._estimate(text)
+        try:
+            if self.backend == "server":
+                n = self._count_server(text)
+            else:
+                n = self._count_tiktoken(text)
+        except Exception as e:
+            # tiktoken fails for good (e.g. encoding can't be downloaded offline),
+            # the server may just be restarting - keep trying it next time
+            self._tiktoken_failed = self.backend != "server"
+            if not self._warned:
+                print(f"{WARNING_COLOR}Tokenizer '{self.backend}' unavailable, falling back to estimate: {e}{Colors.RESET}")
+                self._warned = True
+            return self._estimate(text)
+
+        with self._lock:
+            self._cache[text] = n
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return n
+
+    __call__ = count
@@ -0,0 +1,284 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from app.colors import INFO_COLOR, Colors
+
+TRACING_ENABLED = os.getenv("TRACING", "0") == "1"
+# Send the stage timings of a traced chat turn as the `trace` SSE event
+TRACE_SSE = os.getenv("TRACE_SSE", "1") == "1"
+# OTLP/JSON export, one ExportTraceServiceRequest per line (the OpenTelemetry collector's file format); empty = off
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "./storage/dev/otel_traces.jsonl")
+TRACE_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "raggie-boy")
+
+# OTLP span status codes
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = 0, 1, 2
+
+
+class Span:
+    """
+    A timed stage of a trace. Used as a context manager: entering makes it the parent of
+    spans opened in the same context (including `asyncio.to_thread` workers), leaving records it.
+    """
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "attributes", "start_ns", "end_ns", "status", "error",
+                 "_started", "_previous")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = 0
+        self.end_ns = 0
+        self.status = STATUS_UNSET
+        self.error: Optional[str] = None
+        self._started = 0
+        self._previous: Optional[Span] = None
+
+    def start(self):
+        self.start_ns = time.time_ns()
+        self._started = time.perf_counter_ns()
+
+    def end(self, error: Optional[BaseException] = None):
+        self.end_ns = self.start_ns + time.perf_counter_ns() - self._started
+        if error is not None:
+            self.status = STATUS_ERROR
+            self.error = "cancelled" if isinstance(error, (asyncio.CancelledError, GeneratorExit)) \
+                else f"{type(error).__name__}: {error}"
+        self.trace.add(self)
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def __enter__(self) -> "Span":
+        self._previous = current_span.get()
+        current_span.set(self)
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(exc)
+        # set instead of a reset token: async generators may be resumed in another context copy
+        current_span.set(self._previous)
+        return False
+
+
+class _NoopSpan:
+    """
+    Stands in for a span outside a traced request, so disabled tracing costs one ContextVar lookup.
+    """
+
+    def set(self, **attributes: Any):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """
+    Spans of one request under a root span named after it; the trace id is OpenTelemetry-compatible
+    (32 hex digits). Spans may finish in worker threads.
+    """
+
+    def __init__(self, name: str, **attributes: Any):
+        self.trace_id = os.urandom(16).hex()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        self.root = Span(self, name, None, attributes)
+        self.root.start()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Stage timings for the `trace` SSE event: spans in start order with their offset from the
+        start of the request and their parent stage.
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start_ns)
+        names = {s.span_id: s.name for s in spans}
+        return {
+            "trace_id": self.trace_id,
+            "duration_ms": round(self.root.duration_ms, 1),
+            "spans": [{"name": s.name, "parent": names.get(s.parent_id),  # type: ignore
+                       "start_ms": round((s.start_ns - self.root.start_ns) / 1e6, 1),
+                       "duration_ms": round(s.duration_ms, 1), **({"error": s.error} if s.error else {}),
+                       **s.attributes}
+                      for s in spans if s is not self.root],
+        }
+
+    def to_otlp(self, service_name: str = TRACE_SERVICE_NAME) -> Dict[str, Any]:
+        """
+        The trace as an OTLP/JSON ExportTraceServiceRequest.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": service_name})},
+            "scopeSpans": [{
+                "scope": {"name": "app.tracing"},
+                "spans": [{
+                    "traceId": self.trace_id,
+                    "spanId": s.span_id,
+                    **({"parentSpanId": s.parent_id} if s.parent_id else {}),
+                    "name": s.name,
+                    "kind": 2 if s is self.root else 1,  # SERVER / INTERNAL
+                    "startTimeUnixNano": str(s.start_ns),
+                    "endTimeUnixNano": str(s.end_ns),
+                    "attributes": _otlp_attributes(s.attributes),
+                    "status": {"code": s.status, **({"message": s.error} if s.error else {})},
+                } for s in spans],
+            }],
+        }]}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    values = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        values.append({"key": key, "value": typed})
+    return values
+
+
+# Trace of the request being processed and its innermost open span
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def span(name: str, **attributes: Any):
+    """
+    Context manager timing a stage of the current request: `with span("intent"): ...`.
+    Outside a traced request returns a shared no-op span.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return NOOP_SPAN
+    parent = current_span.get()
+    return Span(trace, name, parent.span_id if parent else trace.root.span_id, attributes)
+
+
+def traced(name: str):
+    """
+    Decorator running a (synchronous) function in a span, e.g. ChromaClient and EmbeddingClient calls.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_attributes(**attributes: Any):
+    """
+    Adds attributes to the innermost open span of the current request (no-op outside one).
+    """
+    current = current_span.get()
+    if current is not None and current_trace.get() is current.trace:
+        current.set(**attributes)
+
+
+def current_trace_id() -> Optional[str]:
+    trace = current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+class Tracer:
+    """
+    Starts and finishes request traces: `start` makes a trace current in the calling context,
+    `finish` closes its root span and queues its OTLP/JSON export. Disabled, `start` returns None
+    and the spans of the request are no-ops.
+    """
+
+    def __init__(self, enabled: bool = TRACING_ENABLED, export_path: str = TRACE_EXPORT_PATH, sse: bool = TRACE_SSE):
+        """
+        :param enabled: Trace requests.
+        :param export_path: JSONL file for OTLP/JSON export (empty = no export).
+        :param sse: Send stage timings to the client as the `trace` SSE event.
+        """
+        self.enabled = enabled
+        self.export_path = export_path
+        self.sse = sse
+        self._export_log = None
+        self._lock = threading.Lock()
+        self._stats = {"traces": 0, "spans": 0}
+
+    def start(self, name: str, **attributes: Any) -> Optional[Trace]:
+        if not self.enabled:
+            return None
+        trace = Trace(name, **attributes)
+        self.use(trace)
+        return trace
+
+    @staticmethod
+    def use(trace: Optional[Trace]):
+        """
+        Makes a started trace current in this context (e.g. the task that streams the response).
+        """
+        if trace is not None:
+            current_trace.set(trace)
+            current_span.set(trace.root)
+
+    def finish(self, trace: Optional[Trace], error: Optional[BaseException] = None):
+        if trace is None or trace.root.end_ns:
+            return
+        trace.root.end(error)
+        with self._lock:
+            self._stats["traces"] += 1
+            self._stats["spans"] += len(trace.spans)
+        print(f"{INFO_COLOR}Trace {trace.trace_id}:{Colors.RESET} {trace.root.name} {trace.root.duration_ms:.0f} ms, "
+              f"{len(trace.spans) - 1} spans")
+        if self.export_path:
+            self._exporter().write_record(trace.to_otlp())
+
+    def _exporter(self):
+        with self._lock:
+            if self._export_log is None:
+                # imported here: llm_log uses this module for the trace ids of its records
+                from app.llm_log import LlmTraceLog
+                self._export_log = LlmTraceLog(path=self.export_path, enabled=True, sample_rate=1.0)
+            return self._export_log
+
+    def close(self):
+        if self._export_log is not None:
+            self._export_log.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+        stats.update(enabled=self.enabled, sse=self.sse, export_path=self.export_path)
+        if self._export_log is not None:
+            stats["export"] = self._export_log.stats()
+        return stats
+
+
+tracer = Tracer()
@@ -0,0 +1,173 @@
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+COUNTERS = ("llm_calls", "prompt_tokens", "cached_tokens", "completion_tokens", "prompt_ms", "predicted_ms", "llm_ms",
+            "embed_calls", "embed_texts", "embed_ms")
+
+
+class Usage:
+    """
+    Token and time counters of a group of LLM and embedding calls.
+
+    `prompt_ms` / `predicted_ms` are the server's own prompt processing and generation times
+    (llama-server `timings`); `llm_ms` / `embed_ms` are wall times of the calls as seen by the client.
+    """
+
+    def __init__(self, **counters: float):
+        for name in COUNTERS:
+            setattr(self, name, counters.get(name, 0))
+
+    def add(self, **counters: float):
+        for name, value in counters.items():
+            setattr(self, name, getattr(self, name) + (value or 0))
+
+    def merge(self, other: "Usage"):
+        self.add(**{name: getattr(other, name) for name in COUNTERS})
+
+    def to_dict(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {name: round(getattr(self, name), 1) if name.endswith("_ms") else getattr(self, name)
+                                for name in COUNTERS}
+        data["cache_ratio"] = round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0
+        generation_ms = self.predicted_ms or self.llm_ms
+        data["completion_tokens_per_s"] = round(self.completion_tokens * 1000 / generation_ms, 1) if generation_ms else 0.0
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Usage":
+        return cls(**{name: data.get(name, 0) for name in COUNTERS})
+
+
+class UsageBreakdown:
+    """
+    Usage in total, per agent step and per backend: of one chat turn, of a thread (persisted
+    in its metadata) or of the whole process (`usage_totals`). Safe to update from worker threads.
+    """
+
+    def __init__(self):
+        self.total = Usage()
+        self.steps: Dict[str, Usage] = {}
+        self.backends: Dict[str, Usage] = {}
+        self.turns = 0
+        self._lock = threading.Lock()
+
+    def add(self, step: str, backend: str, **counters: float):
+        with self._lock:
+            self.total.add(**counters)
+            self.steps.setdefault(step, Usage()).add(**counters)
+            self.backends.setdefault(backend, Usage()).add(**counters)
+
+    def merge(self, other: "UsageBreakdown"):
+        with self._lock:
+            self.turns += other.turns
+            self.total.merge(other.total)
+            for name, usage in other.steps.items():
+                self.steps.setdefault(name, Usage()).merge(usage)
+            for name, usage in other.backends.items():
+                self.backends.setdefault(name, Usage()).merge(usage)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "total": self.total.to_dict(),
+                "steps": {name: usage.to_dict() for name, usage in self.steps.items()},
+                "backends": {name: usage.to_dict() for name, usage in self.backends.items()},
+            }
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "UsageBreakdown":
+        breakdown = cls()
+        if not data:
+            return breakdown
+        breakdown.turns = int(data.get("turns", 0))
+        breakdown.total = Usage.from_dict(data.get("total") or {})
+        breakdown.steps = {name: Usage.from_dict(d) for name, d in (data.get("steps") or {}).items()}
+        breakdown.backends = {name: Usage.from_dict(d) for name, d in (data.get("backends") or {}).items()}
+        return breakdown
+
+
+class TurnUsage(UsageBreakdown):
+    """
+    Usage of one chat turn, started by `request_context.begin_turn`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.turns = 1
+        self.started = time.perf_counter()
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = super().to_dict()
+        data["wall_ms"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return data
+
+    def __str__(self) -> str:
+        t = self.total
+        reused = t.cached_tokens / t.prompt_tokens if t.prompt_tokens else 0.0
+        slowest = max(self.steps.items(), key=lambda item: item[1].llm_ms + item[1].embed_ms, default=None)
+        text = (f"{t.llm_calls} LLM calls, prompt {t.prompt_tokens} tokens ({t.cached_tokens} from KV cache, {reused:.0%}), "
+                f"{t.completion_tokens} generated, {t.llm_ms / 1000:.1f}s; {t.embed_calls} embedding calls, {t.embed_ms / 1000:.1f}s")
+        if slowest is not None:
+            text += f"; slowest step: {slowest[0]} ({(slowest[1].llm_ms + slowest[1].embed_ms) / 1000:.1f}s)"
+        return text
+
+
+# Usage of the chat turn (or batch job) being processed and the agent step its calls are attributed to
+current_usage: ContextVar[Optional[UsageBreakdown]] = ContextVar("current_usage", default=None)
+current_step: ContextVar[str] = ContextVar("current_step", default="other")
+
+# Everything since the process started, served at /api/usage/stats
+usage_totals = UsageBreakdown()
+
+
+def set_step(step: str):
+    """
+    Attributes the following LLM and embedding calls of the current context to an agent step.
+    """
+    current_step.set(step)
+
+
+def _record(backend: str, **counters: float):
+    step = current_step.get()
+    usage_totals.add(step, backend, **counters)
+    turn = current_usage.get()
+    if turn is not None:
+        turn.add(step, backend, **counters)
+
+
+def record_llm_usage(backend: str, duration_ms: float, prompt_tokens: int = 0, completion_tokens: int = 0,
+                     cached_tokens: int = 0, prompt_ms: float = 0.0, predicted_ms: float = 0.0):
+    _record(backend, llm_calls=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+            cached_tokens=cached_tokens, prompt_ms=prompt_ms, predicted_ms=predicted_ms, llm_ms=duration_ms)
+
+
+def record_embedding_usage(backend: str, texts: int, duration_ms: float):
+    _record(backend, embed_calls=1, embed_texts=texts, embed_ms=duration_ms)
+
+
+def record_openai_usage(backend: str, usage: Optional[dict], timings: Optional[dict], duration_ms: float) -> Dict[str, int]:
+    """
+    Records an OpenAI-compatible `usage` object (llama-server, OpenRouter) and llama-server
+    `timings`. Returns the prompt / evaluated / cached token counts.
+    """
+    usage, timings = usage or {}, timings or {}
+    # a fully cached prompt reports prompt_n = 0: only a missing field means "unknown"
+    evaluated = int(timings["prompt_n"]) if "prompt_n" in timings else None
+    prompt_tokens = int(usage.get("prompt_tokens") or 0)
+    cached = timings.get("cache_n")
+    if cached is None:
+        details = usage.get("prompt_tokens_details") or {}
+        cached = details.get("cached_tokens")
+    if cached is None:
+        cached = max(prompt_tokens - evaluated, 0) if evaluated is not None else 0
+    cached = int(cached)
+    if evaluated is None:
+        evaluated = max(prompt_tokens - cached, 0)
+    prompt_tokens = prompt_tokens or evaluated + cached
+    completion_tokens = int(usage["completion_tokens"] if "completion_tokens" in usage else timings.get("predicted_n") or 0)
+    record_llm_usage(backend, duration_ms, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                     cached_tokens=cached, prompt_ms=float(timings.get("prompt_ms") or 0),
+                     predicted_ms=float(timings.get("predicted_ms") or 0))
+    return {"prompt_tokens": prompt_tokens, "evaluated_tokens": evaluated, "cached_tokens": cached}
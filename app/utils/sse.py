@@ -0,0 +1,147 @@
+import asyncio
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Iterator, Optional
+
+from app.metrics import metrics
+
+# Как часто проверять, не отключился ли клиент SSE (сек)
+DISCONNECT_POLL_S = 0.5
+# Сколько событий может опережать медленного клиента: дальше генерация ждёт, пока он прочитает
+SSE_QUEUE_SIZE = 32
+
+
+def _sse_data(line: str) -> Optional[str]:
+    if not line or not line.startswith("data:"):
+        return None
+    return line[5:].strip()
+
+
+def _openai_delta(data: str, meta: Optional[dict] = None) -> Optional[str]:
+    event = json.loads(data)
+    if event.get("error"):
+        raise RuntimeError(f"Stream error: {event['error']}")
+    if meta is not None:
+        # llama-server отдаёт timings (и usage) в последнем событии потока
+        for key in ("timings", "usage"):
+            if event.get(key):
+                meta[key] = event[key]
+    choice = (event.get("choices") or [{}])[0]
+    text = (choice.get("delta") or {}).get("content")
+    if text is None:
+        text = choice.get("text")
+    return text
+
+
+def iter_sse_data(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Отдаёт содержимое полей `data:` из потока строк Server-Sent Events.
+    Комментарии (": keep-alive") и прочие поля пропускаются, `[DONE]` завершает поток.
+    """
+    for line in lines:
+        data = _sse_data(line)
+        if data == "[DONE]":
+            return
+        if data:
+            yield data
+
+
+def iter_openai_deltas(lines: Iterable[str], meta: Optional[dict] = None) -> Iterator[str]:
+    """
+    Отдаёт текстовые дельты из потокового ответа OpenAI-совместимого /v1/chat/completions
+    (llama-server, OpenRouter): choices[0].delta.content, у некоторых сборок — choices[0].text.
+    Если передан `meta`, в него складываются поля `timings`/`usage` из событий потока.
+    """
+    for data in iter_sse_data(lines):
+        text = _openai_delta(data, meta)
+        if text:
+            yield text
+
+
+async def aiter_openai_deltas(lines: AsyncIterable[str], meta: Optional[dict] = None) -> AsyncIterator[str]:
+    """
+    Асинхронный вариант `iter_openai_deltas` (для `httpx.AsyncClient`, `response.aiter_lines()`).
+    """
+    async for line in lines:
+        data = _sse_data(line)
+        if data == "[DONE]":
+            return
+        if data:
+            text = _openai_delta(data, meta)
+            if text:
+                yield text
+
+
+async def cancel_on_disconnect(events: AsyncIterator[Any],
+                               is_disconnected: Callable[[], Awaitable[bool]],
+                               name: str = "stream",
+                               poll_s: float = DISCONNECT_POLL_S,
+                               queue_size: int = SSE_QUEUE_SIZE) -> AsyncIterator[Any]:
+    """
+    Прогоняет `events` в отдельной задаче и отдаёт его элементы. Пока идёт поток, раз в `poll_s`
+    проверяется `is_disconnected()` (например, `request.is_disconnected`); когда клиент ушёл,
+    задача отменяется: CancelledError проходит через Agent и Generator до клиента LLM, который
+    закрывает HTTP-запрос, и llama-server прекращает генерацию. Без этого отключение замечается
+    только при следующей записи в сокет, а между событиями (анализ намерения, поиск) — никогда.
+    Отменённые потоки считаются в метрике `sse_cancelled{stream=name}`.
+    Очередь ограничена `queue_size` событиями: медленный клиент тормозит генерацию, а не копит
+    события в памяти. Отмена, пришедшая, пока задача ждёт места в очереди, закрывает `events`.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    finished = object()
+
+    def cancel():
+        if not producer.done() and not producer.cancelling():
+            metrics.inc("sse_cancelled", stream=name)
+            producer.cancel()
+
+    async def produce():
+        delivered = False
+        try:
+            try:
+                async for item in events:
+                    await queue.put(item)
+            except Exception as e:
+                await queue.put(e)
+            else:
+                await queue.put(finished)
+            delivered = True
+        finally:
+            if not delivered:
+                # отменены (клиент ушёл или поток закрыли): непрочитанные события уже не нужны,
+                # читателя будим в любом случае
+                while True:
+                    try:
+                        queue.put_nowait(finished)
+                        break
+                    except asyncio.QueueFull:
+                        queue.get_nowait()
+                # отмена могла прийти в queue.put, а не внутри events: закрываем его сами,
+                # чтобы GeneratorExit дошёл до клиента LLM и запрос к серверу закрылся
+                aclose = getattr(events, "aclose", None)
+                if aclose is not None:
+                    try:
+                        await aclose()
+                    except Exception as e:
+                        print(f"Error closing {name} after cancellation: {e}")
+
+    async def watch():
+        while not await is_disconnected():
+            await asyncio.sleep(poll_s)
+        if not producer.done():
+            print(f"SSE client disconnected, cancelling {name}")
+            cancel()
+
+    producer = asyncio.create_task(produce())
+    watcher = asyncio.create_task(watch())
+    try:
+        while True:
+            item = await queue.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        watcher.cancel()
+        # поток закрыли снаружи (ошибка записи, отмена ответа Starlette)
+        cancel()
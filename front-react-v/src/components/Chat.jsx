@@ -35,6 +35,26 @@ function Chat({ currentThread, onThreadUpdate, disabled }) {
     }
   };
 
+  // Shows an error as (the end of) the agent's reply
+  const showError = (text) => {
+    setMessages(prev => {
+      const lastMessage = prev[prev.length - 1];
+      if (lastMessage && lastMessage.sender === 'agent') {
+        const separator = lastMessage.text ? '\n' : '';
+        return [...prev.slice(0, -1), { ...lastMessage, text: `${lastMessage.text}${separator}[${text}]`, streaming: false }];
+      }
+      return [...prev, { id: Date.now(), text: `[${text}]`, sender: 'agent' }];
+    });
+  };
+
+  // 429: the LLM queue is full, 503: the LLM backend is down; both tell when to retry
+  const errorText = (status, detail, retryAfter) => {
+    const reason = status === 429 ? 'The server is busy' : status === 503 ? 'The language model is unavailable' : `Error ${status}`;
+    const seconds = Math.ceil(Number(retryAfter));
+    const retry = seconds > 0 ? `, try again in ${seconds} s` : '';
+    return `${reason}${retry}${detail ? ` (${detail})` : ''}`;
+  };
+
   const handleSendMessage = (text, useDbExplorer) => {
     if (!currentThread) return;
 
@@ -53,10 +73,24 @@ function Chat({ currentThread, onThreadUpdate, disabled }) {
           body: JSON.stringify({ content: text, use_db_explorer: useDbExplorer }),
         });
 
+        if (!response.ok) {
+          // rejected before the stream started (e.g. 429 when the LLM queue is full)
+          let detail = '';
+          try {
+            detail = (await response.json()).detail || '';
+          } catch (e) {
+            detail = '';
+          }
+          showError(errorText(response.status, detail, response.headers.get('Retry-After')));
+          return;
+        }
         if (!response.body) return;
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
 
+        // SSE events may be split across reads or arrive several per read,
+        // so buffer the text and only parse complete events ("\n\n"-terminated).
+        let buffer = '';
         let streaming = true;
         while (streaming) {
           const { done, value } = await reader.read();
@@ -64,12 +98,60 @@ function Chat({ currentThread, onThreadUpdate, disabled }) {
             streaming = false;
             break;
           }
-          
-          const chunk = decoder.decode(value, { stream: true });
-          const jsonStrings = chunk.replace(/^data: /, '').split('\n\n').filter(s => s);
-          jsonStrings.forEach(jsonStr => {
+
+          buffer += decoder.decode(value, { stream: true });
+          const events = buffer.split('\n\n');
+          buffer = events.pop();
+          events.forEach(rawEvent => {
+            const jsonStr = rawEvent
+              .split('\n')
+              .filter(line => line.startsWith('data:'))
+              .map(line => line.replace(/^data: ?/, ''))
+              .join('\n');
+            if (!jsonStr) return;
 			  try {
-				  const eventData = JSON.parse(JSON.parse(jsonStr).data);
+				  const event = JSON.parse(jsonStr);
+                  if (event.type === 'delta') {
+                    // A piece of the answer being generated: append it to the message being streamed
+                    setIsThinking(false);
+                    setMessages(prev => {
+                      const currentMessages = [...prev];
+                      const lastMessage = currentMessages[currentMessages.length - 1];
+                      if (lastMessage && lastMessage.sender === 'agent' && lastMessage.streaming) {
+                        // reset: the backend is retrying the generation, drop what was streamed so far
+                        const text = event.reset ? event.data : lastMessage.text + event.data;
+                        currentMessages[currentMessages.length - 1] = { ...lastMessage, text };
+                        return currentMessages;
+                      }
+                      if (event.reset) return currentMessages;
+                      return [...currentMessages, {
+                        id: Date.now() + Math.random(),
+                        text: event.data,
+                        sender: 'agent',
+                        retrieved_docs: [],
+                        follow_up: !!(lastMessage && lastMessage.sender === 'agent' && lastMessage.text),
+                        streaming: true,
+                      }];
+                    });
+                    return;
+                  }
+                  if (event.type === 'usage') {
+                    // Tokens and time of the turn per agent step and backend
+                    console.debug('Turn usage', event.data);
+                    return;
+                  }
+                  if (event.type === 'trace') {
+                    // Per-stage durations of the turn (TRACING=1 on the server)
+                    console.debug('Turn trace', event.data);
+                    return;
+                  }
+                  if (event.type === 'error') {
+                    // The turn was rejected or the backend failed after the stream started
+                    setIsThinking(false);
+                    showError(errorText(event.status, event.data, event.retry_after));
+                    return;
+                  }
+				  const eventData = JSON.parse(event.data);
                   if (eventData.answer.startsWith('<internal>')) {
                     setIsThinking(true);
                     return; 
@@ -80,7 +162,18 @@ function Chat({ currentThread, onThreadUpdate, disabled }) {
                     const currentMessages = [...prev];
                     const lastMessage = currentMessages[currentMessages.length - 1];
 
-                    if (eventData.follow_up && lastMessage && lastMessage.sender === 'agent' && lastMessage.text) {
+                    if (lastMessage && lastMessage.sender === 'agent' && lastMessage.streaming) {
+                      // The full answer replaces the streamed deltas
+                      currentMessages[currentMessages.length - 1] = {
+                        ...lastMessage,
+                        text: eventData.answer,
+                        retrieved_docs: eventData.retrieved_docs || [],
+                        follow_up: eventData.follow_up || lastMessage.follow_up,
+                        streaming: false,
+                      };
+                      return currentMessages;
+                    }
+                    else if (eventData.follow_up && lastMessage && lastMessage.sender === 'agent' && lastMessage.text) {
                       const newBotMessage = {
                         id: Date.now() + Math.random(),
                         text: eventData.answer,
@@ -116,14 +209,7 @@ function Chat({ currentThread, onThreadUpdate, disabled }) {
         }
       } catch (error) {
         console.error("Streaming failed:", error);
-        setMessages(prev => {
-            const lastMessage = prev[prev.length -1];
-            if(lastMessage && lastMessage.sender === 'agent') {
-                lastMessage.text += '\n[Error receiving response]';
-                return [...prev];
-            }
-            return [...prev, { id: Date.now(), text: '[Error receiving response]', sender: 'agent' }];
-        });
+        showError('Error receiving response');
       } finally {
         setIsStreaming(false);
         setIsThinking(false);
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# tests import the application as `app.*`, like `python -m app.benchmarks.ingest_bench`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# no runtime logs or background probes from the code under test
+os.environ.setdefault("LLM_LOG", "0")
+os.environ.setdefault("LLM_ROUTER_HEALTH_INTERVAL_S", "0")
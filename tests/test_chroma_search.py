@@ -0,0 +1,60 @@
+"""
+ChromaClient.search_chunks_many on an in-memory Chroma collection with a stub embedding client:
+exclusion, the `n_results` cap and the tracing span of the call.
+"""
+import chromadb
+import pytest
+
+from app.chroma_client import ChromaClient
+from app.tracing import Trace, current_span, current_trace
+
+
+class StubEmbeddings:
+    def embed_texts(self, texts):
+        return [[1.0, 0.0, 0.0] for _ in texts]
+
+
+@pytest.fixture
+def chroma():
+    client = ChromaClient.__new__(ChromaClient)  # no persistent store or embedding server
+    store = chromadb.EphemeralClient()
+    for name in ("test_chunks", "test_documents"):
+        if name in [c.name for c in store.list_collections()]:
+            store.delete_collection(name)
+    client.collection = store.create_collection("test_chunks")
+    client.documents_collection = store.create_collection("test_documents")
+    client.embedding_client = StubEmbeddings()
+    client.collection.add(ids=["a0", "a1", "a2", "b0"],
+                          embeddings=[[1, 0, 0], [1, 0, 1], [1, 0, 2], [0, 1, 0]],
+                          documents=["a0", "a1", "a2", "b0"],
+                          metadatas=[{"doc_id": "A"}] * 3 + [{"doc_id": "B"}])
+    client.documents_collection.add(ids=["A", "B"], embeddings=[[1, 0, 0]] * 2,
+                                    metadatas=[{"chunks": 3}, {"name": "b"}])
+    return client
+
+
+def test_chunk_count_from_metadata_or_collection(chroma):
+    assert chroma._chunk_count(["A"]) == 3
+    # B has no `chunks` metadata: the whole collection bounds the search
+    assert chroma._chunk_count(["A", "B"]) == 4
+    assert chroma._chunk_count() == 4
+
+
+def test_excluded_chunks_are_skipped_within_the_thread(chroma):
+    results = chroma.search_chunks_many(["q1", "q2"], top_k=5, doc_ids=["A"], exclude_ids={"a0", "a1"})
+    assert [[c["id"] for c in r] for r in results] == [["a2"], ["a2"]]
+    assert chroma.search_chunks_many(["q"], top_k=2, doc_ids=["A"], exclude_ids={"a0", "a1", "a2"}) == [[]]
+
+
+def test_search_span_is_named_after_the_search(chroma):
+    trace = Trace("test")
+    current_trace.set(trace)
+    current_span.set(trace.root)
+    try:
+        chroma.search_chunks_many(["q"], top_k=2, doc_ids=["A"])
+    finally:
+        current_trace.set(None)
+        current_span.set(None)
+    spans = {s.name: s for s in trace.spans}
+    assert "chroma.search_chunks_many" in spans
+    assert spans["chroma.search_chunks_many"].attributes == {"queries": 1, "top_k": 2, "excluded": 0}
@@ -0,0 +1,53 @@
+"""
+Golden-output tests of `chunk_text`: checked-in inputs with the chunks the reference
+(pre single-pass) chunker produced for them. Regenerate a pair only for an intended change.
+"""
+import json
+import os
+
+import pytest
+
+from app.ingest import _split_sentences, chunk_text
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "chunking")
+CASES = sorted(name[:-4] for name in os.listdir(FIXTURES) if name.endswith(".txt"))
+
+
+def _load(case: str):
+    with open(os.path.join(FIXTURES, f"{case}.txt"), encoding="utf-8") as f:
+        text = f.read()
+    with open(os.path.join(FIXTURES, f"{case}.json"), encoding="utf-8") as f:
+        expected = json.load(f)
+    return text, expected
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_chunk_text_golden(case):
+    text, expected = _load(case)
+    assert chunk_text(text, expected["chunk_size"], expected["overlap"]) == expected["chunks"]
+
+
+def test_initials_do_not_end_a_sentence():
+    text, expected = _load("initials_ru")
+    assert len(text) >= 2000 and "\n" not in text  # punctuation mode
+    assert any("утвердил И.О. Петров, согласовал А. Смирнов" in c for c in expected["chunks"])
+    sentences = _split_sentences("Документ утвердил И.О. Петров. Подписал J.R. Smith. Готово и т.д. Конец.")
+    assert sentences == ["Документ утвердил И.О. Петров.", "Подписал J.R. Smith.", "Готово и т.д.", "Конец."]
+
+
+def test_short_text_with_newlines_splits_by_lines():
+    text, _ = _load("newline_short")
+    assert len(text) < 2000
+    assert _split_sentences(text) == [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def test_overlap_tail_across_2000_chars():
+    _, expected = _load("newline_around_2000")
+    lengths = [len(c) for c in expected["chunks"]]
+    # chunks on both sides of the line-mode threshold, with line breaks inside
+    assert any(l < 2000 and "\n" in c for l, c in zip(lengths, expected["chunks"]))
+    assert any(l >= 2000 and "\n" in c for l, c in zip(lengths, expected["chunks"]))
+    # every chunk after the first starts with the overlap tail of the previous one
+    # (under 2,000 chars the tail is its last two lines, joined with a space)
+    for prev, cur in zip(expected["chunks"], expected["chunks"][1:]):
+        assert " ".join(cur.split()[:8]) in " ".join(prev.split())
@@ -0,0 +1,47 @@
+"""
+Parity of the extractor engines: for every checked-in HTML page and DOCX body, each engine of
+`EXTRACTORS[fmt]` must produce the text of the DOM-based "dom" engine, which is pinned in
+`<fixture>.expected.txt`. DOCX fixtures are `word/document.xml` bodies, packed into a
+python-docx template at test time.
+"""
+import io
+import os
+import zipfile
+
+import pytest
+from docx import Document
+
+from app.ingest import EXTRACTORS
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "extractors")
+HTML = sorted(name for name in os.listdir(FIXTURES) if name.endswith(".html"))
+DOCX = sorted(name for name in os.listdir(FIXTURES) if name.endswith(".document.xml"))
+
+
+def _expected(name: str) -> str:
+    with open(os.path.join(FIXTURES, f"{name}.expected.txt"), encoding="utf-8") as f:
+        return f.read()
+
+
+def _docx(name: str, tmp_path) -> str:
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        xml = f.read()
+    template = io.BytesIO()
+    Document().save(template)
+    path = str(tmp_path / name.replace(".document.xml", ".docx"))
+    with zipfile.ZipFile(template) as src, zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as dst:
+        for item in src.infolist():
+            dst.writestr(item, xml if item.filename == "word/document.xml" else src.read(item.filename))
+    return path
+
+
+@pytest.mark.parametrize("engine", sorted(EXTRACTORS["html"]))
+@pytest.mark.parametrize("name", HTML)
+def test_html_engines_match(name, engine):
+    assert EXTRACTORS["html"][engine](os.path.join(FIXTURES, name)) == _expected(name)
+
+
+@pytest.mark.parametrize("engine", sorted(EXTRACTORS["docx"]))
+@pytest.mark.parametrize("name", DOCX)
+def test_docx_engines_match(name, engine, tmp_path):
+    assert EXTRACTORS["docx"][engine](_docx(name, tmp_path)) == _expected(name)
@@ -0,0 +1,50 @@
+"""
+IntentRouter with a stub embedding client: turns with documents go to the LLM until a
+calibration is loaded, then confident turns are routed.
+"""
+import hashlib
+import re
+from datetime import datetime
+
+from app.intent_router import NO_RETRIEVE, IntentRouter
+from app.schemas import Thread, UserMessage
+
+
+class StubEmbeddings:
+    """Bag-of-words vectors: messages sharing words are similar."""
+
+    def embed_texts(self, texts):
+        vectors = []
+        for text in texts:
+            vector = [0.0] * 64
+            for word in re.findall(r"\w+", text.lower()):
+                vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % 64] += 1.0
+            vectors.append(vector)
+        return vectors
+
+
+def _thread(message: str, document_ids=("doc-1",)) -> Thread:
+    return Thread(id="t", name="t", created_at=datetime.now(), metadata={},
+                  history=[UserMessage(sender="user", content=message)], document_ids=list(document_ids))
+
+
+def test_uncalibrated_router_leaves_intent_to_the_llm(tmp_path):
+    router = IntentRouter(StubEmbeddings(), path=str(tmp_path / "missing.json"), threshold=0.0)
+    decision = router.route(_thread("привет"))
+    assert (decision.routed, decision.reason) == (False, "uncalibrated")
+    # no documents: nothing to retrieve, no LLM call needed either way
+    assert router.route(_thread("привет", document_ids=())).routed
+    stats = router.stats()
+    assert stats["uncalibrated"] == 1 and stats["calibrated"] is False
+
+
+def test_calibration_file_enables_routing(tmp_path):
+    path = str(tmp_path / "intent_router.json")
+    seeded = IntentRouter(StubEmbeddings(), path=None)
+    seeded.threshold = 0.0
+    seeded.save(path)
+
+    router = IntentRouter(StubEmbeddings(), path=path)
+    assert router.calibrated
+    decision = router.route(_thread("привет"))
+    assert decision.routed and decision.label == NO_RETRIEVE
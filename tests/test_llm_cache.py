@@ -0,0 +1,56 @@
+"""
+LLMCache: both tiers, disk I/O of the asyncio methods off the event loop thread, disk-tier pruning.
+"""
+import asyncio
+import os
+import threading
+import time
+
+from app.llm_cache import LLMCache
+
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+    LLMCache(cache_dir=str(tmp_path)).put("k", '{"a": 1}')
+    cache = LLMCache(cache_dir=str(tmp_path))
+    assert cache.get("k") == '{"a": 1}'
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["misses"]) == (1, 1)
+
+
+def test_async_disk_io_runs_off_the_event_loop(tmp_path, monkeypatch):
+    cache = LLMCache(cache_dir=str(tmp_path), prune_every=1)
+    threads = {}
+    for name in ("_read", "_write", "prune"):
+        original = getattr(cache, name)
+
+        def spy(*args, _name=name, _original=original):
+            threads[_name] = threading.get_ident()
+            return _original(*args)
+
+        monkeypatch.setattr(cache, name, spy)
+
+    async def run():
+        await cache.aput("k", "text")
+        await asyncio.sleep(0.1)  # the prune is not awaited
+        cache._memory.clear()
+        assert await cache.aget("k") == "text"
+        assert await cache.aget("k") == "text"  # memory tier now
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert set(threads) == {"_read", "_write", "prune"}
+    assert loop_thread not in threads.values()
+    assert cache.stats()["memory_hits"] == 1 and cache.stats()["disk_hits"] == 1
+
+
+def test_prune_keeps_the_newest_files_within_limits(tmp_path):
+    cache = LLMCache(cache_dir=str(tmp_path), disk_max_entries=3, disk_max_bytes=0, prune_every=1000)
+    for i in range(6):
+        cache.put(f"k{i}", "x" * 100)
+        os.utime(tmp_path / f"k{i}.json", (time.time() - 60 + i, time.time() - 60 + i))
+    stale_tmp = tmp_path / "k9.json.1.2.tmp"
+    stale_tmp.write_text("")
+    os.utime(stale_tmp, (0, 0))
+    assert cache.prune() == 4
+    assert sorted(os.listdir(tmp_path)) == ["k3.json", "k4.json", "k5.json"]
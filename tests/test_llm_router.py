@@ -0,0 +1,211 @@
+"""
+LlmRouter and LlamaGenAI failover against local stub llama-servers (stdlib HTTP servers on
+random ports): replica choice, ejection, `/health` probes and failover of non-streamed and
+streamed calls, which only fail over before the first token.
+"""
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from app.llama_gen import LlamaGenAI
+from app.llm_router import LlmRouter
+
+
+class StubLlama:
+    """
+    A llama-server stand-in. `mode`: "ok"; "error" (500 on completions); "down" (500 on
+    everything, /health included); "cut" (streams one delta, then drops the connection).
+    """
+
+    def __init__(self, name: str, slots: int = 2):
+        self.name = name
+        self.mode = "ok"
+        self.busy_slots = set()
+        self.total_slots = slots
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if stub.mode == "down":
+                    return self._json(500, {"error": "down"})
+                if self.path == "/props":
+                    return self._json(200, {"total_slots": stub.total_slots, "default_generation_settings": {"n_ctx": 4096}})
+                if self.path == "/health":
+                    return self._json(200, {"status": "ok"})
+                if self.path == "/slots":
+                    return self._json(200, [{"id": i, "is_processing": i in stub.busy_slots} for i in range(stub.total_slots)])
+                if self.path == "/v1/models":
+                    return self._json(200, {"data": [{"id": "stub.gguf"}]})
+                return self._json(404, {})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stub.requests.append(body)
+                if stub.mode in ("error", "down"):
+                    return self._json(500, {"error": "boom"})
+                if not body.get("stream"):
+                    return self._json(200, {"choices": [{"message": {"content": f"from {stub.name}"}}]})
+                events = [{"choices": [{"delta": {"content": f"from {stub.name}"}}]},
+                          {"choices": [{"delta": {"content": "!"}}]}]
+                data = "".join(f"data: {json.dumps(e)}\n\n" for e in events) + "data: [DONE]\n\n"
+                if stub.mode == "cut":
+                    data = f"data: {json.dumps(events[0])}\n\n"
+                raw = data.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                # "cut" promises more than it sends: the client sees a truncated body
+                self.send_header("Content-Length", str(len(raw) + (1000 if stub.mode == "cut" else 0)))
+                self.end_headers()
+                self.wfile.write(raw)
+                self.wfile.flush()
+                if stub.mode == "cut":
+                    self.close_connection = True
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stubs():
+    servers = [StubLlama("a"), StubLlama("b")]
+    yield servers
+    for server in servers:
+        server.close()
+
+
+def test_props_are_read(stubs):
+    router = LlmRouter([s.base for s in stubs])
+    assert [r.total_slots for r in router.replicas] == [2, 2]
+    assert router.n_ctx == 4096
+
+
+def test_choose_least_loaded_and_exclude(stubs):
+    router = LlmRouter([s.base for s in stubs])
+    a, b = router.replicas
+    with router.lease(a):
+        assert all(router.choose() is b for _ in range(10))
+    assert router.choose(exclude=[a.base]) is b
+    # nothing left after excluding: falls back to any replica
+    assert router.choose(exclude=[a.base, b.base]) in (a, b)
+
+
+def test_choose_keeps_thread_affinity_until_saturated(stubs):
+    router = LlmRouter([s.base for s in stubs])
+    home = router.choose("thread-1")
+    assert all(router.choose("thread-1") is home for _ in range(10))
+    other = next(r for r in router.replicas if r is not home)
+    with router.lease(home), router.lease(home):
+        # home is full (2 of 2 slots) and the other replica is idle
+        assert router.choose("thread-1") is other
+
+
+def test_failures_eject_and_bad_requests_do_not(stubs):
+    router = LlmRouter([s.base for s in stubs], eject_after=2, eject_s=60)
+    a, b = router.replicas
+    request = httpx.Request("POST", a.url)
+    router.mark_failure(a, httpx.HTTPStatusError("bad", request=request, response=httpx.Response(400, request=request)))
+    router.mark_failure(a, httpx.HTTPStatusError("bad", request=request, response=httpx.Response(400, request=request)))
+    assert a.ejected_until == 0.0 and a.failures == 0
+    router.mark_failure(a, httpx.ConnectError("refused"))
+    router.mark_failure(a, httpx.ConnectError("refused"))
+    assert a.ejected_until > 0
+    assert all(router.choose() is b for _ in range(10))
+    assert router.stats()[0]["healthy"] is False
+
+
+def test_health_check_ejects_and_reinstates(stubs):
+    router = LlmRouter([s.base for s in stubs], eject_s=60)
+    a = router.replicas[0]
+    stubs[0].mode = "down"
+    assert router.check(a) is False
+    assert router.stats()[0]["healthy"] is False
+    stubs[0].mode = "ok"
+    stubs[0].busy_slots = {1}
+    assert router.check(a) is True
+    assert router.stats()[0]["healthy"] is True
+    assert a.idle_slots == 1 and a.free_slot_ids == {0}
+
+
+def test_claim_slot_only_when_idle(stubs):
+    router = LlmRouter([stubs[0].base])
+    replica = router.replicas[0]
+    thread = "thread-7"
+    home = replica.slot_for(thread)
+    stubs[0].busy_slots = {home}
+    router.check(replica)
+    assert router.claim_slot(replica, thread) is None
+    stubs[0].busy_slots = set()
+    router.check(replica)
+    assert router.claim_slot(replica, thread) == home
+    # reserved until the lease ends
+    assert router.claim_slot(replica, thread) is None
+    with router.lease(replica, home):
+        pass
+    assert router.claim_slot(replica, thread) == home
+
+
+async def collect(client, received=None, **kwargs):
+    received = [] if received is None else received
+    async for delta in client.astream(**kwargs):
+        received.append(delta)
+    return "".join(received)
+
+
+def test_complete_fails_over_to_another_replica(stubs):
+    stubs[0].mode = "error"
+    router = LlmRouter([s.base for s in stubs])
+    client = LlamaGenAI(stubs[0].base, router=router)
+    for _ in range(4):
+        assert asyncio.run(client.acomplete(user="hi")) == "from b"
+    assert router.replicas[0].errors >= 1
+
+
+def test_complete_raises_when_every_replica_fails(stubs):
+    for stub in stubs:
+        stub.mode = "error"
+    client = LlamaGenAI(stubs[0].base, router=LlmRouter([s.base for s in stubs]))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.acomplete(user="hi"))
+    assert len(stubs[0].requests) == 1 and len(stubs[1].requests) == 1
+
+
+def test_stream_fails_over_before_the_first_token(stubs):
+    stubs[0].mode = "error"
+    client = LlamaGenAI(stubs[0].base, router=LlmRouter([s.base for s in stubs]))
+    for _ in range(4):
+        assert asyncio.run(collect(client, user="hi")) == "from b!"
+
+
+def test_stream_does_not_fail_over_after_the_first_token(stubs):
+    stubs[0].mode = "cut"
+    stubs[1].mode = "cut"
+    client = LlamaGenAI(stubs[0].base, router=LlmRouter([s.base for s in stubs]))
+    received = []
+    with pytest.raises(httpx.TransportError):
+        asyncio.run(collect(client, received, user="hi"))
+    # one replica tried: its first token was already passed on
+    assert len(received) == 1
+    assert len(stubs[0].requests) + len(stubs[1].requests) == 1
@@ -0,0 +1,78 @@
+"""
+cancel_on_disconnect: backpressure from a slow reader and cancellation of the producer on disconnect.
+"""
+import asyncio
+
+from app.utils.sse import cancel_on_disconnect
+
+
+def test_slow_reader_bounds_the_producer():
+    produced = []
+
+    async def events():
+        for i in range(200):
+            produced.append(i)
+            yield i
+
+    async def connected():
+        return False
+
+    async def run():
+        received = []
+        async for item in cancel_on_disconnect(events(), connected, queue_size=4, poll_s=0.01):
+            received.append(item)
+            await asyncio.sleep(0.001)
+            # the producer is at most the queue plus the item in hand ahead of the reader
+            assert len(produced) - len(received) <= 4 + 1
+        return received
+
+    assert asyncio.run(run()) == list(range(200))
+
+
+def test_disconnect_closes_a_producer_waiting_for_queue_space():
+    state = {"closed": False, "disconnected": False}
+
+    async def events():
+        try:
+            for i in range(1000):
+                yield i
+        finally:
+            state["closed"] = True  # the LLM request of the pipeline is closed here
+
+    async def is_disconnected():
+        return state["disconnected"]
+
+    async def run():
+        received = []
+        async for item in cancel_on_disconnect(events(), is_disconnected, queue_size=2, poll_s=0.01):
+            received.append(item)
+            if len(received) == 3:
+                state["disconnected"] = True
+                await asyncio.sleep(0.1)  # a stalled client: the producer is blocked in put
+        await asyncio.sleep(0.05)
+        # closed by the cancelled producer, not by the loop's shutdown of leftover generators
+        return received, state["closed"]
+
+    received, closed = asyncio.run(run())
+    assert closed
+    assert len(received) < 10
+
+
+def test_errors_reach_the_reader_after_the_items():
+    async def events():
+        yield 1
+        yield 2
+        raise ValueError("boom")
+
+    async def connected():
+        return False
+
+    async def run():
+        received = []
+        try:
+            async for item in cancel_on_disconnect(events(), connected, queue_size=1, poll_s=0.01):
+                received.append(item)
+        except ValueError as e:
+            return received, str(e)
+
+    assert asyncio.run(run()) == ([1, 2], "boom")
@@ -0,0 +1,52 @@
+"""
+record_openai_usage: where the cached token count comes from (llama-server `timings.cache_n`,
+OpenRouter `usage.prompt_tokens_details.cached_tokens`, or derived from `timings.prompt_n`)
+and that a fully cached prompt (prompt_n = 0) is reported as such.
+"""
+import contextvars
+
+from app.usage import TurnUsage, current_usage, record_openai_usage
+
+
+def record(usage, timings):
+    turn = TurnUsage()
+
+    def run():
+        current_usage.set(turn)
+        return record_openai_usage("llama", usage, timings, 12.0)
+
+    return contextvars.copy_context().run(run), turn.total
+
+
+def test_cached_from_llama_server_timings():
+    tokens, total = record({"prompt_tokens": 100, "completion_tokens": 5},
+                           {"prompt_n": 30, "cache_n": 70, "predicted_n": 5})
+    assert tokens == {"prompt_tokens": 100, "evaluated_tokens": 30, "cached_tokens": 70}
+    assert (total.prompt_tokens, total.cached_tokens, total.completion_tokens) == (100, 70, 5)
+
+
+def test_cached_from_prompt_tokens_details():
+    tokens, total = record({"prompt_tokens": 100, "completion_tokens": 5,
+                            "prompt_tokens_details": {"cached_tokens": 64}}, None)
+    assert tokens == {"prompt_tokens": 100, "evaluated_tokens": 36, "cached_tokens": 64}
+    assert total.cached_tokens == 64
+
+
+def test_cached_derived_from_prompt_n():
+    tokens, total = record({"prompt_tokens": 100, "completion_tokens": 5}, {"prompt_n": 40})
+    assert tokens == {"prompt_tokens": 100, "evaluated_tokens": 40, "cached_tokens": 60}
+    assert total.cached_tokens == 60
+
+
+def test_fully_cached_prompt_reports_zero_evaluated():
+    tokens, total = record({"prompt_tokens": 100, "completion_tokens": 0,
+                            "prompt_tokens_details": {"cached_tokens": 96}}, {"prompt_n": 0, "predicted_n": 1})
+    # prompt_n = 0 is the server's count, not a missing one
+    assert tokens == {"prompt_tokens": 100, "evaluated_tokens": 0, "cached_tokens": 96}
+    assert total.completion_tokens == 0
+
+
+def test_no_cache_information():
+    tokens, total = record({"prompt_tokens": 100, "completion_tokens": 5}, None)
+    assert tokens == {"prompt_tokens": 100, "evaluated_tokens": 100, "cached_tokens": 0}
+    assert (total.llm_calls, total.llm_ms) == (1, 12.0)